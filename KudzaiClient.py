@@ -6,13 +6,25 @@ Author: Kudzaishe Nyika
 Date: 04 March 2024
 """
 from socket import *
+import json
+import os
 import sys
 import struct
 import threading
 from queue import Queue
+from concurrent.futures import Future
+import itertools
 import time
+import random
+from protocol import Channel, ProtocolError, PROTOCOL_ACK, SESSION_PREFIX, RESUME_PREFIX, BATCH_PREFIX, encode_batch, \
+    decode_batch_results, upgrade_hello, agreed_flags, PayloadCompressor, FLAG_ACCEPTS_COMPRESSED, DICTIONARY_ID
+from rudp import ReliableChannel
+from presence import PresenceView
+from filetransfer import FileServer, receive_file, download_path, format_report, TransferError, FILE_OFFER_PREFIX
+from rooms import ROOM_PREFIX
 
-COMMANDS = ["LIST_CLIENTS", "VISIBILITY", "CONNECT_TO", "TERMINATE", "CANCEL","\n"]
+COMMANDS = ["LIST_CLIENTS", "VISIBILITY", "CONNECT_TO", "TERMINATE", "CANCEL","\n", "FIND", "STATS", "SUBSCRIBE_PRESENCE",
+            "UNSUBSCRIBE_PRESENCE", "BATCH", "CREATE_ROOM", "JOIN_ROOM", "LEAVE_ROOM", "ROOM_SEND", "CANCEL_REQUEST"]
 
 visibilityOptions = {  # using numbers to prevent spelling errors
     0: "private",
@@ -28,42 +40,186 @@ Message_types = {
 
 
 lock = threading.Lock()
-#message_queue = Queue()
+REPLY_TIMEOUT = 10  # seconds to wait for the server to answer TERMINATE, or a resumed session's hello
+RECONNECT_ATTEMPTS = 6  # tries at resuming the session after the connection to the server drops
+RECONNECT_MAX_DELAY = 30  # most seconds to wait between tries
+FILE_OFFER_TIMEOUT = 3600  # seconds a file offered in a chat is served for
+FILE_ATTEMPTS = 5  # tries at fetching a file offered in a chat, each carrying on from where the last one got to
+leaving = False  # True once this user has asked to TERMINATE, so a closed connection is not a reason to reconnect
+incoming_requests = []  # connection requests waiting for this user to type Y or N
+chat_session = None  # the ReliableChannel of the chat in progress, if any
+chat_said_bye = False
+chat_heard_bye = False
+presence_view = PresenceView()  # who is public, kept up to date once this client has sent SUBSCRIBE_PRESENCE
+
+
+class ServerConnection:
+    """
+    A connection to the server that can have several commands waiting for replies at once.
 
+    A reader thread receives everything the server sends. Each command is sent with its own request ID, and the reply
+    carrying that ID completes the command's Future. Everything else the server sends (connection requests, peer
+    addresses, notices) goes on the pushes queue instead of being mistaken for a reply.
+    Commands sent before the server has acknowledged binary frames carry no request IDs, nor does anything sent to a
+    legacy text server, so replies without one are matched to those commands in the order they were sent.
 
-def serialize(message_type, user_id, message):
+    The server says which userID the client was given, along with a token for resuming the session should the
+    connection drop (see resumption.py); these are kept in user_id and resume_token. open_channel() does not wait for
+    that, so wait_joined() is there for anything that must know the server has taken the client on.
     """
-    Encodes messages so that they are received in a certain order. The order imitates the protocol header.
-    
-    :param message_type: The type of message needing to be sent
-    :type message_type: str
-    :param user_id: The user_ID of sender
-    :type user_id: str
-    :param message: The actual message needing to be sent
-    :type message: str
-    :rtype: bytes
-    
-    """
-    byte_message = f"{message_type},{user_id},{message}"
-    # print(byte_message)
-    return byte_message.encode('utf-8')
-
 
-def deserialize(data):
+    def __init__(self, channel, user_id):
+        self.channel = channel
+        self.user_id = user_id
+        self.resume_token = None  # None until the server sends one; legacy servers never do
+        self.resumed = False  # True if the server gave this connection a session that was left behind
+        self.pushes = Queue()  # (message_type, user_id, message) the server sent on its own; None once disconnected
+        self._request_ids = itertools.count(1)
+        self._waiting = {}  # request ID -> Future, oldest first
+        self._unnumbered = set()  # the request IDs of commands that may have been sent without them
+        self._lock = threading.Lock()
+        self._disconnected = False
+        self._joined = threading.Event()  # set once the server has given this client a session, or hung up
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def request(self, command):
+        """
+        Sends a command without waiting for its reply.
+        :param command: The command to send
+        :type command: str
+        :rtype: concurrent.futures.Future (completes with (message_type, user_id, message))
+        """
+        future = Future()
+        if "\n" in command and self.channel.binary is None:
+            # text goes one line per message until the server acknowledges frames (see protocol.py)
+            self.wait_joined()
+        with self._lock:
+            if self._disconnected:
+                future.set_exception(ConnectionError("connection to the server closed"))
+                return future
+            request_id = next(self._request_ids)
+            self._waiting[request_id] = future
+            if not self.channel.binary:
+                self._unnumbered.add(request_id)
+        try:
+            self.channel.send(0, self.user_id, command, request_id)
+        except OSError as error:
+            with self._lock:
+                self._waiting.pop(request_id, None)
+            future.set_exception(error)
+        return future
+
+    def wait_joined(self, timeout=REPLY_TIMEOUT):
+        """
+        Waits until the server has given this client its session. Legacy servers never say, so it times out with them.
+        :param timeout: seconds to wait at most
+        :type timeout: float
+        :rtype: bool (True if the server took the client on, False if it turned it away, hung up or did not say)
+        """
+        return self._joined.wait(timeout) and self.resume_token is not None
+
+    def send(self, message_type, message):
+        """
+        Sends a message that the server does not reply to, such as the answer to a connection request.
+        :param message_type: The type of message needing to be sent
+        :type message_type: int
+        :param message: The actual message needing to be sent
+        :type message: str
+        :rtype: None
+        """
+        self.channel.send(message_type, self.user_id, message)
+
+    def close(self):
+        self.channel.close()
+
+    def _read(self):
+        try:
+            while True:
+                message_type, request_id, user_id, message = self.channel.recv_frame()
+                if message_type == 2 and message == "PING":
+                    # the server checking that this client is still there
+                    self.channel.send(2, self.user_id, "PONG")
+                    continue
+                if message_type == 2 and message == PROTOCOL_ACK:
+                    # the server speaks binary frames, and the channel has switched to them
+                    if agreed_flags(self.channel.flags, request_id) & FLAG_ACCEPTS_COMPRESSED:
+                        self.channel.compressor = PayloadCompressor()
+                    continue
+                if message_type == 2 and message.startswith(SESSION_PREFIX):
+                    words = message.split()
+                    self.user_id, self.resume_token, self.resumed = words[1], words[2], words[3:] == ["resumed"]
+                    self._joined.set()
+                    continue
+                with self._lock:
+                    if not request_id and message_type != 4 and self._unnumbered:
+                        request_id = min(self._unnumbered)
+                    self._unnumbered.discard(request_id)
+                    future = self._waiting.pop(request_id, None)
+                if future is not None:
+                    future.set_result((message_type, user_id, message))
+                else:
+                    self.pushes.put((message_type, user_id, message))
+        except (OSError, ProtocolError, ValueError):
+            pass
+        with self._lock:
+            self._disconnected = True
+            waiting = list(self._waiting.values())
+            self._waiting.clear()
+            self._unnumbered.clear()
+        for future in waiting:
+            future.set_exception(ConnectionError("connection to the server closed"))
+        self._joined.set()
+        self.pushes.put(None)
+
+
+def open_channel(host, port, user_id, visibility, legacy=False, resume_token=None):
     """
-    Decodes data and returns the parts of the data in the correct order. 
-    
-    :param data: the data needing to be decoded
-    :type data: bytes 
-    :rtype: tuple of str
-    
-    """    
-    decoded_data = data.decode('utf-8')
-    segments = decoded_data.split(',')
-    message_type = segments[0]
-    user_id = segments[1]
-    message = segments[2]
-    return message_type, user_id, message
+    Connects to the server and says hello. The hello is sent in the text format, asking for binary frames in a way
+    older servers ignore (see protocol.upgrade_hello()), so nothing waits to find out what the server speaks: the
+    channel sends text until the server acknowledges, which ServerConnection looks out for, and frames from then on.
+    The hello says this client can take compressed replies, and if the acknowledgement says the server can too, big
+    commands are compressed. A client resuming its session knows the server speaks frames, so says hello in one and
+    waits for the answer. Otherwise this returns once the hello is sent, before the server has taken the client on;
+    ServerConnection.wait_joined() waits for that.
+    :param host: The server's host name or IP address
+    :type host: str
+    :param port: The server's port number
+    :type port: int
+    :param user_id: The userID to join with
+    :type user_id: str
+    :param visibility: 0 for private, 1 for public
+    :type visibility: int
+    :param legacy: speak the legacy text format only, without asking for binary frames
+    :type legacy: bool
+    :param resume_token: the token of a session to resume; the client joins afresh if the server no longer has it
+    :type resume_token: str
+    :rtype: protocol.Channel
+    :raises ConnectionRefusedError: if the server turned a resuming client away, e.g. because it is full
+    """
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.connect((host, port))
+    if resume_token is None:
+        channel = Channel(sock, binary=False if legacy else None)
+        channel.send(1, user_id, str(visibility) if legacy else upgrade_hello(visibility, FLAG_ACCEPTS_COMPRESSED))
+        return channel
+
+    channel = Channel(sock)
+    channel.send(2, user_id, RESUME_PREFIX + resume_token + " " + str(visibility), DICTIONARY_ID,
+                 flags=FLAG_ACCEPTS_COMPRESSED)
+    sock.settimeout(REPLY_TIMEOUT)
+    try:
+        message_type, server_id, message = channel.recv()
+    except (OSError, ProtocolError) as error:
+        channel.close()
+        raise ConnectionError("no answer to the hello: " + str(error))
+    sock.settimeout(None)
+    if message_type == 3:
+        channel.close()
+        raise ConnectionRefusedError(message)
+    if agreed_flags(channel.flags, channel.reply_to) & FLAG_ACCEPTS_COMPRESSED:
+        channel.compressor = PayloadCompressor()
+    return channel
 
 
 def on_and_connect():
@@ -71,28 +227,30 @@ def on_and_connect():
     Turns on the client and connects it to the server.
     :rtype: None
     """
+    args = [arg for arg in sys.argv[1:] if arg != "--legacy"]
     try:
-        host, port, visibility, user_id = sys.argv[1], int(sys.argv[2]), sys.argv[3], sys.argv[4]
+        host, port, visibility, user_id = args[0], int(args[1]), args[2], args[3]
     except:
         print("NOT ENOUGH ARGUMENTS")
         sys.exit(0)
 
-    global clientSocket, userID
+    global clientSocket, channel, server, userID, server_address, current_visibility
 
-    clientSocket = socket(AF_INET, SOCK_STREAM)
-    clientSocket.connect((host, port))
-
-    # CHANGE THE NEXT TO LINES TO USE THE SERIALIZE/DESERIALIZE WHAT_WHATS
     # send visibility status
     for i, value in visibilityOptions.items():
         if visibility.lower() == value:
             current_visibility = i
             break
     userID = user_id
+    server_address = (host, port)
     print("UserID: " + userID)
-    # use serialization here
-    clientSocket.sendall(serialize(1, userID, str(current_visibility)))
-    # send command
+    try:
+        channel = open_channel(host, port, userID, current_visibility, legacy="--legacy" in sys.argv)
+    except ConnectionRefusedError as error:
+        print(error)
+        sys.exit(0)
+    clientSocket = channel.sock
+    server = ServerConnection(channel, userID)
 
     print("CONNECTION ESTABLISHED!")
 
@@ -116,37 +274,64 @@ def send_commands(command):
     Sends commands to server.
     :param command: The command entered by the user
     :type command: str
-    :rtype: bool
+    :rtype: concurrent.futures.Future or None if nothing was sent
     
     """    
     command_keyword = (command.split()[0].split('\n')[0]).upper()
 
     if command_keyword in [COMMANDS[4], COMMANDS[5]]:
         print("NO COMMAND")
-        return False
+        return None
     # if the user wanted to see the list
     elif command_keyword == COMMANDS[0]:  # if you just want a list
-        clientSocket.send(serialize(0, userID, command.upper()))
-        return True
+        return server.request(command.upper())
     # if the user wants to change visibility
     elif command_keyword == COMMANDS[1]:
-        response = command.split()[1].lower()
+        response = command.split()[1].lower() if len(command.split()) > 1 else ""
         while response not in ["public", "private", "cancel"]:
-            message = "Invalid visibility option. Please type either PUBLIC or PRIVATE. Say CANCEL to exit this request."
+            print("Invalid visibility option. Please type either PUBLIC or PRIVATE. Say CANCEL to exit this request.")
             response = (input("Enter PUBLIC or PRIVATE: ")).lower()
         if response == "cancel":
-            return False
+            return None
 
-        clientSocket.send(serialize(0, userID, command.split()[0].upper() + " " + response))
-        return True
+        return server.request(command.split()[0].upper() + " " + response)
     elif command_keyword == COMMANDS[2]:  # if you wanna connect with someone
+        if len(command.split()) < 2:
+            print("Say CONNECT_TO followed by the userID you want to speak to")
+            return None
         # Debug
         print("SENDING: " + command_keyword + " " + command.split()[1])
         # Debug
-        clientSocket.send(serialize(0, userID, command_keyword + " " + command.split()[1]))
-        print("WAITING FOR REPLY...\n")
-        return True
-    return True
+        print("WAITING FOR REPLY... (you can carry on with other commands, or say CANCEL_REQUEST "
+              + command.split()[1] + " to take the request back)\n")
+        return server.request(command_keyword + " " + command.split()[1])
+    elif command_keyword == COMMANDS[6]:  # if you're looking for someone
+        if len(command.split()) < 2:
+            print("Say FIND followed by the start of a userID")
+            return None
+        # userIDs are case sensitive, so only the keyword is upper-cased
+        return server.request(command_keyword + " " + " ".join(command.split()[1:]))
+    elif command_keyword == COMMANDS[10]:  # several commands in one go, e.g. "BATCH LIST_CLIENTS; FIND ku"
+        parts = command.split(None, 1)[1].split(";") if len(command.split()) > 1 else []
+        # userIDs are case sensitive, so only the keywords are upper-cased
+        commands = [" ".join([part.split()[0].upper()] + part.split()[1:]) for part in parts if part.split()]
+        if not commands or not all(validate_command(each) for each in commands):
+            print("Say BATCH followed by commands separated by ';'")
+            return None
+        if not server.channel.binary:
+            print("BATCH needs a server that speaks binary frames")
+            return None
+        return server.request(encode_batch(commands))
+    elif command_keyword == COMMANDS[15]:  # if you no longer want to connect with someone you asked
+        if len(command.split()) < 2:
+            print("Say CANCEL_REQUEST followed by the userID you asked to CONNECT_TO")
+            return None
+        # userIDs are case sensitive, so only the keyword is upper-cased
+        return server.request(command_keyword + " " + command.split()[1])
+    elif command_keyword in COMMANDS[11:15]:  # group chat rooms, e.g. "ROOM_SEND team hello all"
+        # room names are case sensitive, and so is what is said, so only the keyword is upper-cased
+        return server.request(" ".join([command_keyword] + command.split(None, 1)[1:]))
+    return server.request(command)
 
 
  
@@ -167,19 +352,70 @@ def receive_response(message_type, user_id, response):
         # threading.Thread(target=prep_for_chat, args=(userID, response)).start()
     elif message_type == 3:
         print("CLIENT NOT AVAILABLE")
+        print(response)
     
     elif message_type == 1:
         print(response)
-        # ip_address, port_str = response.split(":")[1].strip()
+        if "address: " in response:
+            # the peer's address, sent to both clients once a request is accepted
+            ip_address, port_str = response.split("address: ")[1].strip().rsplit(":", 1)
+            print("YOU MAY CHAT NOW")
+            chat(ip_address, int(port_str))
     
+    elif message_type == 2 and PresenceView.is_presence(response):
+        show_presence(response)
+
+    elif message_type == 2 and response.startswith(BATCH_PREFIX):
+        show_batch_results(response)
+
+    elif message_type == 2 and response.startswith(ROOM_PREFIX):
+        # someone in one of your rooms said something
+        heading, _, text = response.partition("\n")
+        print("[" + heading[len(ROOM_PREFIX) + 1:] + "] " + user_id + ": " + text)
+
     else:
         print("From ", user_id + ":\n", response)
 
  
     
+def show_presence(response):
+    """
+    Applies a presence snapshot or delta from the server and prints who came and went. A delta that does not follow on
+    from what this client has means something was missed, so it asks to be caught up.
+    :param response: the snapshot or delta
+    :type response: str
+    :rtype: None
+    """
+    if not presence_view.apply(response):
+        future = server.request("SUBSCRIBE_PRESENCE " + str(presence_view.version))
+        future.add_done_callback(show_reply)
+        return
+    lines = response.split("\n")[1:]
+    if response.startswith("PRESENCE_SNAPSHOT"):
+        print("ONLINE (" + str(len(lines)) + "): " + ", ".join(lines))
+    else:
+        for change in lines:
+            print(change[1:] + (" is online" if change[0] == "+" else " has gone"))
+
+
+def show_batch_results(response):
+    """
+    Goes through the server's answer to a BATCH, handling each command's reply as if it had been sent on its own.
+    :param response: the answer
+    :type response: str
+    :rtype: None
+    """
+    for count, result in enumerate(decode_batch_results(response), 1):
+        print(str(count) + ". " + result["command"] + ": " + result["status"].upper())
+        if result["status"] == "pending":
+            print("WAITING FOR REPLY... (you can carry on with other commands)")
+        else:
+            receive_response(result["type"], "Server", result["reply"])
+
+
 def prep_for_chat(userID, response):
     """
-    Asks client if they want to chat, and performs actions based on client's reply 
+    Tells the client someone wants to chat. Their Y or N is typed at the command prompt (see answer_request()).
     :param user_id: The username of the client receiving request
     :type command: str
     :param response: The server response
@@ -187,117 +423,283 @@ def prep_for_chat(userID, response):
     :rtype: None
     """        
     
-    print("REQUEST RECEIVED!!:\n" + response)
-    reply = input("Enter reply: ")
+    with lock:
+        if response in incoming_requests:
+            return  # asked again after reconnecting
+        incoming_requests.append(response)
+    print("\nREQUEST RECEIVED!!:\n" + response)
 
-    while reply not in ["Y", "N"]:
-        reply = input("Invalid reply, say Y or N: ")  # validate response before sending to the server
 
+def answer_request(reply):
+    """
+    Sends the client's answer to the oldest connection request.
+    :param reply: 'Y' or 'N'
+    :type reply: str
+    :rtype: None
+    """
+    with lock:
+        incoming_requests.pop(0)
+    server.send(1, reply)
     if reply == "N":
         print("All good! Proceed with your commands.")
-        clientSocket.send(serialize(1, userID, reply))
-
     else:
-        clientSocket.send(serialize(1, userID, reply))
         print("REPLY SENT")
-        message_type, user_id, response = deserialize(clientSocket.recv(2048))
-        # DEBUG
-        print(response)
-        ip_address, port_str = response.split(":")[1].strip()
-        port = int(port_str)
-        print("YOU MAY CHAT NOW")
-        chat(ip_address, port)        
+
+
+def handle_pushes():
+    """
+    Handles everything the server sends that is not a reply to a command, for as long as the connection is open.
+    :rtype: None
+    """
+    while True:
+        push = server.pushes.get()
+        if push is None:
+            if leaving or not reconnect():
+                print("\nDisconnected from the server.")
+                return
+            continue
+        receive_response(*push)
+
+
+def reconnect():
+    """
+    Resumes the session after the connection to the server drops. Each try waits a random time up to a limit that
+    doubles every try, so clients that were all cut off at once do not all come back at once.
+    :rtype: bool (False if the server could not be reached)
+    """
+    global clientSocket, channel, server
+    if server.resume_token is None:
+        return False
+    print("\nLost the connection to the server, reconnecting...")
+    for attempt in range(RECONNECT_ATTEMPTS):
+        time.sleep(random.uniform(0, min(RECONNECT_MAX_DELAY, 2 ** attempt)))
+        try:
+            new_channel = open_channel(server_address[0], server_address[1], server.user_id, current_visibility,
+                                       resume_token=server.resume_token)
+        except OSError:
+            continue
+        channel = new_channel
+        clientSocket = channel.sock
+        server = ServerConnection(channel, server.user_id)
+        print("Reconnected to the server.")
+        if presence_view.version is not None:
+            # subscriptions do not survive the connection, so catch up from the version already seen
+            server.request("SUBSCRIBE_PRESENCE " + str(presence_view.version)).add_done_callback(show_reply)
+        return True
+    return False
+
+
+def show_reply(future):
+    """
+    Prints the server's reply to a command once it arrives.
+    :param future: the command's Future
+    :type future: concurrent.futures.Future
+    :rtype: None
+    """
+    try:
+        message_type, user_id, response = future.result()
+    except ConnectionError:
+        return
+    receive_response(message_type, user_id, response)
 
 
 def chat(destination_ip, destination_port):
     """
-    Manages a chat between two clients
+    Starts a chat with another client. Messages go over UDP from the same port as the connection to the server, with
+    retransmission and ordering from rudp.ReliableChannel. While the chat is on, lines typed at the prompt are sent to
+    the other client (see send_chat_message()) until both of you have said bye, and SEND_FILE <path> offers them a
+    file.
     :param destination_ip: IP address of the client you're talking to
     :type destination_ip: str
     :param destination_port: Port number of client you're talking to
-    :type destination_ip: str
+    :type destination_port: int
     :rtype: None
     
     """
-    # Using IPv4 and UDP protocol
-    me = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    source_ip = clientSocket.getsockname()[0]
-    source_port = clientSocket.getsockname()[1]
-    
-    # Creating socket
-    me.bind((source_ip, source_port))
-    chat_is_on = True
-    sent = 0
-    received = 0
-
-    # Function for receiving messages
-    def receiveMessage():
-        while chat_is_on:
-            if sent == 1 and received == 1:
-                print("Chat closed.")
-                break
-            data = me.recvfrom(1024)
-            data = data[0].decode()
-            if data[-len("bye"):] == "bye":
-                received = 1
-                print(f'{data}')
-        print("Receiving thread stopped")
-
-    def sendMessages():
-        print("...start chat")
-        if sent == 1 and received == 1:
-            print("Chat closed.")
-            chat_is_on = False
-        while chat_is_on:
-            in_message = input("")
-            if in_message == "bye":
-                sent = 1
-            message = "<" + userID + ">: " + in_message
-            me.sendto(message.encode(), (destination_ip, destination_port))
-        print("Sending thread stopped")
-
-    receive = threading.Thread(target=receiveMessage)
-    send = threading.Thread(target=sendMessages)
-
-    receive.start()
-    send.start()
-
-    #receive.join()
-    #send.join()
+    global chat_session, chat_said_bye, chat_heard_bye
+    me = socket(AF_INET, SOCK_DGRAM)
+    me.bind(clientSocket.getsockname())
+    session = ReliableChannel(me, (destination_ip, destination_port))
+    with lock:
+        chat_session = session
+        chat_said_bye = chat_heard_bye = False
+    print("...start chat")
+    threading.Thread(target=receive_chat_messages, args=(session,), daemon=True).start()
+
+
+def receive_chat_messages(session):
+    """
+    Prints what the other client says until the chat closes.
+    :param session: the chat's channel
+    :type session: rudp.ReliableChannel
+    :rtype: None
+    """
+    global chat_heard_bye
+    while True:
+        message = session.messages.get()
+        if message is None:
+            return
+        message = message.decode('utf-8', 'replace')
+        if message.startswith(FILE_OFFER_PREFIX):
+            threading.Thread(target=accept_file, args=(json.loads(message[len(FILE_OFFER_PREFIX):]), session.peer[0]),
+                             daemon=True).start()
+            continue
+        print(message)
+        if message.endswith(": bye"):
+            with lock:
+                chat_heard_bye = True
+            end_chat_if_done(session)
+
+
+def send_chat_message(message):
+    """
+    Sends a line typed at the prompt to the other client.
+    :param message: what the user typed
+    :type message: str
+    :rtype: None
+    """
+    global chat_said_bye
+    session = chat_session
+    if message.split()[0].upper() == "SEND_FILE":
+        if len(message.split()) < 2:
+            print("Say SEND_FILE followed by the path of the file")
+        else:
+            offer_file(session, message.split(None, 1)[1].strip())
+        return
+    session.send("<" + userID + ">: " + message)
+    if message == "bye":
+        with lock:
+            chat_said_bye = True
+        end_chat_if_done(session)
+
+
+def offer_file(session, path):
+    """
+    Offers a file to the other client in the chat, and serves it to them in the background.
+    :param session: the chat's channel
+    :type session: rudp.ReliableChannel
+    :param path: the file
+    :type path: str
+    :rtype: None
+    """
+    try:
+        file_server = FileServer(path, clientSocket.getsockname()[0])
+    except OSError as error:
+        print("Cannot send " + path + ": " + str(error))
+        return
+    file_server.start()
+    session.send(FILE_OFFER_PREFIX + json.dumps(file_server.offer()))
+    print("Offering " + os.path.basename(path) + " (" + format(file_server.size, ",") + " bytes)...")
+    threading.Thread(target=finish_offer, args=(file_server,), daemon=True).start()
+
+
+def finish_offer(file_server):
+    """
+    Stops serving an offered file once the other client has it, or once the offer runs out.
+    :param file_server: the file being served
+    :type file_server: filetransfer.FileServer
+    :rtype: None
+    """
+    received = file_server.done.wait(FILE_OFFER_TIMEOUT)
+    file_server.close()
+    name = os.path.basename(file_server.path)
+    if received:
+        print("Sent " + name + ": " + file_server.report())
+    else:
+        print("Stopped offering " + name + "; the other client did not fetch all of it")
+
+
+def accept_file(offer, host):
+    """
+    Fetches a file the other client in the chat offered, into the current directory. A transfer that is cut off is
+    tried again from where it got to.
+    :param offer: what the offer said: the file's name and size, and the port and token to fetch it with
+    :type offer: dict
+    :param host: the other client's address
+    :type host: str
+    :rtype: None
+    """
+    path = download_path(".", offer["name"])
+    print("Receiving " + os.path.basename(path) + " (" + format(offer["size"], ",") + " bytes)...")
+    for attempt in range(FILE_ATTEMPTS):
+        try:
+            report = receive_file(host, offer["port"], offer["token"], path)
+        except (OSError, ValueError, TransferError) as error:
+            print("Transfer of " + os.path.basename(path) + " cut off (" + str(error) + "), carrying on...")
+            time.sleep(2 ** attempt)
+            continue
+        print("Received " + os.path.basename(path) + ": " + format_report(report))
+        return
+    print("Gave up on " + os.path.basename(path) + "; if it is offered again, it carries on from where it got to")
+
+
+def end_chat_if_done(session):
+    """
+    Closes the chat once both clients have said bye.
+    :param session: the chat's channel
+    :type session: rudp.ReliableChannel
+    :rtype: None
+    """
+    global chat_session
+    with lock:
+        if chat_session is not session or not (chat_said_bye and chat_heard_bye):
+            return
+        chat_session = None
+    session.close()  # lets the last bye get through first
+    session.sock.close()
+    session.messages.put(None)
+    print("Chat closed.")
+
 
 def communicate_with_server():
     """
     Sends commands to the server and processes them accordingly.
     :rtype: None
     """        
+    global leaving
+    threading.Thread(target=handle_pushes, daemon=True).start()
     while True:
         command = input("Enter command: ")
+        if not command.split():
+            continue
+
+        # while chatting, everything typed goes to the other client
+        if chat_session is not None:
+            send_chat_message(command)
+            continue
+
+        # someone is waiting for an answer to their connection request
+        if incoming_requests and command.strip().upper() in ["Y", "N"]:
+            answer_request(command.strip().upper())
+            continue
 
         # Check if the command is valid
-        while not validate_command(command):
+        if not validate_command(command):
             print("Command not recognized, please try again. CANCEL to exit this request")
-            command = input("Enter command: ")
+            print("Commands: " + ", ".join(name for name in COMMANDS if name.strip()))
+            continue
 
         if (command.split()[0].split('\n')[0]).upper() == COMMANDS[3]:
             # if you want to TERMINATE
-            clientSocket.send(serialize(0, userID, command.upper()))
+            leaving = True
+            future = server.request(command.upper())
             # DEBUG
             print("TERMINATION REQUEST SENT")
             # DEBUG
-            #clientSocket.close()
+            try:
+                receive_response(*future.result(timeout=REPLY_TIMEOUT))
+            except Exception:
+                pass
             break
         else:
-            if send_commands(command):  # send command to server
-                # Continuously check queue for response
-                message_type, user_id, response = deserialize(clientSocket.recv(2048))
-
-                #print("MESSAGE TYPE: " + message_type)
-
-                receive_response(message_type, user_id, response)
-            else:
-                continue
+            # replies are printed whenever they arrive, so the next command can be typed straight away
+            future = send_commands(command)
+            if future is not None:
+                future.add_done_callback(show_reply)
 	    
-    clientSocket.close()
+    server.close()
+
 
-on_and_connect()
-communicate_with_server()
\ No newline at end of file
+if __name__ == "__main__":
+    on_and_connect()
+    communicate_with_server()
\ No newline at end of file
@@ -8,9 +8,28 @@ Date: 04 March 2024
 # server that accepts multiple clients
 from socket import *
 import sys
+import argparse
+import asyncio
+import json
+import os
+import signal
 import threading
 import time  # may be used to create delays between messages, to reduce network load
 import struct
+from protocol import accept_channel, Channel, open_async_channel, start_async_server, PROTOCOL_ACK, SESSION_PREFIX, RESUME_PREFIX, encode_batch_results, \
+    PayloadCompressor, COMPRESS_ABOVE, FLAG_ACCEPTS_COMPRESSED, FLAG_UPGRADE, DICTIONARY_ID, agreed_flags
+from registry import ClientRegistry, Session, ACTIVE, HANDSHAKING, CHATTING
+from handshakes import PendingRequests
+from metrics import ServerStats, format_snapshot
+from eventlog import EventLog, LEVELS
+from timerwheel import TimerWheel
+from presence import PresenceHub
+from flowcontrol import TokenBucket, parse_rate, HIGH_WATER, LOW_WATER, QUEUE_LIMIT
+from resumption import ParkedSessions, new_token, same_token, save_sessions, load_sessions
+from workers import SharedDirectory, WorkerLinks, RemoteChannel, fork_workers, DIRECTORY_SIZE, LINK_QUEUE_LIMIT
+from federation import FederatedDirectory, PeerLinks, GOSSIP_INTERVAL, PEER_TIMEOUT, PEER_RETRY
+from capture import TrafficCapture
+from rooms import RoomDirectory, deliver, ROOM_PREFIX, ROOM_NAME_LIMIT
 
 visibilityOptions = { #the two options that a person can be
     0: "private",
@@ -20,248 +39,1497 @@ visibilityOptions = { #the two options that a person can be
 Message_type = { # used to decipher what kind of response to give
     0: "COMMAND",  # anything in the command list
     1: "MESSAGE",  # any string
-    2: "REGULAR DATA TRANSFER",  # for requesting re-entry
+    2: "REGULAR DATA TRANSFER",  # for requesting re-entry (see resumption.py)
     3: "REQUEST DENIED",  # denying request
     4: "CONNECTION REQUEST" # the server is notifying this client that another client wants to talk to them
 }
-COMMANDS = ["LIST_CLIENTS", "VISIBILITY", "CONNECT_TO", "TERMINATE",""] #list of commands a client can choose from
+COMMANDS = ["LIST_CLIENTS", "VISIBILITY", "CONNECT_TO", "TERMINATE","", "FIND", "CANCEL_REQUEST", "STATS", "SUBSCRIBE_PRESENCE", "UNSUBSCRIBE_PRESENCE", "BATCH",
+            "CREATE_ROOM", "JOIN_ROOM", "LEAVE_ROOM", "ROOM_SEND"] #list of commands a client can choose from
+FIND_LIMIT = 20  # results returned by FIND when the client does not say how many it wants
+FIND_MAX_LIMIT = 100
+BATCH_LIMIT = 50  # most commands one BATCH can carry
 
 serverID = "Server" # The server''s "user_ID"
-connected_clients = []  # where all the clients will be listed
-user_IDs = []
+registry = ClientRegistry()  # where all the clients will be listed
 threads = []
-lock = threading.Lock()
+listing_cache = (-1, (), "")  # (version, numbered lines, whole text) of the last public list that was rendered
+LIST_HEADER = "-------LIST OF AVAILABLE CLIENTS-------\n"
+pending_requests = PendingRequests(timeout=30)  # connection requests waiting for a Y or N
+stats = ServerStats()  # what the STATS command and the snapshot file report
+log = EventLog()  # written out by a background thread, so logging never waits for the console or the disk
+heartbeats = TimerWheel(tick=0.5, now=time.monotonic())  # session -> when to next check that it is alive
+presence = PresenceHub(registry)  # clients that are pushed changes to the public list
+parked = ParkedSessions(grace=60)  # sessions of clients that lost their connection and may resume
+rooms = RoomDirectory()  # group chat rooms, and who is in them
+public_list = registry  # what LIST_CLIENTS, FIND and presence read: the registry, or the directory when there is one
+# the workers.SharedDirectory of every worker's clients when there are several workers, or the
+# federation.FederatedDirectory of every node's clients when there are other nodes
+directory = None
+links = None  # the workers.WorkerLinks to the other workers, or the federation.PeerLinks to the other nodes
+peerSocket = None  # where the other nodes connect to this one
+compressor = None  # the protocol.PayloadCompressor every client that can take compressed replies shares
+capture = None  # the capture.TrafficCapture recording what clients send, with --capture-file
+worker_index = 0
+remote_sessions = {}  # user_ID -> stand-in Session of a client on another worker whose command is being carried out
+forwarded = {}  # user_ID of a client of this worker -> the workers their commands have been handed to
+registry.lock = stats.timed_lock("registry", registry.lock)
+pending_requests.lock = stats.timed_lock("pending_requests", pending_requests.lock)
 
 
-def serialize(message_type, user_id, message):
+def server_on():
+    """
+    Switches the server on.
+    :rtype: None
+    
+    """       
+    global serverSocket, peerSocket, options, compressor, capture
+    parser = argparse.ArgumentParser(usage="python Server.py <host> <port> [--asyncio]")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve every client from one asyncio event loop instead of one thread per client")
+    parser.add_argument("--request-timeout", type=float, default=pending_requests.timeout,
+                        help="seconds a connection request waits for an answer before it expires")
+    parser.add_argument("--stats-file", help="write a JSON snapshot of the server's stats to this file periodically")
+    parser.add_argument("--stats-interval", type=float, default=10, help="seconds between stats snapshots")
+    parser.add_argument("--heartbeat-interval", type=float, default=15,
+                        help="seconds a client may be quiet before it is sent a PING (0 for no heartbeats)")
+    parser.add_argument("--heartbeat-timeout", type=float, default=10,
+                        help="seconds a client has to answer a PING before it is evicted")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="seconds a client may go without sending a command before it is evicted (0 for never)")
+    parser.add_argument("--presence-window", type=float, default=presence.window,
+                        help="seconds changes to the public list are gathered for before subscribers are sent them")
+    parser.add_argument("--max-sessions", type=int, default=0,
+                        help="clients connected at once before new ones are turned away (0 for no limit)")
+    parser.add_argument("--rate-limit", type=parse_rate, metavar="RATE[:BURST]",
+                        help="messages a second a client may send; faster clients are read more slowly")
+    parser.add_argument("--command-limit", action="append", default=[], metavar="COMMAND=RATE[:BURST]",
+                        help="times a second a client may send one command; more are refused (may be repeated)")
+    parser.add_argument("--high-water", type=int, default=HIGH_WATER,
+                        help="bytes waiting to be sent to a client before its commands stop being read")
+    parser.add_argument("--low-water", type=int, default=LOW_WATER,
+                        help="bytes waiting to be sent to a client before its commands are read again")
+    parser.add_argument("--queue-limit", type=int, default=QUEUE_LIMIT,
+                        help="bytes waiting to be sent to a client before it is disconnected as too slow")
+    parser.add_argument("--compress-above", type=int, default=COMPRESS_ABOVE,
+                        help="bytes a reply must be over to be compressed, for clients that can take it (0 for never)")
+    parser.add_argument("--resume-grace", type=float, default=parked.grace,
+                        help="seconds a client that lost its connection has to resume its session (0 for never)")
+    parser.add_argument("--session-file",
+                        help="save sessions to this file periodically, and let them resume after the server restarts")
+    parser.add_argument("--session-interval", type=float, default=5, help="seconds between saving sessions")
+    parser.add_argument("--capture-file", help="append everything clients send to this file, for replay.py")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port, each serving its own clients (Unix only)")
+    parser.add_argument("--directory-size", type=int, default=DIRECTORY_SIZE,
+                        help="clients the directory the workers share has room for")
+    parser.add_argument("--node", help="this server's name among the nodes it shares clients with (default host:port)")
+    parser.add_argument("--peer-port", type=int, help="port the other nodes connect to this one on")
+    parser.add_argument("--peers", type=parse_peers, default=[], metavar="HOST:PORT,...",
+                        help="the peer ports of the other nodes, whose clients this node's clients can speak to")
+    parser.add_argument("--gossip-interval", type=float, default=GOSSIP_INTERVAL,
+                        help="seconds between exchanges of the client directory with another node")
+    parser.add_argument("--peer-timeout", type=float, default=PEER_TIMEOUT,
+                        help="seconds without news of a node before its clients are taken off the list")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="INFO")
+    parser.add_argument("--log-file", help="also write the log to this file, rotating it when it gets big")
+    parser.add_argument("--quiet", action="store_true", help="do not write the log to the console")
+    options = parser.parse_args()
+    try:
+        options.command_limits = {name.upper(): parse_rate(rate) for name, rate in
+                                  (limit.split("=", 1) for limit in options.command_limit)}
+    except ValueError:
+        parser.error("--command-limit takes COMMAND=RATE[:BURST]")
+    # SO_REUSEPORT comes in with "from socket import *" where the platform has it
+    if options.workers > 1 and not (hasattr(os, "fork") and "SO_REUSEPORT" in globals()):
+        parser.error("--workers needs fork() and SO_REUSEPORT")
+    if options.node is None:
+        options.node = options.host + ":" + str(options.port)
+    if "@" in options.node or " " in options.node:
+        parser.error("--node cannot contain '@' or spaces")
+    if options.peers and options.peer_port is None:
+        parser.error("--peers needs --peer-port, for the other nodes to connect to this one")
+    if options.peer_port is not None and options.workers > 1:
+        parser.error("--peer-port cannot be used with --workers")
+    pending_requests.timeout = options.request_timeout
+    if options.compress_above > 0:
+        compressor = PayloadCompressor(options.compress_above)
+    parked.grace = options.resume_grace
+    presence.window = options.presence_window
+    log.level = LEVELS[options.log_level]
+    log.path = options.log_file
+    if options.quiet:
+        log.console = None
+    if options.workers > 1:
+        start_workers(options.workers, options.directory_size)
+    if options.peer_port is not None:
+        start_federation(options.node, options.peer_timeout)
+    log.start()
+    if options.capture_file:
+        capture = TrafficCapture(options.capture_file)
+        capture.start()
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> writes out the recent events kept in memory
+        signal.signal(signal.SIGUSR1, lambda signum, frame: log.dump())
+
+    host, port = options.host, options.port
+    serverSocket = socket(AF_INET, SOCK_STREAM)
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)  # so a restarted server can listen while old connections linger
+    if options.workers > 1:
+        # every worker listens on the port, and the kernel shares new connections out between them
+        serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    serverSocket.bind((host, port))  # ready to hear from whoever
+    serverSocket.listen()
+    log.info("listening", host=host, port=port, engine="asyncio" if options.asyncio else "threads",
+             worker=worker_index, pid=os.getpid())
+    if options.peer_port is not None:
+        peerSocket = socket(AF_INET, SOCK_STREAM)
+        peerSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        peerSocket.bind((host, options.peer_port))
+        peerSocket.listen()
+        log.info("federating", node=options.node, peer_port=options.peer_port,
+                 peers=",".join(format_address(peer) for peer in options.peers))
+    if options.session_file:
+        restore_sessions(options.session_file)
+
+
+def start_workers(count, size):
+    """
+    Forks the worker processes, and returns in each of them set up to share the directory of clients with the others.
+    The process that forked them only waits on them.
+    :param count: how many workers
+    :type count: int
+    :param size: how many clients the directory has room for
+    :type size: int
+    :rtype: None
+    """
+    global directory, links, worker_index, public_list
+    directory = SharedDirectory(size)
+    links = WorkerLinks(count)
+    worker_index = fork_workers(count, links)
+    links.become(worker_index)
+    directory.worker = worker_index
+    registry.use_directory(directory)
+    public_list = presence.registry = directory
+    # each worker saves its own sessions and stats
+    if options.session_file:
+        options.session_file += "." + str(worker_index)
+    if options.stats_file:
+        options.stats_file += "." + str(worker_index)
+    if options.capture_file:
+        options.capture_file += "." + str(worker_index)
+
+
+def parse_peers(text):
+    """
+    Parses the --peers option.
+    :param text: HOST:PORT,HOST:PORT,...
+    :type text: str
+    :rtype: list[tuple[str,int]]
+    """
+    peers = []
+    for peer in text.split(","):
+        host, _, port = peer.strip().rpartition(":")
+        if not host or not port.isdigit():
+            raise argparse.ArgumentTypeError("peers are given as HOST:PORT,HOST:PORT,...")
+        peers.append((host, int(port)))
+    return peers
+
+
+def start_federation(node, timeout):
+    """
+    Sets the server up to share its clients with other nodes, and to see theirs.
+    :param node: this node's name
+    :type node: str
+    :param timeout: seconds without news of a node before its clients are taken off the list
+    :type timeout: float
+    :rtype: None
+    """
+    global directory, links, public_list
+    directory = FederatedDirectory(node, timeout)
+    links = PeerLinks(directory)
+    registry.use_directory(directory)
+    public_list = presence.registry = directory
+
+
+def accepting_connections():
+    """
+    Accepts client connections.
+    :rtype: None
+    
+    """       
+    threads = []  # List to store threads
+
+    # listen for new connections
+    while True:
+        client_socket, addr = serverSocket.accept()
+        client_socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)  # the only check legacy clients get, as they ignore PINGs
+        # replies go out as soon as they are written, not held back until the client acknowledges the one before
+        client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        try:
+            # binary clients get an acknowledgement, legacy text clients carry on as before
+            connection = accept_channel(client_socket)
+            message_type, user_id, hello = connection.recv()
+            if server_full():
+                refuse_client(connection, addr)
+                continue
+            acknowledge_binary(connection)
+        except Exception:
+            log.warning("bad_hello", address=addr)
+            client_socket.close()
+            continue
+        if hand_over_client(client_socket, addr, message_type, user_id, hello, connection.flags):
+            client_socket.close()
+            continue
+
+        new_userID = register_client(connection, addr, message_type, user_id, hello)
+
+        # Start thread to handle client and store it in the list
+        thread = threading.Thread(target=handle_client_commands, args=(connection, addr, new_userID))
+        thread.start()
+        threads.append(thread)
+
+    # make sure all threads to finish
+    for thread in threads:
+        thread.join()
+
+
+def server_full():
+    """
+    :rtype: bool (True if no more clients are being let in)
+    """
+    if options.workers > 1:
+        # the limit is on the clients of every worker together
+        return directory.full() or bool(options.max_sessions) and len(directory) >= options.max_sessions
+    return bool(options.max_sessions) and len(registry) >= options.max_sessions
+
+
+def refuse_client(connection, addr):
+    """
+    Turns away a client that has just said hello, telling them why.
+    :param connection: The client's channel
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :rtype: None
+    """
+    log.warning("client_refused", address=addr, sessions=len(registry))
+    stats.count("refused full")
+    try:
+        connection.send(3, serverID, "The server is full. Please try again later.")
+    except OSError:
+        pass
+    connection.close()
+
+
+def acknowledge_binary(connection):
+    """
+    Acknowledges the hello of a client that sent it as a binary frame, or in text asking for binary frames, after which
+    everything is sent to them as frames. Legacy text clients get nothing, as they always have.
+    :param connection: The client's channel, which has just received their hello
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :rtype: None
+    """
+    if connection.binary or connection.flags & FLAG_UPGRADE:
+        if not connection.flags & FLAG_UPGRADE:
+            # a binary hello carries the client's dictionary ID as its request ID; upgrade_flags() checked a text one's
+            connection.flags = agreed_flags(connection.flags, connection.reply_to)
+        connection.binary = True
+        connection.send(2, serverID, PROTOCOL_ACK, DICTIONARY_ID if compressor is not None else 0, flags=ack_flags())
+
+
+def ack_flags():
+    """
+    :rtype: int (the flags of the acknowledgement of a binary hello: FLAG_ACCEPTS_COMPRESSED if compression is on, which
+            tells the client it may compress what it sends too)
+    """
+    return FLAG_ACCEPTS_COMPRESSED if compressor is not None else 0
+
+
+def hand_over_client(sock, addr, message_type, user_id, hello, flags):
+    """
+    Hands a client resuming a session that another worker kept for them over to that worker, connection and all.
+    :param sock: The client's socket, which the caller closes if the client was handed over
+    :type sock: socket.socket
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param message_type: the type of the hello, 2 for a client resuming their session
+    :type message_type: int
+    :param user_id: the userID the client asked for
+    :type user_id: str
+    :param hello: "1" for public, "0" for private, or "RESUME <token> <visibility>"
+    :type hello: str
+    :param flags: the flags of the hello
+    :type flags: int
+    :rtype: bool (True if the client was handed over)
+    """
+    if options.workers == 1 or message_type != 2 or not hello.startswith(RESUME_PREFIX):
+        return False
+    entry = directory.lookup(user_id)
+    if entry is None or entry.worker == worker_index:
+        return False
+    try:
+        links.hand_over(entry.worker, sock, {"user_id": user_id, "hello": hello, "address": addr, "flags": flags})
+    except OSError as error:
+        log.warning("hand_over_failed", user_id=user_id, worker=entry.worker, error=repr(error))
+        return False
+    stats.count("handed over")
+    log.info("client_handed_over", user_id=user_id, worker=entry.worker)
+    return True
+
+
+def take_over_client(sock, details):
+    """
+    Takes on a client another worker handed over, and handles their commands on a thread of their own, for the threaded
+    engine.
+    :param sock: The client's socket
+    :type sock: socket.socket
+    :param details: the client's hello and address
+    :type details: dict
+    :rtype: None
+    """
+    connection = Channel(sock)  # only binary clients can resume
+    connection.flags = details["flags"]
+    addr = tuple(details["address"])
+    user_id = register_client(connection, addr, 2, details["user_id"], details["hello"])
+    threading.Thread(target=handle_client_commands, args=(connection, addr, user_id)).start()
+
+
+def take_over_clients_forever():
+    """
+    Takes on the clients other workers hand over, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        take_over_client(*links.take_over())
+
+
+async def async_take_over_client(sock, details):
+    """
+    The asyncio engine's version of take_over_client(), run as one coroutine per client.
+    :rtype: None
+    """
+    connection = await open_async_channel(sock=sock)  # only binary clients can resume, and their hello has been read
+    connection.flags = details["flags"]
+    addr = tuple(details["address"])
+    user_id = register_client(connection, addr, 2, details["user_id"], details["hello"])
+    async_serve_client(connection, addr, user_id)
+
+
+async def async_take_over_clients_forever():
+    """
+    Takes on the clients other workers hand over, for the asyncio engine. Waiting for them is done off the event loop.
+    :rtype: None
+    """
+    clients = set()  # kept so the tasks are not garbage collected
+    while True:
+        sock, details = await asyncio.to_thread(links.take_over)
+        client = asyncio.create_task(async_take_over_client(sock, details))
+        clients.add(client)
+        client.add_done_callback(clients.discard)
+
+
+def register_client(connection, addr, message_type, user_id, hello):
+    """
+    Adds a client that has just said hello to the list of connected clients, or gives a client that is resuming their
+    session back.
+    :param connection: The client's channel
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param message_type: the type of the hello, 2 for a client resuming their session
+    :type message_type: int
+    :param user_id: the userID the client asked for
+    :type user_id: str
+    :param hello: "1" for public, "0" for private, or "RESUME <token> <visibility>"
+    :type hello: str
+    :rtype: str (the userID the client was given)
+    """
+    connection.queue_outbound(options.high_water, options.low_water, options.queue_limit)
+    if compressor is not None and connection.binary and connection.flags & FLAG_ACCEPTS_COMPRESSED:
+        connection.compressor = compressor
+    if capture is not None:
+        capture.hello(connection, message_type, user_id, hello)
+    session = None
+    visibility = hello
+    if message_type == 2 and hello.startswith(RESUME_PREFIX):
+        words = hello.split()
+        visibility = words[2] if len(words) > 2 else "0"
+        if len(words) > 1:
+            session = resume_session(connection, addr, user_id, words[1])
+    resumed = session is not None
+    if not resumed:
+        # Take care of duplicate usernames
+        session = registry.join(user_id, connection, addr, visibility)
+    new_userID = session.user_id
+    if options.rate_limit:
+        session.bucket = TokenBucket(*options.rate_limit)
+    if options.command_limits:
+        session.command_buckets = {name: TokenBucket(*rate) for name, rate in options.command_limits.items()}
+    stats.connection_opened()
+    next_check = next_heartbeat_check(session, time.monotonic())
+    if next_check is not None:
+        heartbeats.schedule(session, next_check)
+
+    if connection.binary:
+        # a fresh token every time, so an old one is no use to anyone who saw it
+        session.token = new_token()
+        connection.send(2, serverID, SESSION_PREFIX + new_userID + " " + session.token
+                        + (" resumed" if resumed else " new"))
+    if resumed:
+        log.info("client_resumed", user_id=new_userID, address=addr, visibility=session.visibility)
+        # they may have missed being asked, so they are asked again
+        for requestor_id in pending_requests.requestors_of(new_userID):
+            connection.send(4, serverID, requestor_id + " wants to speak to you. Type 'Y' to accept, and 'N' to deny.")
+        if pending_requests.involves(new_userID):
+            session.state = HANDSHAKING
+    else:
+        log.info("client_joined", user_id=new_userID, address=addr, visibility=visibility)
+    return new_userID
+
+
+def resume_session(connection, addr, user_id, token):
+    """
+    Gives a client back the session they left behind when their connection dropped.
+    :param connection: The client's new channel
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param user_id: the userID the client was given
+    :type user_id: str
+    :param token: the resumption token the client was given
+    :type token: str
+    :rtype: registry.Session or None if there is no session for that userID and token
+    """
+    session = registry.get(user_id)
+    if session is not None and session.token is not None and same_token(session.token, token):
+        # the client noticed its connection was gone before the server did
+        evict_client(session, "replaced")
+    parked_session = parked.claim(user_id, token)
+    if parked_session is None:
+        stats.count("resume failed")
+        return None
+    return registry.claim(user_id, connection, addr, parked_session.visibility)
+
+
+def park_client(session):
+    """
+    Keeps the session of a client whose connection dropped, so they can resume it.
+    :param session: the client's session, already off the list of connected clients
+    :type session: registry.Session
+    :rtype: None
+    """
+    parked.park(session.user_id, session.visibility, session.token)
+    log.info("client_parked", user_id=session.user_id, grace=parked.grace)
+
+
+def expire_parked_sessions():
+    """
+    Gives up on parked sessions whose clients did not come back in time, and tells anyone waiting on them.
+    :rtype: None
+    """
+    for parked_session in parked.expire():
+        registry.unreserve(parked_session.user_id)
+        drop_requests(parked_session.user_id)
+        rooms.leave_all(parked_session.user_id)
+        log.info("parked_session_expired", user_id=parked_session.user_id)
+
+
+def restore_sessions(path):
+    """
+    Parks every session saved before the server last stopped, so their clients can resume.
+    :param path: where the sessions were saved
+    :type path: str
+    :rtype: None
+    """
+    restored = 0
+    for saved in load_sessions(path):
+        if parked.grace and registry.reserve(saved["user_id"]):
+            parked.park(saved["user_id"], saved["visibility"], saved["token"])
+            restored += 1
+    log.info("sessions_restored", sessions=restored, path=path)
+
+
+def write_sessions(path):
+    """
+    Saves every session that could be resumed, connected or parked.
+    :param path: where to save them
+    :type path: str
+    :rtype: None
+    """
+    save_sessions(path, [session for session in registry.sessions() if session.token] + parked.sessions())
+
+
+def write_sessions_forever(path, interval):
+    """
+    Saves the sessions every interval seconds, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        time.sleep(interval)
+        write_sessions(path)
+
+
+async def async_write_sessions_forever(path, interval):
+    """
+    Saves the sessions every interval seconds, for the asyncio engine. The file is written off the event loop.
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(write_sessions, path)
+
+
+def remove_client(connection, addr, user_id):
+    """
+    Closes a client's connection and takes them off the list of connected clients.
+    :param connection: The client's channel
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param user_id: The client userID
+    :type user_id: str
+    :rtype: None
+    """
+    connection.close()
+    if capture is not None:
+        capture.close(connection)
+    forget_client(connection, user_id, park=True)
+    stats.connection_closed(connection)
+    if connection.overflowed:
+        stats.count("evicted slow")
+        log.warning("slow_consumer", user_id=user_id, address=addr)
+    log.info("client_left", user_id=user_id, address=addr)
+
+
+def forget_client(connection, user_id, park=False):
+    """
+    Takes a client off the list of connected clients and drops the connection requests they were part of. Does nothing
+    if they are already gone, or if someone new has since joined with the same userID.
+    :param connection: The client's channel
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param user_id: The client userID
+    :type user_id: str
+    :param park: keep their session and requests for a while, as they did not mean to leave and may resume
+    :type park: bool
+    :rtype: None
+    """
+    with registry.lock:
+        session = registry.get(user_id)
+        if session is None or session.connection is not connection:
+            return
+        park = park and bool(parked.grace) and session.token is not None
+        registry.leave(user_id, reserve=park)
+    presence.unsubscribe(session)
+    if park:
+        park_client(session)
+    else:
+        drop_requests(user_id)
+        rooms.leave_all(user_id)
+
+
+def drop_requests(user_id, everywhere=True):
+    """
+    Drops the connection requests a client that has gone was part of, telling whoever is on the other end.
+    :param user_id: The client userID
+    :type user_id: str
+    :param everywhere: have the other workers that may hold their requests drop them too
+    :type everywhere: bool
+    :rtype: None
+    """
+    for request in pending_requests.drop_user(user_id):
+        if request.requestor_id == user_id:
+            settle_states(request.requested_id)
+            notify(request.requested_id, 2, user_id + " no longer wants to speak to you.")
+        else:
+            settle_states(request.requestor_id)
+            notify(request.requestor_id, 3, "USER:" + user_id + " has left.", request.request_id)
+    if everywhere:
+        tell_workers(user_id, {"op": "left", "user_id": user_id})
+
+
+def public_listing():
+    """
+    Renders the list of public clients, reusing the last rendering until someone joins, leaves or changes visibility.
+    :rtype: tuple[int,tuple[str],str] (version, numbered lines, whole text)
+    """
+    global listing_cache
+    listing = listing_cache
+    version, public = public_list.public_snapshot()
+    if listing[0] != version:
+        lines = tuple([str(count) + ". " + user_id + "\n" for count, user_id in enumerate(public, 1)])
+        listing = listing_cache = (version, lines, LIST_HEADER + "".join(lines))
+    return listing
+
+
+def list_connections(offset=None, limit=None):
+    """
+    Lists public clients, either all of them or one page of them.
+    :param offset: how many public clients to skip
+    :type offset: int
+    :param limit: how many public clients to list at most
+    :type limit: int
+    :rtype: str
+    
+    """       
+    # clients that have stopped answering heartbeats are evicted, so the list does not need checking here
+    version, lines, list_str = public_listing()
+    if offset is None:
+        return list_str
+    page = lines[offset:offset + limit]
+    # the version lets a client paging through the list notice that it changed between pages
+    if not page:  # paged past the end, perhaps because clients left since the last page
+        return "-------NO CLIENTS AT OFFSET " + str(offset) + " (of " + str(len(lines)) + ", version " + str(version) \
+            + ")-------\n"
+    header = "-------LIST OF AVAILABLE CLIENTS " + str(offset + 1) + "-" + str(offset + len(page)) + " of " + str(len(lines)) \
+        + " (version " + str(version) + ")-------\n"
+    return header + "".join(page)
+
+
+
+def change_client_visibility(user_id, new_visibility):  # it has to be the number 1 or 0
+    """
+    Changes client visibility.
+    :param userID: the userID of the client whose visibility is going to change
+    :type userID: str
+    :param new_visibility: the visibility to change the current visibility to
+    :type new_visibility: int
+    :rtype: None
+    
+    """       
+    registry.set_visibility(user_id, str(new_visibility))
+    log.debug("visibility_changed", user_id=user_id, visibility=visibilityOptions[new_visibility])
+
+
+def connect_clients(requestor_id, requested_id, connection):
+    """
+    Coordinates communication between two clients that may potentially communicate with each other.
+    The request is passed on and written down in pending_requests; the answer arrives later through the requested
+    client's own handler (see answer_connection_request()), so nobody waits here for a person to type Y or N.
+    :param requestor_id: the userID of the client requesting to speak to someone
+    :type requestor_id: str
+    :param requested_id: the userID of the client being requested for a chat
+    :type requested_id: str
+    :param connection: The requestor's socket
+    :type connection: socket.socket
+    :rtype: None
+    
+    """           
+    worker = owning_worker(requested_id)
+    if worker is not None and requestor_id in registry:
+        # the requested client, and so every request to them, is on another worker, which takes it from here
+        forward_command(worker, requestor_id, "CONNECT_TO " + requested_id, connection)
+        return
+    requestor_socket, requestor_address, requestor_session = get_user_info(requestor_id)
+    requested_socket, requested_address, requested_session = get_user_info(requested_id)
+
+    try:
+        if requested_session is None or requested_id == requestor_id or requested_session.state == CHATTING:
+            connection.reply(3, serverID, "USER:" + requested_id + " is not available.\nPlease view the list of other available clients:\n" + list_connections())
+            return
+        if pending_requests.add(requestor_id, requested_id, connection.reply_to) is None:
+            connection.reply(3, serverID, "You have already asked " + requested_id + " to chat. Please wait for their answer.")
+            return
+        if registry.get(requested_id) is not requested_session:
+            # they left while the request was being written down, after their requests were dropped
+            pending_requests.cancel(requestor_id, requested_id)
+            connection.reply(3, serverID, "USER:" + requested_id + " has left.")
+            return
+        requestor_session.state = requested_session.state = HANDSHAKING
+        message = requestor_id + " wants to speak to you. Type 'Y' to accept, and 'N' to deny."
+        requested_socket.send(4, serverID, message)
+    except Exception as error:
+        log.error("connect_failed", requestor=requestor_id, requested=requested_id, error=repr(error))
+
+
+def answer_connection_request(requested_id, response):
+    """
+    Passes a client's Y/N answer on to whoever asked to speak to them.
+    :param requested_id: the userID of the client answering
+    :type requested_id: str
+    :param response: what they answered, 'Y' or 'N', optionally followed by the userID they are answering
+    :type response: str
+    :rtype: None
+    """
+    words = response.split()
+    if not words or words[0].upper() not in ("Y", "N"):
+        notify(requested_id, 3, "Type 'Y' to accept, and 'N' to deny.")
+        return
+    request = pending_requests.answer(requested_id, words[1] if len(words) > 1 else None)
+    if request is None:
+        notify(requested_id, 3, "There is no such request to answer.")
+        return
+    finish_connection(request.requestor_id, requested_id, words[0], request.request_id)
+
+
+def cancel_connection_request(requestor_id, requested_id, connection):
+    """
+    Takes back a connection request that has not been answered yet.
+    :param requestor_id: the userID of the client that made the request
+    :type requestor_id: str
+    :param requested_id: the userID of the client that was asked
+    :type requested_id: str
+    :param connection: The requestor's socket
+    :type connection: socket.socket
+    :rtype: None
+    """
+    request = pending_requests.cancel(requestor_id, requested_id)
+    if request is None:
+        worker = owning_worker(requested_id)
+        if worker is not None and requestor_id in registry:
+            forward_command(worker, requestor_id, "CANCEL_REQUEST " + requested_id, connection)
+        else:
+            connection.reply(3, serverID, "You have not asked " + requested_id + " to chat.")
+        return
+    settle_states(requestor_id, requested_id)
+    # the CONNECT_TO is answered too, so a client waiting on it is not left hanging
+    notify(requestor_id, 3, "Request to " + requested_id + " cancelled", request.request_id)
+    connection.reply(2, serverID, "Request to " + requested_id + " cancelled")
+    notify(requested_id, 2, requestor_id + " no longer wants to speak to you.")
+
+
+def expire_connection_requests():
+    """
+    Tells both sides of every connection request that has gone unanswered for too long that it has expired.
+    :rtype: None
+    """
+    for request in pending_requests.expire():
+        settle_states(request.requestor_id, request.requested_id)
+        log.info("request_expired", requestor=request.requestor_id, requested=request.requested_id)
+        notify(request.requestor_id, 3, "USER:" + request.requested_id + " did not answer in time.", request.request_id)
+        notify(request.requested_id, 2, "The request from " + request.requestor_id + " has expired.")
+
+
+def expire_connection_requests_forever():
+    """
+    Expires unanswered connection requests once a second, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        time.sleep(1)
+        expire_connection_requests()
+        expire_parked_sessions()
+
+
+async def async_expire_connection_requests_forever():
+    """
+    Expires unanswered connection requests once a second, for the asyncio engine.
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(1)
+        expire_connection_requests()
+        expire_parked_sessions()
+
+
+def next_heartbeat_check(session, now):
+    """
+    Works out when a session next needs looking at, sending it a PING if it has been quiet for too long.
+    :param session: a connected client's session
+    :type session: registry.Session
+    :param now: the current time.monotonic()
+    :type now: float
+    :rtype: float or None if the session never needs checking
+    """
+    checks = []
+    if options.idle_timeout:
+        checks.append(session.last_command + options.idle_timeout)
+    # only binary clients know to answer a PING; legacy clients are left to TCP
+    if options.heartbeat_interval and session.connection.binary:
+        if session.pinged_at and session.last_seen < session.pinged_at:
+            checks.append(session.pinged_at + options.heartbeat_timeout)
+        elif now - session.last_seen >= options.heartbeat_interval:
+            session.pinged_at = now
+            session.connection.send(2, serverID, "PING")
+            checks.append(now + options.heartbeat_timeout)
+        else:
+            session.pinged_at = 0.0
+            checks.append(session.last_seen + options.heartbeat_interval)
+    return min(checks) if checks else None
+
+
+def check_heartbeats(now=None):
+    """
+    Looks at every session whose timer has gone off, and evicts those that are dead or have been idle for too long.
+    :param now: the current time.monotonic()
+    :type now: float
+    :rtype: None
+    """
+    if now is None:
+        now = time.monotonic()
+    for session in heartbeats.advance(now):
+        if registry.get(session.user_id) is not session:
+            continue  # already gone
+        if options.idle_timeout and now - session.last_command >= options.idle_timeout:
+            evict_client(session, "idle")
+        elif session.pinged_at and session.last_seen < session.pinged_at \
+                and now - session.pinged_at >= options.heartbeat_timeout:
+            evict_client(session, "dead")
+        else:
+            try:
+                next_check = next_heartbeat_check(session, now)
+            except OSError:
+                evict_client(session, "dead")
+                continue
+            if next_check is not None:
+                heartbeats.schedule(session, next_check)
+
+
+def evict_client(session, reason):
+    """
+    Takes a client off the list straight away and closes their connection, which ends their handler.
+    :param session: the client's session
+    :type session: registry.Session
+    :param reason: "idle", "dead", or "replaced" when the client has resumed on a new connection
+    :type reason: str
+    :rtype: None
+    """
+    log.info("client_evicted", user_id=session.user_id, address=session.address, reason=reason)
+    stats.count("evicted " + reason)
+    # a client that went quiet on purpose does not need its session kept
+    forget_client(session.connection, session.user_id, park=reason != "idle")
+    session.connection.close()
+
+
+def is_heartbeat(session, message_type, message):
+    """
+    Notes that a client is alive, and whether what they sent was only the answer to a PING.
+    :param session: the client's session
+    :type session: registry.Session
+    :param message_type: The message type received from the client
+    :type message_type: int
+    :param message: The message itself
+    :type message: str
+    :rtype: bool (True if there is nothing more to do with the message)
+    """
+    session.last_seen = time.monotonic()
+    if message_type == 2 and message == "PONG":
+        return True
+    session.last_command = session.last_seen
+    return False
+
+
+def rate_limit_delay(session):
+    """
+    Charges a message to the client's rate limit.
+    :param session: the client's session
+    :type session: registry.Session
+    :rtype: float (0 if the message can be handled now, otherwise seconds to wait before asking again)
+    """
+    if session.bucket is None:
+        return 0.0
+    return session.bucket.take()
+
+
+def command_limited(user_id, name):
+    """
+    Charges a command to the client's limit for that command.
+    :param user_id: The client userID
+    :type user_id: str
+    :param name: the command keyword
+    :type name: str
+    :rtype: bool (True if the command is over its limit and should be refused)
+    """
+    session = registry.get(user_id)
+    if session is None or not session.command_buckets:
+        return False
+    bucket = session.command_buckets.get(name)
+    return bucket is not None and bucket.take() > 0
+
+
+def heartbeats_forever():
+    """
+    Checks heartbeats every tick of the timer wheel, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        time.sleep(heartbeats.tick)
+        check_heartbeats()
+
+
+async def async_heartbeats_forever():
+    """
+    Checks heartbeats every tick of the timer wheel, for the asyncio engine.
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(heartbeats.tick)
+        check_heartbeats()
+
+
+def publish_presence():
+    """
+    Sends every presence subscriber that is behind what has changed in the public list.
+    :rtype: None
+    """
+    for session, message in presence.publish():
+        try:
+            session.connection.send(2, serverID, message)
+        except OSError:
+            pass  # they are on their way out, and forget_client() will unsubscribe them
+
+
+def publish_presence_forever():
+    """
+    Publishes presence changes once per window, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        time.sleep(presence.window)
+        publish_presence()
+
+
+async def async_publish_presence_forever():
+    """
+    Publishes presence changes once per window, for the asyncio engine.
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(presence.window)
+        publish_presence()
+
+
+def SUBSCRIBE_PRESENCE(connection, user_id, arguments):
+    """
+    Subscribes a client to changes in the public list. "SUBSCRIBE_PRESENCE <version>" catches up a client that already
+    has that version of the list.
+    :param connection: The client socket
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param user_id: The client userID
+    :type user_id: str
+    :param arguments: the words after SUBSCRIBE_PRESENCE in the command
+    :type arguments: list[str]
+    :rtype: None
+    """
+    try:
+        version = int(arguments[0]) if arguments else None
+    except ValueError:
+        connection.reply(3, serverID, "Usage: SUBSCRIBE_PRESENCE [version]")
+        return
+    session = registry.get(user_id)
+    if session is not None:
+        connection.reply(2, serverID, presence.subscribe(session, version))
+
+
+def stats_snapshot():
+    """
+    Gathers the server's stats along with how many clients are connected and in which state.
+    :rtype: dict
+    """
+    return stats.snapshot(registry.sessions(), len(pending_requests))
+
+
+def write_stats_snapshot(path):
+    """
+    Writes the stats to a file as JSON, replacing the previous snapshot in one step so readers never see half of one.
+    :param path: where to write
+    :type path: str
+    :rtype: None
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(stats_snapshot(), file, indent=2)
+    os.replace(temporary, path)
+
+
+def write_stats_snapshots_forever(path, interval):
+    """
+    Writes a stats snapshot every interval seconds, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        time.sleep(interval)
+        write_stats_snapshot(path)
+
+
+async def async_write_stats_snapshots_forever(path, interval):
+    """
+    Writes a stats snapshot every interval seconds, for the asyncio engine. The file is written off the event loop.
+    :rtype: None
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(write_stats_snapshot, path)
+
+
+def settle_states(*user_ids):
+    """
+    Puts the clients on both ends of a request that is over back to ACTIVE, unless they are still in other handshakes.
+    :param user_ids: The userIDs of the clients
+    :type user_ids: str
+    :rtype: None
+    """
+    for user_id in user_ids:
+        session = registry.get(user_id)
+        if session is not None and session.state == HANDSHAKING and not pending_requests.involves(user_id):
+            session.state = ACTIVE
+
+
+def notify(user_id, message_type, message, request_id=0):
+    """
+    Sends a message to a client if they are still connected.
+    :param user_id: The userID of the client
+    :type user_id: str
+    :param message_type: The type of message needing to be sent
+    :type message_type: int
+    :param message: The actual message needing to be sent
+    :type message: str
+    :param request_id: the client's command this message answers; 0 if it is not an answer
+    :type request_id: int
+    :rtype: None
+    """
+    session = registry.get(user_id)
+    if session is None:
+        session = remote_session(user_id)
+    if session is None:
+        return
+    try:
+        session.connection.send(message_type, serverID, message, request_id)
+    except OSError:
+        log.warning("notify_failed", user_id=user_id)
+
+
+def finish_connection(requestor_id, requested_id, response, request_id=0):
+    """
+    Acts on the requested client's answer to a connection request.
+    :param requestor_id: the userID of the client requesting to speak to someone
+    :type requestor_id: str
+    :param requested_id: the userID of the client being requested for a chat
+    :type requested_id: str
+    :param response: what the requested client answered, 'Y' or 'N'
+    :type response: str
+    :param request_id: the request ID of the requestor's CONNECT_TO
+    :type request_id: int
+    :rtype: None
+    """
+    # get info of requestor client and requested client
+    requestor_socket, requestor_address, requestor_session = get_user_info(requestor_id)
+    requested_socket, requested_address, requested_session = get_user_info(requested_id)
+    if requestor_session is None:
+        # they lost their connection while waiting, and may yet resume; they can ask again
+        settle_states(requested_id)
+        notify(requested_id, 3, "USER:" + requestor_id + " is not connected right now.")
+        return
+    try:
+        if str(response).strip().upper() == "Y":
+            # the requested accepts: both go private, and every other request to or from them is off
+            start_chatting(requestor_id, requested_id)
+            start_chatting(requested_id, requestor_id)
+            # send message that the user wants to speak to them
+            message = requestor_id + "'s address: " + format_address(requestor_address)
+            requested_socket.send(1, serverID, message)
+    
+            message = requested_id + "'s address: " + format_address(requested_address)
+            requestor_socket.send(1, serverID, message, request_id)
+            # stay ready to receive something from the requestor when chat terminates
+            log.info("chat_started", requestor=requestor_id, requested=requested_id,
+                     requestor_address=format_address(requestor_address),
+                     requested_address=format_address(requested_address))
+        else:
+            # if the requested denies, tell requestor "USER:" + requestedID + "does not want to speak to you!"
+            settle_states(requestor_id, requested_id)
+            message = "USER:" + requested_id + " does not want to speak to you!\nPlease view the list of other available clients:\n" + list_connections()
+            requestor_socket.send(3, serverID, message, request_id)
+    except Exception as error:
+        log.error("answer_failed", requestor=requestor_id, requested=requested_id, error=repr(error))
+        return
+    log.debug("request_answered", requestor=requestor_id, requested=requested_id, response=response)
+
+
+def start_chatting(user_id, partner_id, everywhere=True):
+    """
+    Takes a client who is about to chat out of every other connection request, and off the public list.
+    :param user_id: The userID of the client
+    :type user_id: str
+    :param partner_id: The userID of the client they are going to chat with
+    :type partner_id: str
+    :param everywhere: have the other workers that may hold the client's requests do the same
+    :type everywhere: bool
+    :rtype: None
+    """
+    for request in pending_requests.drop_user(user_id):
+        settle_states(request.requestor_id, request.requested_id)
+        if request.requestor_id in (user_id, partner_id):
+            notify(request.requested_id, 2, request.requestor_id + " no longer wants to speak to you.")
+            # their own CONNECT_TO is still waiting for a reply
+            notify(request.requestor_id, 3, "Request to " + request.requested_id + " cancelled: you are now chatting.", request.request_id)
+        else:
+            notify(request.requestor_id, 3, "USER:" + request.requested_id + " is no longer available.", request.request_id)
+    session = registry.get(user_id)
+    if session is not None:
+        registry.set_visibility(user_id, "0")
+        session.state = CHATTING
+    if everywhere:
+        tell_workers(user_id, {"op": "chatting", "user_id": user_id, "partner_id": partner_id})
+
+
+def format_address(address):
+    """
+    Formats an address as host:port.
+    :param address: (host, port)
+    :type address: tuple
+    :rtype: str
+    """
+    return str(address[0]) + ":" + str(address[1])
+
+
+def get_user_info(user_id):
+    """
+    Gets the connection, address and session of client using their userID.
+    :param user_id: The userID of a client
+    :type user_id: str
+    :rtype: tuple[protocol.Channel,tuple,registry.Session] (all None if nobody by that name is connected)
     """
-    Encodes messages so that they are received in a certain order. The order imitates the protocol header.
-    
-    :param message_type: The type of message needing to be sent
-    :type message_type: str
-    :param user_id: The user_ID of sender
+    session = registry.get(user_id)
+    if session is None:
+        session = remote_session(user_id)
+    if session is None:
+        return None, None, None
+    return session.connection, session.address, session
+
+
+def owning_worker(user_id):
+    """
+    :param user_id: The userID of a client
     :type user_id: str
-    :param message: The actual message needing to be sent
-    :type message: str
-    :rtype: bytes
-    
+    :rtype: int or str or None (the worker or node the client is connected to, None if it is this one or they are not
+            connected)
     """
-    byte_message = f"{message_type},{user_id},{message}"
-    # print(byte_message)
-    return byte_message.encode('utf-8')
+    session = remote_session(user_id)
+    return None if session is None else session.connection.worker
 
 
-def deserialize(data):
+def remote_session(user_id):
     """
-    Decodes data and returns the parts of the data in the correct order. 
-    
-    :param data: the data needing to be decoded
-    :type data: bytes 
-    :rtype: tuple of str
-    
-    """    
-    decoded_data = data.decode('utf-8')
-    segments = decoded_data.split(',')
-    message_type = segments[0]
-    user_id = segments[1]
-    message = segments[2]
-    return message_type, user_id, message
+    A stand-in session for a client connected to another worker or node, whose channel passes messages on to it.
+    :param user_id: The userID of the client
+    :type user_id: str
+    :rtype: registry.Session or None if they are not connected to another worker or node
+    """
+    if directory is None or user_id in registry:
+        return None
+    session = remote_sessions.get(user_id)
+    if session is not None:
+        return session  # the one carrying the request ID of the command being carried out for them
+    entry = directory.lookup(user_id)
+    if entry is None or not entry.connected or entry.worker == worker_index:
+        return None
+    return Session(user_id, RemoteChannel(links, entry.worker, user_id), entry.address, entry.visibility)
 
 
-def server_on():
+def forward_command(worker, user_id, command, connection):
     """
-    Switches the server on.
+    Hands a client's command over to another worker or node, to be carried out there as if the client were connected to
+    it. Its reply goes back to the client through this one.
+    :param worker: the other worker's index, or the other node's name
+    :type worker: int or str
+    :param user_id: The userID of the client, who is connected to this worker
+    :type user_id: str
+    :param command: the command
+    :type command: str
+    :param connection: The client's socket
+    :type connection: socket.socket
     :rtype: None
-    
-    """       
-    global serverSocket
-    if len(sys.argv) != 3:
-	    print("Usage: python script.py <host> <port>")
-	    return
+    """
+    forwarded.setdefault(user_id, set()).add(worker)
+    try:
+        links.send(worker, {"op": "command", "user_id": user_id, "command": command,
+                            "request_id": connection.reply_to})
+    except OSError as error:
+        log.error("forward_failed", user_id=user_id, worker=worker, error=repr(error))
+        connection.reply(3, serverID, "The server could not pass that on. Please try again.")
 
-    host, port = sys.argv[1], int(sys.argv[2])
-    serverSocket = socket(AF_INET, SOCK_STREAM)
-    serverSocket.bind((host, port))  # ready to hear from whoever
-    serverSocket.listen()
-    print('Listening from ' + str(host) + " " + str(port))
 
-def username_generator(userID, userIDs):
+def tell_workers(user_id, message):
     """
-    Generates username for each client, to ensure there are no duplicates stored in user_ID[] list.
-    :param userID: the userID initially given by client
-    :type userID: str
-    :param userIDs: the userID list used by the server
-    :type userIDS: list
-    :rtype: str
-    
-    """       
-    # takes care of duplicate user IDs
-    if userID not in userIDs:
-        return userID  # user_ID is unique
-    else:
-        count = 1
-        new_ID = userID + "_" + str(count)
+    Sends news of a client who is done with their connection requests to the other workers or nodes that may hold some
+    of them: the ones the client's commands were handed to, or the client's own, which passes it on to those.
+    :param user_id: The userID of the client
+    :type user_id: str
+    :param message: the news; "op" says what it is
+    :type message: dict
+    :rtype: None
+    """
+    if links is None:
+        return
+    workers = forwarded.pop(user_id, set())
+    owner = owning_worker(user_id)
+    if owner is not None:
+        workers.add(owner)
+    for worker in workers:
+        try:
+            links.send(worker, message)
+        except OSError:
+            pass  # that worker or node is gone, and so are its clients
 
-        while new_ID in userIDs:
-            count += 1
-            new_ID = userID + "_" + str(count)
 
-        return new_ID
+def handle_worker_message(message):
+    """
+    Acts on a message from another worker or node: a message to pass on to one of this one's clients, a command a client
+    of that one sent about one of this one's clients, or news that a client has left or started chatting.
+    :param message: the decoded message; "op" says what it is
+    :type message: dict
+    :rtype: None
+    """
+    op = message["op"]
+    user_id = message["user_id"]
+    if op == "deliver":
+        notify(user_id, message["type"], message["message"], message["request_id"])
+    elif op == "command":
+        session = remote_session(user_id)
+        if session is not None:
+            session.connection.reply_to = message["request_id"]
+            remote_sessions[user_id] = session
+            try:
+                handle_command(message["command"], session.connection, session.address, user_id)
+            finally:
+                del remote_sessions[user_id]
+    elif op == "left":
+        drop_requests(user_id, everywhere=False)
+    elif op == "chatting":
+        # a client of this one started chatting with someone on another one; pass it on to the others that need it
+        start_chatting(user_id, message["partner_id"], everywhere=user_id in registry)
 
 
-def accepting_connections():
+def worker_messages_forever(worker, channel):
     """
-    Accepts client connections.
+    Handles the messages from another worker as they arrive, for the threaded engine.
+    :param worker: the other worker's index
+    :type worker: int
+    :param channel: the link to that worker
+    :type channel: protocol.Channel
     :rtype: None
-    
-    """       
-    threads = []  # List to store threads
+    """
+    while True:
+        try:
+            message_type, sender, message = channel.recv()
+        except OSError:
+            log.error("worker_link_lost", worker=worker)
+            return
+        try:
+            handle_worker_message(json.loads(message))
+        except Exception as error:
+            log.error("worker_message_failed", message=message, error=repr(error))
 
-    # once the server starts again, get rid of all the connections and things
-    if connected_clients:
-        with lock:  # thread safety
-            for x, conn in connected_clients:
-                conn.close()
-            connected_clients.clear()
 
-    # listen for new connections
+async def async_worker_messages_forever(worker, sock):
+    """
+    Handles the messages from another worker as they arrive, for the asyncio engine, which also sends to that worker
+    through the same channel.
+    :param worker: the other worker's index
+    :type worker: int
+    :param sock: this worker's end of the link
+    :type sock: socket.socket
+    :rtype: None
+    """
+    channel = await open_async_channel(sock=sock)
+    channel.queue_outbound(limit=LINK_QUEUE_LIMIT)
+    links.channels[worker] = channel
     while True:
-        connection, addr = serverSocket.accept()
-        message_type, user_id, visibility = deserialize(connection.recv(2048))
+        try:
+            message_type, sender, message = await channel.recv()
+        except OSError:
+            log.error("worker_link_lost", worker=worker)
+            return
+        try:
+            handle_worker_message(json.loads(message))
+        except Exception as error:
+            log.error("worker_message_failed", message=message, error=repr(error))
 
-        with lock:
-            connected_clients.append(((connection, addr), visibility))
 
-        # Take care of duplicate usernames
-        new_userID = username_generator(user_id, user_IDs)
-        user_IDs.append(new_userID)
+def handle_peer_message(node, message):
+    """
+    Acts on a message from another node: gossip about the clients of every node, or anything else another worker
+    could send, with the userIDs in it turned into how this node knows them.
+    :param node: the other node's name
+    :type node: str
+    :param message: the decoded message; "op" says what it is
+    :type message: dict
+    :rtype: None
+    """
+    message = links.receive(node, message)
+    if message is not None:
+        handle_worker_message(message)
 
-        print("\nUser: " + new_userID + " has joined the chatroom!\nAddress: " + str(addr) + "\nVisibility Status:" + visibility+"\n")
 
-        # Start thread to handle client and store it in the list
-        thread = threading.Thread(target=handle_client_commands, args=(connection, addr, new_userID))
-        thread.start()
-        threads.append(thread)
+def gossip_round():
+    """
+    Gives up on nodes not heard from in a while, pushes this node's new changes to every peer, and starts an exchange
+    of the whole directory with one of them.
+    :rtype: None
+    """
+    for node in directory.beat():
+        log.warning("peer_silent", node=node)
+    links.push()
+    links.gossip()
 
-    # make sure all threads to finish
-    for thread in threads:
-        thread.join()
+
+def gossip_forever():
+    """
+    Runs a gossip round every gossip interval, for the threaded engine.
+    :rtype: None
+    """
+    while True:
+        time.sleep(options.gossip_interval)
+        gossip_round()
 
 
-def list_connections():
+async def async_gossip_forever():
     """
-    Lists public clients.
+    Runs a gossip round every gossip interval, for the asyncio engine.
     :rtype: None
-    
-    """       
-    # for listing all connections without checking if they're still connected - this works faster
-    list_str = "-------LIST OF AVAILABLE CLIENTS-------\n"
-    count = 0
-    for i, ((conn, client_addr), visibility) in enumerate(connected_clients):
-        if visibility == "1":
-            count += 1
-            list_str += str(count) + ". " + user_IDs[i] + "\n"
-    return list_str
+    """
+    while True:
+        await asyncio.sleep(options.gossip_interval)
+        gossip_round()
 
 
+def peer_greeting(message_type, node, message):
+    """
+    Checks the first message on a connection between nodes.
+    :rtype: str (the name of the node that sent it)
+    :raises ValueError: if it is not a node saying hello
+    """
+    if message_type != 2 or json.loads(message).get("op") != "hello" or not node or node == directory.node:
+        raise ValueError("not a hello from another node")
+    return node
 
-def change_client_visibility(user_id, new_visibility):  # it has to be the number 1 or 0
+
+def dial_peer_forever(address):
     """
-    Changes client visibility.
-    :param userID: the userID of the client whose visibility is going to change
-    :type userID: str
-    :param new_visibility: the visibility to change the current visibility to
-    :type new_visibility: int
+    Keeps a connection to another node open, connecting again whenever it drops, for the threaded engine. Everything
+    this node sends to that one goes over it.
+    :param address: the other node's peer port (host, port)
+    :type address: tuple
     :rtype: None
-    
-    """       
-    print(user_id + " is changing visibility")
-    for i, (((conn, client_addr), visibility)) in enumerate(connected_clients):
-        if user_IDs[i] == user_id:
-            with lock:
-                connected_clients[i] = ((conn, client_addr), str(new_visibility))
-		# debug
-                print(((conn, client_addr), str(new_visibility)))
-		# debug
-            break
-    print("User: " + user_id + " --> Visibility updated to: " + visibilityOptions[new_visibility])
+    """
+    while True:
+        try:
+            sock = create_connection(address)
+        except OSError:
+            time.sleep(PEER_RETRY)
+            continue
+        channel = Channel(sock)
+        try:
+            channel.send(2, directory.node, json.dumps({"op": "hello"}))
+            node = peer_greeting(*channel.recv())
+        except Exception as error:
+            log.warning("bad_peer_hello", address=format_address(address), error=repr(error))
+        else:
+            channel.queue_outbound(limit=LINK_QUEUE_LIMIT)
+            links.connected(node, channel)
+            log.info("peer_connected", node=node, address=format_address(address))
+            links.gossip(node)  # catch up now rather than at the next round
+            try:
+                while True:
+                    channel.recv()  # nothing else comes this way; this only notices the connection dropping
+            except Exception:
+                pass
+            links.lost(node, channel)
+            log.warning("peer_lost", node=node, address=format_address(address))
+        channel.close()
+        time.sleep(PEER_RETRY)
 
 
-def connect_clients(requestor_id, requested_id):
+def peer_messages_forever(sock, addr):
     """
-    Coordinates communication between two clients that may potentially communicate with each other.
-    :param requestor_id: the userID of the client requesting to speak to someone
-    :type requestor_id: str
-    :param requested_id: the userID of the client being requested for a chat
-    :type requested_id: str
+    Handles the messages another node sends over the connection it made to this one, for the threaded engine.
+    :param sock: the connection
+    :type sock: socket.socket
+    :param addr: where it came from (host, port)
+    :type addr: tuple
     :rtype: None
-    
-    """           
-    # Debug
-    print("REQUEST RECEIVED")
-    # Debug
-    # get info of requestor client and requested client
-    requestor_socket, requestor_address, requestor_index = get_user_info(requestor_id)
-    requested_socket, requested_address, requested_index = get_user_info(requested_id)
-   
-    # put while-loop so the server is constantly listening
+    """
+    channel = Channel(sock)
     try:
-        message = requestor_id + " wants to speak to you. Type 'Y' to accept, and 'N' to deny."
-        requested_socket.sendall(serialize(4, serverID, message))    
-        message_type, user_id, response = deserialize(requested_socket.recv(2048))
-        if str(response).strip() == "Y":
-            # THREAD SAFETY!!! one thread must access connected_clients at a time
-            with lock:
-                connected_clients[requestor_index] = (connected_clients[requestor_index][0], "0")
-                connected_clients[requested_index] = (connected_clients[requested_index][0], "0")
-            # send message that the user wants to speak to them
-            print("SENDING USER INFO TO USERS")
-            
-            message = requestor_id + "'s address: " + requestor_address
-            # Debug
-            print(message)
-            # Debug
-            requested_socket.sendall(serialize(1, serverID, message))
-    
-            message = requested_id + "'s address: " + requested_address
-            # Debug
-            print(message)
-            # Debug
-            requestor_socket.sendall(serialize(1, serverID, message))
-            # stay ready to receive something from the requestor when chat terminates
-            print("SENT USER INFO TO USERS")    
-        elif str(response).strip() == "N":
-            # if the requested denies, tell requestor "USER:" + requestedID + "does not want to speak to you!"
-            message = "USER:" + requested_id + " does not want to speak to you!\nPlease view the list of other available clients:\n" + list_connections()
-            requestor_socket.sendall(serialize(3, serverID, message))	
-    except:
-        print("error in communicating with clients.")
+        node = peer_greeting(*channel.recv())
+        channel.send(2, directory.node, json.dumps({"op": "hello"}))
+    except Exception as error:
+        log.warning("bad_peer_hello", address=format_address(addr), error=repr(error))
+        channel.close()
         return
-    print("RESPONSE FROM REQUESTED IS: " + response)
+    while True:
+        try:
+            message_type, sender, message = channel.recv()
+        except Exception:
+            channel.close()
+            return
+        try:
+            handle_peer_message(node, json.loads(message))
+        except Exception as error:
+            log.error("peer_message_failed", node=node, message=message, error=repr(error))
 
 
-    # If the requested accepts, change both visibilities to 0 (private),
-    # send address info to each, initiate chat
+def peer_connections_forever():
+    """
+    Accepts the connections other nodes make to this one, handling each on a thread of its own.
+    :rtype: None
+    """
+    while True:
+        sock, addr = peerSocket.accept()
+        threading.Thread(target=peer_messages_forever, args=(sock, addr), daemon=True).start()
 
 
-def get_user_info(user_id):
+async def async_dial_peer_forever(address):
     """
-    Gets the index, connection and address of client using their userID.
-    :param user_id: The userID of a client
-    :type user_id: str
-    :rtype: tuple[str,str,int]
+    Keeps a connection to another node open, connecting again whenever it drops, for the asyncio engine.
+    :param address: the other node's peer port (host, port)
+    :type address: tuple
+    :rtype: None
+    """
+    while True:
+        try:
+            channel = await open_async_channel(*address)
+        except OSError:
+            await asyncio.sleep(PEER_RETRY)
+            continue
+        try:
+            channel.send(2, directory.node, json.dumps({"op": "hello"}))
+            node = peer_greeting(*await channel.recv())
+        except Exception as error:
+            log.warning("bad_peer_hello", address=format_address(address), error=repr(error))
+        else:
+            channel.queue_outbound(limit=LINK_QUEUE_LIMIT)
+            links.connected(node, channel)
+            log.info("peer_connected", node=node, address=format_address(address))
+            links.gossip(node)
+            try:
+                while True:
+                    await channel.recv()
+            except Exception:
+                pass
+            links.lost(node, channel)
+            log.warning("peer_lost", node=node, address=format_address(address))
+        channel.close()
+        await asyncio.sleep(PEER_RETRY)
+
+
+async def async_handle_peer(channel):
+    """
+    Handles the messages another node sends over the connection it made to this one, for the asyncio engine.
+    :param channel: the connection's channel
+    :type channel: protocol.AsyncChannel
+    :rtype: None
     """
-    # get user information from user_ID
-    user_index = 0
-    user_socket = ""
-    user_address = ""
-    for i, ((conn, client_addr), visibility) in enumerate(connected_clients):
-        if user_IDs[i] == user_id:
-            user_socket = conn
-            user_address = client_addr
-            user_index = i
-            break
-    return user_socket, user_address, user_index
+    addr = channel.transport.get_extra_info('peername')
+    try:
+        node = peer_greeting(*await channel.recv())
+        channel.send(2, directory.node, json.dumps({"op": "hello"}))
+    except Exception as error:
+        log.warning("bad_peer_hello", address=format_address(addr), error=repr(error))
+        channel.close()
+        return
+    while True:
+        try:
+            message_type, sender, message = await channel.recv()
+        except Exception:
+            channel.close()
+            return
+        try:
+            handle_peer_message(node, json.loads(message))
+        except Exception as error:
+            log.error("peer_message_failed", node=node, message=message, error=repr(error))
 
 
 def handle_client_commands(connection, addr, user_id):
@@ -275,38 +1543,410 @@ def handle_client_commands(connection, addr, user_id):
     :type user_id: str
     :rtype: None
     """
+    session = registry.get(user_id)
     try:
         while True:
+            # a client not reading its replies gets no more of them until it catches up
+            if connection.wait_until_drained():
+                stats.count("reads paused")
             # Receive and process commands from the client
-            message_type, user_id, command = deserialize(connection.recv(2048))
+            # (the sender field is what the client asked to be called, user_id is what it was actually given)
+            message_type, sender, command = connection.recv()
+            if is_heartbeat(session, message_type, command):
+                continue
+            if capture is not None:
+                capture.message(connection, message_type, sender, command)
+            delay = rate_limit_delay(session)
+            if delay:
+                stats.count("rate limited")
+                while delay:
+                    time.sleep(delay)
+                    delay = rate_limit_delay(session)
 	    
-            handle_command(command, connection, addr, user_id)
-    except:
-        print('JHGIGUG')  # will be printed out when the connection is closed
+            dispatch(message_type, command, connection, addr, user_id)
+    except Exception as error:
+        log.debug("connection_lost", user_id=user_id, reason=repr(error))
     finally:
         # The code in the 'finally' block will be executed whether an exception occurs or not
-        user_socket, user_address, user_index = get_user_info(user_id)
-        with lock:
-            connection.close()
-            connected_clients.remove(connected_clients[user_index])
-        print(f"Connection closed for client {addr}")
-        user_IDs.remove(user_id)
+        remove_client(connection, addr, user_id)
         # Assuming threads is a list of threads
         # threads[user_index].join()
 
 
+async def async_handle_client(connection):
+    """
+    The asyncio engine's version of accepting a client, run as a task per client until they have said hello.
+    :param connection: The client's channel, which works out from the first byte whether they speak the binary frames
+    :type connection: protocol.AsyncChannel
+    :rtype: None
+    """
+    addr = connection.transport.get_extra_info('peername')
+    sock = connection.transport.get_extra_info('socket')
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    # asyncio only does this itself for sockets made with IPPROTO_TCP, and the listening socket was not
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    try:
+        message_type, user_id, hello = await connection.recv()
+        if server_full():
+            refuse_client(connection, addr)
+            return
+        acknowledge_binary(connection)
+    except Exception:
+        log.warning("bad_hello", address=addr)
+        connection.close()
+        return
+    if hand_over_client(sock, addr, message_type, user_id, hello, connection.flags):
+        connection.close()
+        return
+
+    user_id = register_client(connection, addr, message_type, user_id, hello)
+    async_serve_client(connection, addr, user_id)
+
+
+def async_serve_client(connection, addr, user_id):
+    """
+    The asyncio engine's version of handle_client_commands(). Rather than a task waiting for each command, the channel
+    calls back with each one as it arrives, so a client with nothing to say costs no more than their channel and session.
+    :param connection: The client's channel
+    :type connection: protocol.AsyncChannel
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param user_id: The client userID
+    :type user_id: str
+    :rtype: None
+    """
+    session = registry.get(user_id)
+
+    def handle(message_type, sender, command):
+        if is_heartbeat(session, message_type, command):
+            return
+        if capture is not None:
+            capture.message(connection, message_type, sender, command)
+        delay = rate_limit_delay(session)
+        if delay:
+            stats.count("rate limited")
+            connection.hold(delay, dispatch_when_allowed, message_type, command)
+        else:
+            dispatch_and_wait(message_type, command)
+
+    def dispatch_when_allowed(message_type, command):
+        delay = rate_limit_delay(session)
+        if delay:
+            connection.hold(delay, dispatch_when_allowed, message_type, command)
+        else:
+            dispatch_and_wait(message_type, command)
+
+    def dispatch_and_wait(message_type, command):
+        dispatch(message_type, command, connection, addr, user_id)
+        # a client not reading its replies gets no more of them until it catches up
+        if connection.wait_until_drained():
+            stats.count("reads paused")
+
+    def closed(error):
+        log.debug("connection_lost", user_id=user_id, reason=repr(error))
+        remove_client(connection, addr, user_id)
+
+    connection.serve(handle, closed)
+
+
+async def async_accepting_connections():
+    """
+    Accepts client connections on an asyncio event loop, handling every client in one thread.
+    :rtype: None
+    """
+    expiry = asyncio.create_task(async_expire_connection_requests_forever())  # kept so the task is not garbage collected
+    beats = asyncio.create_task(async_heartbeats_forever())
+    publisher = asyncio.create_task(async_publish_presence_forever())
+    if options.stats_file:
+        snapshots = asyncio.create_task(async_write_stats_snapshots_forever(options.stats_file, options.stats_interval))
+    if options.session_file:
+        saver = asyncio.create_task(async_write_sessions_forever(options.session_file, options.session_interval))
+    if options.workers > 1:
+        link_readers = [asyncio.create_task(async_worker_messages_forever(worker, sock))
+                        for worker, sock in links.sockets.items()]
+        take_overs = asyncio.create_task(async_take_over_clients_forever())
+    if peerSocket is not None:
+        peer_server = await start_async_server(async_handle_peer, peerSocket, binary=True)
+        dialers = [asyncio.create_task(async_dial_peer_forever(peer)) for peer in options.peers]
+        gossip = asyncio.create_task(async_gossip_forever())
+    server = await start_async_server(async_handle_client, serverSocket)
+    async with server:
+        await server.serve_forever()
+
 
-def LIST_CLIENTS(connection):
+
+def LIST_CLIENTS(connection, arguments=()):
     """
-    Lists public clients.
+    Lists public clients. "LIST_CLIENTS <offset> <limit>" lists one page of them.
     :param connection: The client socket
     :type connection: socket.socket
+    :param arguments: the words after LIST_CLIENTS in the command
+    :type arguments: list[str]
     :rtype: None
     """    
     try:
-        connection.sendall(serialize(2, serverID, list_connections()))
-    except:
-        print("ISSUES WITH LIST")
+        if arguments:
+            try:
+                offset, limit = int(arguments[0]), int(arguments[1])
+            except (IndexError, ValueError):
+                offset = limit = -1
+            if offset < 0 or limit < 1:
+                connection.reply(3, serverID, "Usage: LIST_CLIENTS <offset> <limit>")
+                return
+            connection.reply(2, serverID, list_connections(offset, limit))
+        else:
+            connection.reply(2, serverID, list_connections())
+    except Exception as error:
+        log.error("list_failed", error=repr(error))
+
+
+def FIND(connection, arguments):
+    """
+    Finds public clients whose userID starts with a prefix. "FIND <prefix> [limit]"
+    :param connection: The client socket
+    :type connection: socket.socket
+    :param arguments: the words after FIND in the command
+    :type arguments: list[str]
+    :rtype: None
+    """
+    try:
+        limit = int(arguments[1]) if len(arguments) > 1 else FIND_LIMIT
+    except ValueError:
+        limit = 0
+    if not arguments or limit < 1:
+        connection.reply(3, serverID, "Usage: FIND <prefix> [limit]")
+        return
+    matches = public_list.find(arguments[0], min(limit, FIND_MAX_LIMIT))
+    lines = [str(count) + ". " + match + "\n" for count, match in enumerate(matches, 1)]
+    connection.reply(2, serverID, "-------CLIENTS STARTING WITH " + arguments[0] + "-------\n" + "".join(lines))
+
+
+def CREATE_ROOM(connection, user_id, arguments):
+    """
+    Opens a group chat room, with the client who opened it in it. "CREATE_ROOM <room>"
+    :param connection: The client socket
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param user_id: The client userID
+    :type user_id: str
+    :param arguments: the words after CREATE_ROOM in the command
+    :type arguments: list[str]
+    :rtype: None
+    """
+    if len(arguments) != 1 or len(arguments[0]) > ROOM_NAME_LIMIT:
+        connection.reply(3, serverID, "Usage: CREATE_ROOM <room>, a name of up to " + str(ROOM_NAME_LIMIT)
+                         + " characters")
+    elif rooms.create(arguments[0], user_id):
+        log.debug("room_created", room=arguments[0], user_id=user_id)
+        connection.reply(2, serverID, "Room " + arguments[0] + " created")
+    else:
+        connection.reply(3, serverID, "There is already a room called " + arguments[0])
+
+
+def JOIN_ROOM(connection, user_id, arguments):
+    """
+    Puts the client in a group chat room. "JOIN_ROOM <room>"
+    :param connection: The client socket
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param user_id: The client userID
+    :type user_id: str
+    :param arguments: the words after JOIN_ROOM in the command
+    :type arguments: list[str]
+    :rtype: None
+    """
+    if len(arguments) != 1:
+        connection.reply(3, serverID, "Usage: JOIN_ROOM <room>")
+        return
+    members = rooms.join(arguments[0], user_id)
+    if members is None:
+        connection.reply(3, serverID, "There is no room called " + arguments[0])
+    else:
+        connection.reply(2, serverID, "Joined room " + arguments[0] + " (" + str(members) + " members)")
+
+
+def LEAVE_ROOM(connection, user_id, arguments):
+    """
+    Takes the client out of a group chat room. "LEAVE_ROOM <room>"
+    :param connection: The client socket
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param user_id: The client userID
+    :type user_id: str
+    :param arguments: the words after LEAVE_ROOM in the command
+    :type arguments: list[str]
+    :rtype: None
+    """
+    if len(arguments) != 1:
+        connection.reply(3, serverID, "Usage: LEAVE_ROOM <room>")
+    elif rooms.leave(arguments[0], user_id):
+        connection.reply(2, serverID, "Left room " + arguments[0])
+    else:
+        connection.reply(3, serverID, "You are not in a room called " + arguments[0])
+
+
+def ROOM_SEND(connection, user_id, command):
+    """
+    Sends a message to everyone else in a group chat room the client is in. "ROOM_SEND <room> <text>"
+    Members on other workers or nodes are not reached: rooms belong to the process their members are connected to.
+    :param connection: The client socket
+    :type connection: protocol.Channel or protocol.AsyncChannel
+    :param user_id: The client userID
+    :type user_id: str
+    :param command: the whole command, so the text keeps its spacing
+    :type command: str
+    :rtype: None
+    """
+    parts = command.split(None, 2)
+    if len(parts) < 3:
+        connection.reply(3, serverID, "Usage: ROOM_SEND <room> <text>")
+        return
+    members = rooms.members(parts[1], user_id)
+    if members is None:
+        connection.reply(3, serverID, "You are not in a room called " + parts[1])
+        return
+    connections = []
+    for member_id in members:
+        session = registry.get(member_id)
+        if session is not None and member_id != user_id:
+            connections.append(session.connection)
+    sent, dropped = deliver(connections, 2, user_id, ROOM_PREFIX + " " + parts[1] + "\n" + parts[2])
+    message = "Sent to " + str(sent) + " of " + str(len(members) - 1) + " members of " + parts[1]
+    if dropped:
+        message += "; " + str(dropped) + " disconnected for falling too far behind"
+    connection.reply(2, serverID, message)
+
+
+def dispatch(message_type, command, connection, addr, user_id):
+    """
+    Passes a message from a client to the right handler: a MESSAGE from a client that has been asked to chat is their
+    answer, anything else is a command.
+    :param message_type: The message type received from the client
+    :type message_type: int
+    :param command: The message itself
+    :type command: str
+    :param connection: The client socket
+    :type connection: socket.socket
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param user_id: The client userID
+    :type user_id: str
+    :rtype: None
+    """
+    start = time.perf_counter()
+    if message_type == 1 and pending_requests.waiting_on(user_id):
+        answer_connection_request(user_id, command)
+        name = "ANSWER"
+    else:
+        name = run_command(command, connection, addr, user_id)
+    stats.command(name).record(time.perf_counter() - start)
+
+
+def run_command(command, connection, addr, user_id):
+    """
+    Carries out a command, unless the client has sent too many of that kind lately.
+    :param command: The command sent from the client
+    :type command: str
+    :param connection: The client socket
+    :type connection: socket.socket
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param user_id: The client userID
+    :type user_id: str
+    :rtype: str (the command's name, UNKNOWN if it is not one, or REFUSED if it was not carried out)
+    """
+    words = command.split(None, 1)
+    name = words[0] if words else "UNKNOWN"
+    if name not in COMMANDS:
+        name = "UNKNOWN"
+    if command_limited(user_id, name):
+        stats.count("refused " + name)
+        connection.reply(3, serverID, "Too many " + name + " commands. Please slow down.")
+        return "REFUSED"
+    handle_command(command, connection, addr, user_id)
+    return name
+
+
+class BatchConnection:
+    """
+    Stands in for a client's channel while the commands in a BATCH are carried out, keeping their replies for the one
+    combined answer instead of sending them. Anything else still goes to the client, including answers that only come
+    later, such as a CONNECT_TO's: the request ID is 0, so those arrive on their own rather than as the BATCH's reply.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.reply_to = 0
+        self.replies = []  # (message_type, message) of the command being carried out
+
+    def reply(self, message_type, user_id, message):
+        self.replies.append((message_type, message))
+
+    def send(self, message_type, user_id, message, request_id=0):
+        self.connection.send(message_type, user_id, message, request_id)
+
+    def result(self, command, name):
+        """
+        What became of a command, from the replies it left; clears them for the next one.
+        :param command: the command
+        :type command: str
+        :param name: what run_command() returned for it
+        :type name: str
+        :rtype: dict
+        """
+        replies, self.replies = self.replies, []
+        if not replies:
+            return {"command": command, "status": "pending", "type": None, "reply": ""}
+        message_type = replies[-1][0]
+        if name == "REFUSED":
+            status = "refused"
+        else:
+            status = "error" if message_type == 3 else "ok"
+        return {"command": command, "status": status, "type": message_type,
+                "reply": "\n".join(message for message_type, message in replies)}
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def run_batch(command, connection, addr, user_id):
+    """
+    Carries out the commands in a BATCH ("BATCH\n<command>\n<command>..."), in order, and answers them all at once
+    with a status and the reply of each (see protocol.encode_batch_results()). Each command takes the locks it needs
+    as it would on its own, so a long batch does not hold up everyone else, and one that fails is answered with an error
+    while the rest still run.
+    :param command: The BATCH command
+    :type command: str
+    :param connection: The client socket
+    :type connection: socket.socket
+    :param addr: The client IP and port number (host,port)
+    :type addr: tuple
+    :param user_id: The client userID
+    :type user_id: str
+    :rtype: None
+    """
+    commands = [line.strip() for line in command.split("\n")[1:] if line.strip()]
+    if not connection.binary:
+        connection.reply(3, serverID, "BATCH needs a client that speaks binary frames")
+        return
+    if not commands or len(commands) > BATCH_LIMIT:
+        connection.reply(3, serverID, "Usage: BATCH followed by 1 to " + str(BATCH_LIMIT) + " commands, one per line")
+        return
+    batch = BatchConnection(connection)
+    results = []
+    for each in commands:
+        start = time.perf_counter()
+        name = each.split()[0]
+        if name in (COMMANDS[3], COMMANDS[10]):
+            batch.reply(3, serverID, name + " cannot be part of a BATCH")
+            name = "REFUSED"
+        else:
+            try:
+                name = run_command(each, batch, addr, user_id)
+            except Exception as error:
+                # a bug in one command; the rest of the batch, and the connection, carry on
+                log.warning("batch_command_failed", user_id=user_id, command=each, error=repr(error))
+                batch.reply(3, serverID, "Could not carry out " + each)
+        stats.command(name).record(time.perf_counter() - start)
+        results.append(batch.result(each, name))
+    connection.reply(2, serverID, encode_batch_results(results))
 
 
 def handle_command(command, connection, addr, user_id):
@@ -323,38 +1963,101 @@ def handle_command(command, connection, addr, user_id):
     :rtype: None
     """    
     # COMMANDS = {"LIST_CLIENT", "VISIBILITY", "CONNECT_TO", "TERMINATE"}
-    if command.split()[0].split('\n')[0] == COMMANDS[0]:  # if the user wants to see the list of available clients
-        LIST_CLIENTS(connection)
+    words = command.split()  # once, rather than again for every command it is compared with
+    name = words[0] if words else None  # a blank command is not one
+    if name == COMMANDS[0]:  # if the user wants to see the list of available clients
+        LIST_CLIENTS(connection, words[1:])
 
-    elif command.split()[0].split('\n')[0] == COMMANDS[1]:  # if the user wants to change visibility
-        response = command.split()[1].lower()
-        for i, value in visibilityOptions.items():
-            if response.lower() == value:
-                new_vis = i
-                break
+    elif name == COMMANDS[1]:  # if the user wants to change visibility
+        response = words[1].lower() if len(words) > 1 else None
+        new_vis = next((i for i, value in visibilityOptions.items() if response == value), None)
+        if new_vis is None:
+            connection.reply(3, serverID, "Usage: VISIBILITY public|private")
+            return
 
         change_client_visibility(user_id, new_vis)
         message = "Visibility status changed successfully"
-        connection.sendall(serialize(2, serverID, message))
-
-    elif command.split()[0].split('\n')[0] == COMMANDS[2]:  # if the user wants to connect to another user
-        # DEBUG
-        print("CONNECTING...")
-        # DEBUG
-        requested_id = command.split()[1]  # the requested user name will be the second word of the command entered by the client
-        print("CONNECTING " + user_id + " AND " + requested_id)
-        connect_clients(user_id, requested_id)
-
-    elif command.split()[0].split('\n')[0] == COMMANDS[3]:
-        # debug
-        print(user_id + " IS TERMINATING!!!")
-        # debug
+        connection.reply(2, serverID, message)
+
+    elif name == COMMANDS[2]:  # if the user wants to connect to another user
+        if len(words) < 2:
+            connection.reply(3, serverID, "Usage: CONNECT_TO <user_id>")
+            return
+        requested_id = words[1]  # the requested user name will be the second word of the command entered by the client
+        log.debug("connect_requested", requestor=user_id, requested=requested_id)
+        connect_clients(user_id, requested_id, connection)
+
+    elif name == COMMANDS[3]:
+        log.debug("client_terminating", user_id=user_id)
+        # gone before the goodbye arrives, so the client can rejoin straight away under the same userID
+        forget_client(connection, user_id)
         message = "Good bye and take care!"
-        connection.sendall(serialize(2, serverID, message))
+        connection.reply(2, serverID, message)
+
+    elif name == COMMANDS[5]:  # if the user is looking for someone
+        FIND(connection, words[1:])
+
+    elif name == COMMANDS[6]:  # if the user no longer wants to connect to someone
+        if len(words) < 2:
+            connection.reply(3, serverID, "Usage: CANCEL_REQUEST <user_id>")
+        else:
+            cancel_connection_request(user_id, words[1], connection)
+
+    elif name == COMMANDS[7]:  # if someone wants to see how the server is doing
+        connection.reply(2, serverID, format_snapshot(stats_snapshot()))
+
+    elif name == COMMANDS[8]:  # if the user wants to be told who comes and goes
+        SUBSCRIBE_PRESENCE(connection, user_id, words[1:])
+
+    elif name == COMMANDS[9]:
+        if presence.unsubscribe(registry.get(user_id)):
+            connection.reply(2, serverID, "Unsubscribed from presence updates")
+        else:
+            connection.reply(3, serverID, "You are not subscribed to presence updates")
+
+    elif name == COMMANDS[10]:  # if the user sent several commands at once
+        run_batch(command, connection, addr, user_id)
+
+    elif name == COMMANDS[11]:  # if the user wants to open a group chat room
+        CREATE_ROOM(connection, user_id, words[1:])
+
+    elif name == COMMANDS[12]:
+        JOIN_ROOM(connection, user_id, words[1:])
+
+    elif name == COMMANDS[13]:
+        LEAVE_ROOM(connection, user_id, words[1:])
+
+    elif name == COMMANDS[14]:  # if the user is talking to a room
+        ROOM_SEND(connection, user_id, command)
     else:
-        print("what is this mf saying: " + command)
+        log.debug("unknown_command", user_id=user_id, command=command)
+        connection.reply(3, serverID, "Command not recognised: " + command)
 
     
 
-server_on()
-accepting_connections()
\ No newline at end of file
+if __name__ == "__main__":
+    server_on()
+    if options.asyncio:
+        asyncio.run(async_accepting_connections())
+    else:
+        threading.Thread(target=expire_connection_requests_forever, daemon=True).start()
+        threading.Thread(target=heartbeats_forever, daemon=True).start()
+        threading.Thread(target=publish_presence_forever, daemon=True).start()
+        if options.stats_file:
+            threading.Thread(target=write_stats_snapshots_forever, args=(options.stats_file, options.stats_interval),
+                             daemon=True).start()
+        if options.session_file:
+            threading.Thread(target=write_sessions_forever, args=(options.session_file, options.session_interval),
+                             daemon=True).start()
+        if options.workers > 1:
+            for worker, sock in links.sockets.items():
+                channel = links.channels[worker] = Channel(sock)
+                channel.queue_outbound(limit=LINK_QUEUE_LIMIT)
+                threading.Thread(target=worker_messages_forever, args=(worker, channel), daemon=True).start()
+            threading.Thread(target=take_over_clients_forever, daemon=True).start()
+        if peerSocket is not None:
+            threading.Thread(target=peer_connections_forever, daemon=True).start()
+            for peer in options.peers:
+                threading.Thread(target=dial_peer_forever, args=(peer,), daemon=True).start()
+            threading.Thread(target=gossip_forever, daemon=True).start()
+        accepting_connections()
@@ -0,0 +1,81 @@
+"""
+bench_batch.py - Commands sent one at a time against the same commands sent in BATCHes
+
+Clients each send the same read-heavy mix of commands over and over: first one command at a time, each waiting for
+its reply, then several at a time in one BATCH, which takes one round trip and one pass of the server's dispatch.
+
+Usage: python bench_batch.py [clients] [commands per batch] [seconds] [server arguments...]
+"""
+import argparse
+import sys
+import threading
+import time
+from KudzaiClient import ServerConnection, open_channel
+from loadgen import start_server
+from metrics import Histogram
+from protocol import encode_batch, decode_batch_results
+
+MIX = ["LIST_CLIENTS", "FIND bench", "VISIBILITY public", "LIST_CLIENTS 0 10", "FIND bench1"]
+
+
+def client(options, number, batch, stop, latencies, counts):
+    """
+    Sends commands until told to stop, batch at a time (or one at a time if batch is 0).
+    :rtype: None
+    """
+    name = "bench" + str(number)
+    server = ServerConnection(open_channel(options.host, options.port, name, 1), name)
+    commands = (MIX * batch)[:batch] if batch else MIX
+    done = 0
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            if batch:
+                message_type, user_id, reply = server.request(encode_batch(commands)).result(30)
+                if any(result["status"] != "ok" for result in decode_batch_results(reply)):
+                    raise RuntimeError("a command in the batch failed: " + reply[:200])
+                done += len(commands)
+            else:
+                server.request(commands[done % len(commands)]).result(30)
+                done += 1
+            latencies.record(time.perf_counter() - start)
+    finally:
+        server.request("TERMINATE")
+        server.close()
+        counts.append(done)
+
+
+def run(options, batch):
+    stop = threading.Event()
+    latencies = Histogram()
+    counts = []
+    threads = [threading.Thread(target=client, args=(options, i, batch, stop, latencies, counts))
+               for i in range(options.clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(options.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    summary = latencies.summary()
+    label = "BATCH of " + str(batch) if batch else "one at a time"
+    print(f"  {label:<16}{sum(counts) / options.seconds:>14,.0f}{summary['count'] / options.seconds:>14,.0f}"
+          f"{summary['p50_ms']:>10.3f}{summary['p99_ms']:>10.3f}")
+
+
+def main():
+    options = argparse.Namespace(host="127.0.0.1", port=0, server_args=" ".join(sys.argv[4:]))
+    options.clients = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    options.seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 3
+    server = start_server(options)
+    try:
+        print(f"{options.clients} clients, {options.seconds:.0f} s each, server arguments: {options.server_args or '-'}")
+        print(f"  {'':<16}{'commands/s':>14}{'round trips/s':>14}{'p50 ms':>10}{'p99 ms':>10}")
+        run(options, 0)
+        run(options, batch)
+    finally:
+        server.kill()
+
+
+main()
@@ -0,0 +1,66 @@
+"""
+bench_compression.py - Bytes and CPU per LIST_CLIENTS reply, sent as it is and compressed
+
+The reply is the list of public clients as the server renders it. It is compressed without and with the preset
+dictionary, and then through a PayloadCompressor, which is what the server sends with: the same reply to client after
+client is compressed once. Inflating is what each client pays.
+
+Usage: python bench_compression.py [users,...]
+"""
+import random
+import sys
+import time
+import zlib
+from protocol import compress_payload, decompress_payload, encode_frame, PayloadCompressor, COMPRESS_LEVEL
+
+NAMES = ["kudzai", "tendai", "hannah", "farai", "rudo", "tatenda", "chipo", "nyasha", "tafadzwa", "rumbi", "alice", "bob"]
+
+
+def listing(users):
+    """
+    :rtype: str (the reply to LIST_CLIENTS with this many public clients)
+    """
+    generator = random.Random(users)
+    user_ids = [generator.choice(NAMES) + "_" + str(generator.randrange(100000)) for i in range(users)]
+    return "-------LIST OF AVAILABLE CLIENTS-------\n" + "".join(
+        str(count) + ". " + user_id + "\n" for count, user_id in enumerate(user_ids, 1))
+
+
+def per_call(function, budget=0.5):
+    """
+    :rtype: float (seconds per call of function, run for about budget seconds)
+    """
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget:
+        function()
+        calls += 1
+    return (time.perf_counter() - start) / calls
+
+
+def run(users):
+    message = listing(users)
+    payload = message.encode('utf-8')
+    plain = zlib.compress(payload, COMPRESS_LEVEL)
+    compressed = compress_payload(payload)
+    assert decompress_payload(compressed) == payload
+    compressor = PayloadCompressor()
+    frame = encode_frame(2, "Server", message, compressor=compressor)
+    print(f"{users:>9,}{len(payload):>12,}{len(plain):>12,}{len(compressed):>12,}{len(payload) / len(compressed):>8.1f}x"
+          f"{per_call(lambda: encode_frame(2, 'Server', message)) * 1e6:>12,.1f}"
+          f"{per_call(lambda: compress_payload(payload)) * 1e6:>12,.1f}"
+          f"{per_call(lambda: encode_frame(2, 'Server', message, compressor=compressor)) * 1e6:>12,.1f}"
+          f"{per_call(lambda: decompress_payload(compressed)) * 1e6:>12,.1f}")
+    assert len(frame) < len(payload)
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1000, 10000, 100000]
+    print(f"{'':>9}{'bytes':>36}{'':>9}{'microseconds per reply':>48}")
+    print(f"{'users':>9}{'raw':>12}{'zlib':>12}{'zlib+dict':>12}{'ratio':>9}"
+          f"{'raw frame':>12}{'compress':>12}{'cached':>12}{'inflate':>12}")
+    for users in sizes:
+        run(users)
+
+
+main()
@@ -0,0 +1,78 @@
+"""
+bench_filetransfer.py - Sends a large file between a filetransfer.FileServer and receive_file() over loopback
+
+The file is sent once for every number of connections given, then once more with the connections dropped halfway,
+to time a transfer that has to carry on from where it got to.
+
+Usage: python bench_filetransfer.py [megabytes] [connections,connections,...] [directory]
+"""
+import os
+import struct
+import sys
+import tempfile
+import time
+from filetransfer import FileServer, receive_file, chunk_checksums, format_rate, format_report, STREAMS
+
+BLOCK = 1024 * 1024
+
+
+class DroppingServer(FileServer):
+    """
+    Drops every connection once half the file has been sent, as a network that went down would.
+    """
+
+    def send_range(self, connection, file, offset, length):
+        if self.bytes_sent >= self.size // 2:
+            raise ConnectionError("dropped for the benchmark")
+        super().send_range(connection, file, offset, length)
+
+
+def make_file(path, megabytes):
+    # random bytes, with every block numbered so that no two chunks are the same
+    block = bytearray(os.urandom(BLOCK))
+    with open(path, "wb") as file:
+        for number in range(megabytes):
+            struct.pack_into("!Q", block, 0, number)
+            file.write(block)
+
+
+def send(source, target, streams, server_class=FileServer):
+    server = server_class(source, "127.0.0.1")
+    server.start()
+    try:
+        offer = server.offer()
+        return receive_file("127.0.0.1", offer["port"], offer["token"], target, streams)
+    finally:
+        server.close()
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    counts = [int(count) for count in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, STREAMS]
+    directory = sys.argv[3] if len(sys.argv) > 3 else tempfile.gettempdir()
+    source = os.path.join(directory, "bench_filetransfer.source")
+    target = os.path.join(directory, "bench_filetransfer.target")
+    start = time.perf_counter()
+    make_file(source, megabytes)
+    print(f"made {megabytes * BLOCK / 1e6:,.1f} MB of random data in {time.perf_counter() - start:.2f} s")
+    start = time.perf_counter()
+    checksums = chunk_checksums(source)
+    print(f"checksummed it: {format_rate(megabytes * BLOCK, time.perf_counter() - start)}")
+    try:
+        for streams in counts:
+            print(f"  {streams} connection(s): {format_report(send(source, target, streams))}")
+            assert chunk_checksums(target) == checksums, "the copy is not the same as the file"
+            os.remove(target)
+        try:
+            send(source, target, counts[-1], DroppingServer)
+        except OSError:
+            pass
+        print(f"  dropped at half, resumed: {format_report(send(source, target, counts[-1]))}")
+        assert chunk_checksums(target) == checksums, "the copy is not the same as the file"
+    finally:
+        for path in (source, target, target + ".part", target + ".progress"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+main()
@@ -0,0 +1,99 @@
+"""
+bench_memory.py - The server's resident memory per idle client
+
+Starts Server.py, connects clients that say hello and then say nothing more, and reads the server's resident set size
+from /proc before and after, so the difference is what holding that many idle sessions costs. Heartbeats are turned
+off, or the idle clients would be evicted for not answering them. Every client needs a file descriptor in this process
+and in the server's, so the number of clients is capped by the hard limit on open files (ulimit -Hn).
+
+Linux only, for /proc.
+
+Usage: python bench_memory.py [clients] [server arguments...]
+"""
+import argparse
+import resource
+import sys
+import time
+from socket import socket, AF_INET, SOCK_STREAM
+from loadgen import start_server
+from protocol import Channel, SESSION_PREFIX
+
+BATCH = 500  # clients connected before any of their replies are read
+PER_SOURCE = 20000  # loopback clients per source address, well within the ephemeral ports of one
+PROJECTED = 100000
+
+
+def server_status(pid):
+    """
+    :rtype: dict (the server's VmRSS and Threads, in bytes and threads)
+    """
+    status = {}
+    with open("/proc/" + str(pid) + "/status") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "Threads"):
+                words = value.split()
+                status[name] = int(words[0]) * (1024 if words[1:] == ["kB"] else 1)
+    return status
+
+
+def connect_idle(options, count):
+    """
+    Connects count clients, each saying hello and reading the replies up to its SESSION, and then leaving it at that.
+    :rtype: list[protocol.Channel]
+    """
+    channels = []
+    loopback = options.host.startswith("127.")
+    while len(channels) < count:
+        batch = []
+        for number in range(len(channels), min(len(channels) + BATCH, count)):
+            sock = socket(AF_INET, SOCK_STREAM)
+            if loopback:
+                # each source address has its own ephemeral ports, so there are enough for more than ~28 000 clients
+                sock.bind(("127.0.1." + str(1 + number // PER_SOURCE), 0))
+            sock.connect((options.host, options.port))
+            channel = Channel(sock)
+            channel.send(1, "idle" + str(number), str(number % 2))  # half of them public, half private
+            batch.append(channel)
+        for channel in batch:
+            message = ""
+            while not message.startswith(SESSION_PREFIX):
+                message_type, request_id, user_id, message = channel.recv_frame()
+        channels += batch
+    return channels
+
+
+def main():
+    options = argparse.Namespace(host="127.0.0.1", port=0)
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # the server started below gets the same limit
+    if clients > hard - 100:
+        clients = hard - 100
+        print(f"only {clients:,} clients: that is all the open files limit ({hard:,}) leaves room for")
+    options.server_args = " ".join(["--heartbeat-interval", "0", "--quiet"] + sys.argv[2:])
+    server = start_server(options)
+    try:
+        connect_idle(options, 10)  # the first clients cost more than the rest, as caches and pools fill up
+        time.sleep(0.5)
+        before = server_status(server.pid)
+        start = time.perf_counter()
+        channels = connect_idle(options, clients)
+        connected = time.perf_counter() - start
+        time.sleep(1)
+        after = server_status(server.pid)
+        per_client = (after["VmRSS"] - before["VmRSS"]) / clients
+        print(f"server arguments: {options.server_args}")
+        print(f"{clients:,} idle clients connected in {connected:.1f} s")
+        print(f"{'':<24}{'before':>14}{'after':>14}")
+        print(f"{'resident MB':<24}{before['VmRSS'] / 1e6:>14,.1f}{after['VmRSS'] / 1e6:>14,.1f}")
+        print(f"{'threads':<24}{before['Threads']:>14,}{after['Threads']:>14,}")
+        print(f"\n{per_client:,.0f} bytes resident per idle client, "
+              f"{(before['VmRSS'] + per_client * PROJECTED) / 1e6:,.0f} MB for {PROJECTED:,} of them")
+        for channel in channels:
+            channel.close()
+    finally:
+        server.kill()
+
+
+main()
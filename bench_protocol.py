@@ -0,0 +1,81 @@
+"""
+bench_protocol.py - Compares the binary frames with the legacy comma separated text format
+
+Usage: python bench_protocol.py [messages]
+"""
+import sys
+import time
+from protocol import serialize, deserialize, encode_frame, FrameDecoder
+
+SAMPLES = [
+    (0, "kudzai", "LIST_CLIENTS"),
+    (0, "kudzai", "VISIBILITY public"),
+    (1, "Server", "hannah's address: ('127.0.0.1', 50312)"),
+    (2, "Server", "-------LIST OF AVAILABLE CLIENTS-------\n" + "".join(str(i) + ". user_" + str(i) + "\n" for i in range(1, 60))),
+]
+
+
+def timed(label, count, function):
+    """
+    Runs a function and prints how many messages per second it handled.
+    :param label: what is being measured
+    :type label: str
+    :param count: how many messages the function handles
+    :type count: int
+    :param function: the code being measured
+    :type function: callable
+    :rtype: float
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32}{count / elapsed:>14,.0f} msg/s")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    messages = [SAMPLES[i % len(SAMPLES)] for i in range(count)]
+    legacy = [serialize(*message) for message in messages]
+    frames = [encode_frame(*message) for message in messages]
+    stream = b"".join(frames)
+
+    def legacy_encode():
+        for message in messages:
+            serialize(*message)
+
+    def binary_encode():
+        for message in messages:
+            encode_frame(*message)
+
+    def legacy_decode():
+        for data in legacy:
+            deserialize(data)
+
+    def binary_decode():
+        decoder = FrameDecoder()
+        for data in frames:
+            decoder.feed(data)
+            decoder.next_frame()
+
+    def binary_stream_decode():
+        # the same frames arriving as arbitrary 64 KiB reads, the way TCP hands them over
+        decoder = FrameDecoder()
+        for start in range(0, len(stream), 65536):
+            decoder.feed(stream[start:start + 65536])
+            for frame in decoder:
+                pass
+
+    print(f"{count:,} messages, {len(stream):,} bytes framed\n")
+    timed("legacy serialize", count, legacy_encode)
+    timed("binary encode_frame", count, binary_encode)
+    timed("legacy deserialize", count, legacy_decode)
+    timed("binary decode (one per recv)", count, binary_decode)
+    timed("binary decode (64 KiB reads)", count, binary_stream_decode)
+
+    # the legacy format cannot survive a comma in the message or two messages arriving in one read
+    truncated = deserialize(serialize(*SAMPLES[2]))[2]
+    print("\nlegacy round trip of an address: " + repr(truncated))
+
+
+main()
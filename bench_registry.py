@@ -0,0 +1,82 @@
+"""
+bench_registry.py - Per-operation latency of the client registry at 10k and 100k registered users
+
+Usage: python bench_registry.py [users ...]
+"""
+import sys
+import time
+from registry import ClientRegistry
+
+
+def per_op(label, count, function):
+    """
+    Runs a function that does count operations and prints the average time per operation.
+    :param label: what is being measured
+    :type label: str
+    :param count: how many operations the function does
+    :type count: int
+    :param function: the code being measured
+    :type function: callable
+    :rtype: None
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34}{elapsed / count * 1e6:>10.2f} us/op")
+
+
+def bench(users):
+    print(f"{users:,} registered users")
+    registry = ClientRegistry()
+    names = ["user" + str(i) for i in range(users)]
+    sample = names[::max(1, users // 1000)]
+
+    def join():
+        for name in names:
+            registry.join(name, None, ("127.0.0.1", 0), "1")
+
+    def lookup():
+        for name in sample:
+            registry.get(name)
+
+    def flip():
+        for name in sample:
+            registry.set_visibility(name, "0")
+            registry.set_visibility(name, "1")
+
+    def find():
+        for name in sample:
+            registry.find(name, 20)
+
+    def leave_and_rejoin():
+        for name in sample:
+            registry.leave(name)
+            registry.join(name, None, ("127.0.0.1", 0), "1")
+
+    # what the server did before: parallel lists scanned for the user's index
+    connected_clients = [((None, ("127.0.0.1", 0)), "1") for name in names]
+    user_IDs = list(names)
+    scan_sample = sample[::max(1, len(sample) // 50)]
+
+    def linear_lookup():
+        for name in scan_sample:
+            for i, ((conn, client_addr), visibility) in enumerate(connected_clients):
+                if user_IDs[i] == name:
+                    break
+
+    per_op("join", users, join)
+    per_op("get", len(sample), lookup)
+    per_op("set_visibility", len(sample) * 2, flip)
+    per_op("find (prefix of a few users)", len(sample), find)
+    per_op("leave + join", len(sample) * 2, leave_and_rejoin)
+    per_op("public_ids (whole list)", 1, registry.public_ids)
+    per_op("old linear lookup", len(scan_sample), linear_lookup)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    for users in sizes:
+        bench(users)
+
+
+main()
@@ -0,0 +1,101 @@
+"""
+bench_registry_threads.py - Readers and writers sharing the client registry from several threads
+
+Reader threads list, search and look clients up while writer threads join, leave and change visibility, as client
+handlers do in the threaded server. Reads are run twice: from the registry's lock-free snapshots, and wrapped in the
+registry's lock, which is what making the reads safe with the one lock would cost.
+
+Usage: python bench_registry_threads.py [users] [readers] [writers] [seconds]
+"""
+import random
+import sys
+import threading
+import time
+from metrics import Histogram
+from registry import ClientRegistry
+
+
+def fill(users):
+    registry = ClientRegistry()
+    for i in range(users):
+        registry.join("user" + str(i), None, ("127.0.0.1", 0), "1")
+    return registry
+
+
+def reader(registry, names, locked, stop, latencies, counts):
+    """
+    Lists, searches and looks clients up until told to stop.
+    :rtype: None
+    """
+    generator = random.Random()
+    done = 0
+    while not stop.is_set():
+        name = generator.choice(names)
+        start = time.perf_counter()
+        if locked:
+            with registry.lock:
+                registry.public_ids()
+                registry.find(name[:-1], 20)
+                registry.get(name)
+        else:
+            registry.public_ids()
+            registry.find(name[:-1], 20)
+            registry.get(name)
+        latencies.record(time.perf_counter() - start)
+        done += 1
+    counts.append(done)
+
+
+def writer(registry, names, stop, counts):
+    """
+    Makes clients join, leave and change visibility until told to stop.
+    :rtype: None
+    """
+    generator = random.Random()
+    done = 0
+    while not stop.is_set():
+        name = generator.choice(names)
+        if generator.random() < 0.5:
+            registry.set_visibility(name, "0")
+            registry.set_visibility(name, "1")
+        else:
+            registry.leave(name)
+            registry.join(name, None, ("127.0.0.1", 0), "1")
+        done += 2
+    counts.append(done)
+
+
+def run(users, readers, writers, seconds, locked):
+    registry = fill(users)
+    names = ["user" + str(i) for i in range(users)]
+    stop = threading.Event()
+    latencies = Histogram()
+    reads = []
+    writes = []
+    threads = [threading.Thread(target=reader, args=(registry, names, locked, stop, latencies, reads))
+               for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(registry, names, stop, writes)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    summary = latencies.summary()
+    label = "reads under the lock" if locked else "reads from snapshots"
+    print(f"  {label:<24}{sum(reads) / seconds:>12,.0f}{sum(writes) / seconds:>12,.0f}"
+          f"{summary['p50_ms']:>10.3f}{summary['p99_ms']:>10.3f}{summary['max_ms']:>10.3f}")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 3
+    print(f"{users:,} users, {readers} reader and {writers} writer threads, {seconds:.0f} s each")
+    print(f"  {'':<24}{'reads/s':>12}{'writes/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    run(users, readers, writers, seconds, locked=True)
+    run(users, readers, writers, seconds, locked=False)
+
+
+main()
@@ -0,0 +1,121 @@
+"""
+bench_rooms.py - How fast the server fans a room message out to rooms of 10, 1,000 and 10,000 members
+
+Starts Server.py and, for each room size, connects that many members who join one room, and a sender who sends to it.
+The server answers ROOM_SEND once it has handed the message to every member's outbound queue, so the time to the reply
+is what fanning one message out costs the server. The members' sockets are all read by one thread here, which counts
+the bytes, so the end to end figure is messages delivered a second until the last member has the last message.
+Heartbeats are turned off, or the members would be evicted for not answering them. Every member needs a file
+descriptor in this process and in the server's, so the largest room is capped by the hard limit on open files.
+
+Usage: python bench_rooms.py [members,...] [server arguments...]
+"""
+import argparse
+import resource
+import selectors
+import statistics
+import sys
+import threading
+import time
+from socket import create_connection
+from loadgen import start_server
+from protocol import Channel, encode_frame
+from rooms import ROOM_PREFIX
+
+BATCH = 500  # members connected before any of their replies are read
+DELIVERIES = 200000  # about how many messages to deliver for each room size
+TEXT = "the quick brown fox jumps over the lazy dog, again"
+
+
+def join_members(options, room, count):
+    """
+    Connects count members, each saying hello and joining room.
+    :rtype: list[protocol.Channel]
+    """
+    channels = []
+    while len(channels) < count:
+        batch = []
+        for number in range(len(channels), min(len(channels) + BATCH, count)):
+            channel = Channel(create_connection((options.host, options.port)))
+            channel.send(1, room + "_" + str(number), "0")
+            channel.send(0, room + "_" + str(number), "JOIN_ROOM " + room, 1)
+            batch.append(channel)
+        for channel in batch:
+            while channel.recv_frame()[1] != 1:
+                pass  # the acknowledgement and the session, before the answer to JOIN_ROOM
+        channels += batch
+    return channels
+
+
+def drain(channels, expected, done):
+    """
+    Reads everything sent to the members until expected bytes have arrived, then sets done.
+    :rtype: None
+    """
+    selector = selectors.DefaultSelector()
+    for channel in channels:
+        channel.sock.setblocking(False)
+        selector.register(channel.sock, selectors.EVENT_READ)
+    buffer = bytearray(65536)
+    received = 0
+    while received < expected:
+        for key, events in selector.select(1):
+            try:
+                received += key.fileobj.recv_into(buffer)
+            except BlockingIOError:
+                pass
+    selector.close()
+    done.set()
+
+
+def run(options, members):
+    room = "room" + str(members)
+    sender = Channel(create_connection((options.host, options.port)))
+    sender.send(1, "sender_" + room, "0")
+    sender.send(0, "sender_" + room, "CREATE_ROOM " + room, 1)
+    while sender.recv_frame()[1] != 1:
+        pass
+    channels = join_members(options, room, members)
+    messages = max(20, min(2000, DELIVERIES // members))
+    frame = encode_frame(2, "sender_" + room, ROOM_PREFIX + " " + room + "\n" + TEXT)
+    done = threading.Event()
+    threading.Thread(target=drain, args=(channels, len(frame) * members * messages, done), daemon=True).start()
+
+    fan_out = []
+    start = time.perf_counter()
+    for request_id in range(2, messages + 2):
+        sent = time.perf_counter()
+        sender.send(0, "sender_" + room, "ROOM_SEND " + room + " " + TEXT, request_id)
+        message_type, reply_to, user_id, reply = sender.recv_frame()
+        fan_out.append(time.perf_counter() - sent)
+        if not reply.startswith("Sent to " + str(members) + " "):
+            print("unexpected reply: " + reply)
+    delivered = done.wait(60)
+    elapsed = time.perf_counter() - start
+    median = statistics.median(fan_out)
+    print(f"{members:>9,}{messages:>10,}{median * 1e6:>14,.0f}{median / members * 1e9:>14,.0f}"
+          f"{members * messages / elapsed if delivered else 0:>16,.0f}")
+    for channel in channels + [sender]:
+        channel.close()
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [10, 1000, 10000]
+    options = argparse.Namespace(host="127.0.0.1", port=0)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # the server started below gets the same limit
+    if max(sizes) > hard - 100:
+        print(f"rooms of at most {hard - 100:,}: that is all the open files limit ({hard:,}) leaves room for")
+        sizes = [min(size, hard - 100) for size in sizes]
+    options.server_args = " ".join(["--heartbeat-interval", "0", "--quiet"] + sys.argv[2:])
+    server = start_server(options)
+    try:
+        print(f"server arguments: {options.server_args}")
+        print(f"{'members':>9}{'messages':>10}{'us/message':>14}{'ns/member':>14}{'delivered/s':>16}")
+        for members in sizes:
+            run(options, members)
+    finally:
+        server.kill()
+
+
+main()
@@ -0,0 +1,148 @@
+"""
+bench_rudp.py - Sends chat traffic between two reliable UDP channels through a loopback proxy that drops and delays
+datagrams, and reports goodput and delivery latency
+
+Usage: python bench_rudp.py [messages] [message size] [loss %] [delay ms] [jitter ms] [messages per second]
+
+With no rate the messages are sent as fast as send() takes them, which measures goodput but makes latency mostly time
+spent queued behind the window; give a rate to see the latency a paced conversation gets.
+"""
+import heapq
+import random
+import statistics
+import struct
+import sys
+import threading
+import time
+from socket import socket, AF_INET, SOCK_DGRAM
+from rudp import ReliableChannel
+
+STAMP = struct.Struct("!Id")  # message number, time.perf_counter() when it was sent
+
+
+class LossyProxy:
+    """
+    Forwards datagrams between two addresses, dropping some and holding the rest back for a random delay, which also
+    reorders them.
+    """
+
+    def __init__(self, loss, delay, jitter):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.dropped = 0
+        self.forwarded = 0
+        self.sides = [socket(AF_INET, SOCK_DGRAM), socket(AF_INET, SOCK_DGRAM)]
+        for side in self.sides:
+            side.bind(("127.0.0.1", 0))
+            side.settimeout(0.001)
+        self.peers = [None, None]  # the channel behind each side, learnt from the first datagram it sends
+        self._due = []  # heap of (when, order, side to send from, datagram)
+        self._order = 0
+        self._running = True
+        self._threads = [threading.Thread(target=self._listen, args=(i,), daemon=True) for i in range(2)]
+        self._threads.append(threading.Thread(target=self._deliver, daemon=True))
+        self._lock = threading.Condition()
+        for thread in self._threads:
+            thread.start()
+
+    def address(self, side):
+        return self.sides[side].getsockname()
+
+    def stop(self):
+        self._running = False
+        with self._lock:
+            self._lock.notify()
+        for thread in self._threads:
+            thread.join()
+
+    def _listen(self, side):
+        while self._running:
+            try:
+                datagram, address = self.sides[side].recvfrom(65535)
+            except OSError:
+                continue
+            self.peers[side] = address
+            if random.random() < self.loss:
+                self.dropped += 1
+                continue
+            when = time.perf_counter() + self.delay + random.uniform(0, self.jitter)
+            with self._lock:
+                self._order += 1
+                heapq.heappush(self._due, (when, self._order, 1 - side, datagram))
+                self._lock.notify()
+
+    def _deliver(self):
+        while self._running:
+            with self._lock:
+                while self._running and (not self._due or self._due[0][0] > time.perf_counter()):
+                    self._lock.wait(self._due[0][0] - time.perf_counter() if self._due else None)
+                if not self._running:
+                    return
+                when, order, side, datagram = heapq.heappop(self._due)
+            if self.peers[side] is not None:
+                self.forwarded += 1
+                self.sides[side].sendto(datagram, self.peers[side])
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    loss = float(sys.argv[3]) / 100 if len(sys.argv) > 3 else 0.05
+    delay = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+    jitter = float(sys.argv[5]) / 1000 if len(sys.argv) > 5 else 0.01
+    rate = float(sys.argv[6]) if len(sys.argv) > 6 else 0
+
+    proxy = LossyProxy(loss, delay, jitter)
+    sockets = [socket(AF_INET, SOCK_DGRAM), socket(AF_INET, SOCK_DGRAM)]
+    for sock in sockets:
+        sock.bind(("127.0.0.1", 0))
+    # each channel talks to its own side of the proxy; send one datagram so the proxy knows who is behind each side
+    for side, sock in enumerate(sockets):
+        sock.sendto(b"\xff", proxy.address(side))
+    sender = ReliableChannel(sockets[0], proxy.address(0))
+    receiver = ReliableChannel(sockets[1], proxy.address(1))
+
+    padding = b"x" * max(0, size - STAMP.size)
+    latencies = []
+
+    def receive():
+        for expected in range(count):
+            message = receiver.messages.get(timeout=60)
+            number, sent_at = STAMP.unpack_from(message)
+            assert number == expected and len(message) == size, "messages were lost, reordered or cut short"
+            latencies.append(time.perf_counter() - sent_at)
+
+    receiving = threading.Thread(target=receive)
+    start = time.perf_counter()
+    receiving.start()
+    for number in range(count):
+        if rate:
+            time.sleep(max(0.0, start + number / rate - time.perf_counter()))
+        sender.send(STAMP.pack(number, time.perf_counter()) + padding)
+    receiving.join()
+    assert len(latencies) == count, "not every message arrived"
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    proxy.stop()
+
+    latencies.sort()
+    print(f"{count:,} messages of {size:,} bytes, {loss:.0%} loss, {delay * 1000:.0f} ms delay + up to {jitter * 1000:.0f} ms jitter"
+          + (f", {rate:,.0f} msg/s offered" if rate else "") + "\n")
+    print(f"{'goodput':<24}{count * size / elapsed / 1e6:>10.2f} MB/s")
+    print(f"{'messages':<24}{count / elapsed:>10,.0f} msg/s")
+    print(f"{'latency p50':<24}{percentile(latencies, 0.5) * 1000:>10.1f} ms")
+    print(f"{'latency p99':<24}{percentile(latencies, 0.99) * 1000:>10.1f} ms")
+    print(f"{'latency mean':<24}{statistics.mean(latencies) * 1000:>10.1f} ms")
+    print(f"{'datagrams sent':<24}{sender.packets_sent + receiver.packets_sent:>10,}")
+    print(f"{'retransmissions':<24}{sender.retransmissions:>10,}")
+    print(f"{'dropped by the proxy':<24}{proxy.dropped:>10,}")
+    print(f"{'final RTO':<24}{sender.rto * 1000:>10.1f} ms")
+
+
+main()
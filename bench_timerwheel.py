@@ -0,0 +1,66 @@
+"""
+bench_timerwheel.py - Cost of keeping a heartbeat timer per client in the timer wheel, against a heap
+
+Usage: python bench_timerwheel.py [timers]
+"""
+import heapq
+import random
+import sys
+import time
+from timerwheel import TimerWheel
+
+
+def per_op(label, count, function):
+    """
+    Runs a function that does count operations and prints the average time per operation.
+    :rtype: None
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<40}{elapsed / count * 1e6:>10.2f} us/op")
+
+
+def main():
+    timers = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    interval = 15.0
+    deadlines = [random.uniform(0, interval) for i in range(timers)]
+    print(f"{timers:,} timers spread over {interval:.0f} s")
+
+    wheel = TimerWheel(tick=0.5, now=0.0)
+    fired = []
+    print("timer wheel")
+    per_op("schedule", timers, lambda: [wheel.schedule(key, deadline) for key, deadline in enumerate(deadlines)])
+    # every client sends something, pushing its timer back
+    per_op("reschedule", timers, lambda: [wheel.schedule(key, deadline + interval) for key, deadline in enumerate(deadlines)])
+    per_op("advance through every tick (per timer)", timers,
+           lambda: [fired.extend(wheel.advance(tick * 0.5)) for tick in range(1, int(4 * interval) + 1)])
+    assert len(fired) == timers and not len(wheel)
+
+    # a heap cannot move a timer, so rescheduling pushes a new entry and stale ones are skipped when popped
+    heap = []
+    current = {}
+    fired = []
+
+    def heap_schedule(offset):
+        for key, deadline in enumerate(deadlines):
+            current[key] = deadline + offset
+            heapq.heappush(heap, (deadline + offset, key))
+
+    def heap_advance():
+        for tick in range(1, int(4 * interval) + 1):
+            now = tick * 0.5
+            while heap and heap[0][0] <= now:
+                deadline, key = heapq.heappop(heap)
+                if current.get(key) == deadline:
+                    del current[key]
+                    fired.append(key)
+
+    print("heap with lazy deletion")
+    per_op("schedule", timers, lambda: heap_schedule(0))
+    per_op("reschedule", timers, lambda: heap_schedule(interval))
+    per_op("advance through every tick (per timer)", timers, heap_advance)
+    assert len(fired) == timers
+
+
+main()
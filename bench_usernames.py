@@ -0,0 +1,71 @@
+"""
+bench_usernames.py - Stress test for handing out userIDs when every client asks for the same name
+
+Usage: python bench_usernames.py [clients] [threads]
+"""
+import sys
+import threading
+import time
+from registry import ClientRegistry
+
+
+def old_username_generator(userID, userIDs):
+    # what the server used to do: try every suffix against the list of userIDs
+    if userID not in userIDs:
+        return userID
+    count = 1
+    new_ID = userID + "_" + str(count)
+    while new_ID in userIDs:
+        count += 1
+        new_ID = userID + "_" + str(count)
+    return new_ID
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    thread_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    registry = ClientRegistry()
+    start = time.perf_counter()
+    for i in range(clients):
+        registry.join("bot", None, ("127.0.0.1", i), "1")
+    elapsed = time.perf_counter() - start
+    print(f"{str(clients) + ' joins as bot, one thread':<40}{elapsed:8.3f} s  ({elapsed / clients * 1e6:.2f} us/join)")
+
+    # half of them leave, then as many join again and should get the freed suffixes back, lowest first
+    leaving = ["bot_" + str(i) for i in range(1, clients, 2)]
+    start = time.perf_counter()
+    for user_id in leaving:
+        registry.leave(user_id)
+    rejoined = [registry.join("bot", None, ("127.0.0.1", 0), "1").user_id for user_id in leaving]
+    elapsed = time.perf_counter() - start
+    assert rejoined == leaving, "freed suffixes were not reused lowest first"
+    print(f"{str(len(leaving)) + ' leaves + rejoins':<40}{elapsed:8.3f} s  ({elapsed / len(leaving) / 2 * 1e6:.2f} us/op)")
+
+    registry = ClientRegistry()
+    given = []
+
+    def join_many(count):
+        names = [registry.join("bot", None, ("127.0.0.1", 0), "1").user_id for i in range(count)]
+        given.extend(names)
+
+    workers = [threading.Thread(target=join_many, args=(clients // thread_count,)) for i in range(thread_count)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    assert len(set(given)) == len(given) == len(registry), "two clients were given the same userID"
+    print(f"{str(len(given)) + ' joins as bot, ' + str(thread_count) + ' threads':<40}{elapsed:8.3f} s  (all userIDs unique)")
+
+    old_clients = min(clients, 500)  # the old generator is cubic, so keep this small
+    user_IDs = []
+    start = time.perf_counter()
+    for i in range(old_clients):
+        user_IDs.append(old_username_generator("bot", user_IDs))
+    elapsed = time.perf_counter() - start
+    print(f"{str(old_clients) + ' joins with the old generator':<40}{elapsed:8.3f} s  ({elapsed / old_clients * 1e6:.2f} us/join)")
+
+
+main()
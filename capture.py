@@ -0,0 +1,157 @@
+"""
+capture.py - Recording what clients send the server, for replaying it later (see replay.py)
+
+With --capture-file, the server writes every hello, message and hang-up its clients send to an append-only file, each
+as one record: a fixed header followed by the sender's user_ID and the message.
+
+    seconds since the capture started (8) | session (4) | kind (1) | type (1) | flags (1) | request ID (4)
+    | sender length (2) | payload length (4) | sender | payload
+
+Every time the server starts it appends a START record, and numbers its sessions afresh from 1. Like eventlog.py,
+recording only appends to a deque, and a background thread packs and writes whatever has piled up a few times a second,
+so capturing adds no disk I/O to the threads serving clients.
+
+A capture holds everything clients said to the server: their userIDs, what they searched for and who they asked to
+speak to. The file is created readable by its owner only, and the token in the hello of a client resuming its session
+is recorded as REDACTED, since it would let anyone reading the capture take that session over. A replayed resume is
+turned away, as it would be anyway by a server that never gave out the token.
+"""
+import atexit
+import itertools
+import os
+import struct
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from protocol import RESUME_PREFIX
+
+RECORD = struct.Struct("!dIBBBIHI")
+START = 0  # the server started capturing; the payload is the wall clock time
+HELLO = 1  # a client said hello
+MESSAGE = 2  # a client sent a message
+CLOSE = 3  # a client's connection closed
+FLAG_LEGACY = 0x80  # on a HELLO: the client speaks the legacy text format
+REDACTED = "REDACTED"  # recorded in place of a resumption token
+
+Record = namedtuple("Record", "run seconds session kind message_type flags request_id user_id message")
+
+
+class TrafficCapture:
+    """
+    Records what clients send, cheaply enough to leave on in production.
+    """
+
+    def __init__(self, path, flush_interval=0.1, max_queued=1_000_000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued  # beyond this, records are dropped rather than letting memory grow
+        self.dropped = 0
+        self.started = time.monotonic()
+        self._queue = deque()
+        self._sessions = {}  # connection -> its session number
+        self._numbers = itertools.count(1)
+        self._file = None
+        self._flush_lock = threading.Lock()
+
+    def start(self):
+        """
+        Opens the capture file and starts the background writer.
+        :rtype: None
+        """
+        self._file = open(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "ab")
+        self.started = time.monotonic()
+        self._queue.append((0.0, 0, START, 0, 0, 0, "", time.strftime("%Y-%m-%d %H:%M:%S")))
+        threading.Thread(target=self._write_forever, daemon=True).start()
+        atexit.register(self.flush)
+
+    def hello(self, connection, message_type, user_id, hello):
+        """
+        Records a client saying hello, which starts a new session.
+        :param connection: The client's channel
+        :type connection: protocol.Channel or protocol.AsyncChannel
+        :rtype: None
+        """
+        session = self._sessions[connection] = next(self._numbers)
+        flags = connection.flags if connection.binary else FLAG_LEGACY
+        if message_type == 2 and hello.startswith(RESUME_PREFIX):
+            words = hello.split()
+            words[1:2] = [REDACTED] * len(words[1:2])
+            hello = " ".join(words)
+        self._record(session, HELLO, message_type, flags, 0, user_id, hello)
+
+    def message(self, connection, message_type, user_id, message):
+        """
+        Records a message a client sent.
+        :rtype: None
+        """
+        session = self._sessions.get(connection)
+        if session is not None:
+            self._record(session, MESSAGE, message_type, connection.flags, connection.reply_to, user_id, message)
+
+    def close(self, connection):
+        """
+        Records a client's connection closing.
+        :rtype: None
+        """
+        session = self._sessions.pop(connection, None)
+        if session is not None:
+            self._record(session, CLOSE, 0, 0, 0, "", "")
+
+    def flush(self):
+        """
+        Writes out everything recorded so far.
+        :rtype: None
+        """
+        with self._flush_lock:
+            chunks = []
+            while self._queue:
+                seconds, session, kind, message_type, flags, request_id, user_id, message = self._queue.popleft()
+                sender = user_id.encode('utf-8')
+                payload = message.encode('utf-8')
+                chunks += [RECORD.pack(seconds, session, kind, message_type, flags, request_id, len(sender),
+                                       len(payload)), sender, payload]
+            if chunks:
+                self._file.write(b"".join(chunks))
+                self._file.flush()
+
+    def _record(self, session, kind, message_type, flags, request_id, user_id, message):
+        if len(self._queue) >= self.max_queued:
+            self.dropped += 1
+            return
+        self._queue.append((time.monotonic() - self.started, session, kind, message_type, flags, request_id, user_id,
+                            message))
+
+    def _write_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as error:
+                sys.stderr.write("could not write the capture: " + repr(error) + "\n")
+
+
+def read_capture(path):
+    """
+    Reads a capture back, record by record. A record cut off at the end, by a server that was killed part way through
+    writing it, is left out.
+    :param path: the capture file
+    :type path: str
+    :rtype: iterator of Record (run counts the server starts the file holds, from 1)
+    """
+    run = 0
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            seconds, session, kind, message_type, flags, request_id, sender_length, payload_length = \
+                RECORD.unpack(header)
+            sender = file.read(sender_length)
+            payload = file.read(payload_length)
+            if len(sender) < sender_length or len(payload) < payload_length:
+                return
+            if kind == START:
+                run += 1
+            yield Record(run, seconds, session, kind, message_type, flags, request_id, sender.decode('utf-8'),
+                         payload.decode('utf-8'))
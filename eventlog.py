@@ -0,0 +1,172 @@
+"""
+eventlog.py - Levelled, structured logging that keeps console and file I/O off the threads serving clients
+
+Logging an event only appends a record to a deque, which needs no lock. A background thread wakes up a few times a
+second, formats whatever has piled up and writes it out in one go, to the console and/or a file that is rotated once
+it gets too big. The most recent events are also kept in memory so they can be dumped when something goes wrong.
+Events below the log level return straight away.
+"""
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+
+
+def format_record(record):
+    """
+    Renders one record as a line: time, level, event name, then key=value fields.
+    :param record: (time.time(), level, event, fields)
+    :type record: tuple
+    :rtype: str
+    """
+    when, level, event, fields = record
+    line = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)) + f".{int(when % 1 * 1000):03d} "
+    line += LEVEL_NAMES.get(level, str(level)) + " " + event
+    for key, value in fields.items():
+        value = str(value)
+        if not value or " " in value or "=" in value or '"' in value or "\n" in value:
+            value = '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        line += " " + key + "=" + value
+    return line
+
+
+class EventLog:
+    """
+    A log that is cheap to write to from any thread.
+    """
+
+    def __init__(self, level=INFO, console=sys.stdout, path=None, max_bytes=10_000_000, backups=3, ring_size=1000,
+                 flush_interval=0.1, max_queued=100_000):
+        self.level = level
+        self.console = console  # None to log to the file only
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued  # beyond this, events are dropped rather than letting memory grow
+        self.dropped = 0
+        self.recent = deque(maxlen=ring_size)  # the last records logged, for dump()
+        self._queue = deque()
+        self._file = None
+        self._size = 0
+        self._flush_lock = threading.Lock()  # only the writer and flush() take it, never the threads logging
+        self._writer = None
+
+    def start(self):
+        """
+        Opens the log file and starts the background writer. Until this is called events only pile up.
+        :rtype: None
+        """
+        if self.path:
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._size = self._file.tell()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_forever, daemon=True)
+            self._writer.start()
+            atexit.register(self.flush)
+
+    def enabled(self, level):
+        """
+        For callers that would have to do real work to build an event's fields.
+        :rtype: bool
+        """
+        return level >= self.level
+
+    def log(self, level, event, **fields):
+        """
+        Records an event.
+        :param level: DEBUG, INFO, WARNING or ERROR
+        :type level: int
+        :param event: a short name for what happened, such as "client_joined"
+        :type event: str
+        :param fields: the details, written out as key=value
+        :rtype: None
+        """
+        if level < self.level:
+            return
+        if len(self._queue) >= self.max_queued:
+            self.dropped += 1
+            return
+        record = (time.time(), level, event, fields)
+        self._queue.append(record)
+        self.recent.append(record)
+
+    def debug(self, event, **fields):
+        if DEBUG >= self.level:
+            self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        if INFO >= self.level:
+            self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, **fields)
+
+    def flush(self):
+        """
+        Writes out everything logged so far.
+        :rtype: None
+        """
+        with self._flush_lock:
+            lines = []
+            while self._queue:
+                lines.append(format_record(self._queue.popleft()))
+            if lines:
+                self._write("\n".join(lines) + "\n")
+
+    def dump(self):
+        """
+        Writes out the recent events kept in memory, whether or not they were already written.
+        :rtype: None
+        """
+        records = list(self.recent)
+        self.flush()
+        with self._flush_lock:
+            self._write(f"-------{len(records)} RECENT EVENTS-------\n"
+                        + "".join(format_record(record) + "\n" for record in records)
+                        + "-------END OF RECENT EVENTS-------\n")
+
+    def _write_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as error:
+                sys.stderr.write("could not write the log: " + repr(error) + "\n")
+
+    def _write(self, text):
+        # called with _flush_lock held
+        if self.console is not None:
+            self.console.write(text)
+            self.console.flush()
+        if self._file is not None:
+            self._file.write(text)
+            self._file.flush()
+            self._size += len(text)
+            if self._size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        # log -> log.1 -> log.2 ..., dropping the oldest
+        self._file.close()
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = 0
@@ -0,0 +1,621 @@
+"""
+federation.py - Several servers on different addresses, letting the clients of one speak to the clients of another
+
+Each server is a node with a name of its own. The nodes connect to each other over TCP, and every node keeps a replica
+of the directory of every node's clients: who is connected where, from which address, and whether they are public. A
+client of another node is known here as <userID>@<node>, so userIDs never clash between nodes, and LIST_CLIENTS,
+FIND and presence updates cover the public clients of every node.
+
+The replicas are kept up to date by gossip. Every change a node makes to its own clients is numbered from that node's
+counter, and a node's version vector holds the highest number it has from every node. Every gossip interval each node
+sends its vector to a peer picked at random, which answers with the changes the vector shows are missing, along with
+its own vector, and is sent back whatever it is missing in turn. A node's own new changes are also pushed to a peer
+ahead of anything else sent to it, so a peer never hears of a client's request before hearing that they joined. The
+vector carries a heartbeat for every node too; the clients of a node nobody has heard from in a while are left out of
+the lists until it is heard from again.
+
+Every node's changes are also kept in a log ordered by number, so finding those after a vector's is a binary search
+rather than a sort of every client. A client who has left stays in the replicas as a tombstone, so that nodes that
+have not heard yet are told, until every node that is up has acknowledged it in its vector, or until TOMBSTONE_TTL
+has gone by. A node left behind by a tombstone that has since been forgotten is given that node's clients afresh, in
+place of what it had.
+
+A CONNECT_TO or CANCEL_REQUEST for a client of another node is forwarded to that node and carried out there, with the
+answers passed back through the requestor's node, the same way as between worker processes (see workers.py).
+
+To try three nodes on one machine:
+
+    python Server.py 127.0.0.1 9000 --node a --peer-port 9100 --peers 127.0.0.1:9101,127.0.0.1:9102
+    python Server.py 127.0.0.1 9001 --node b --peer-port 9101 --peers 127.0.0.1:9100,127.0.0.1:9102
+    python Server.py 127.0.0.1 9002 --node c --peer-port 9102 --peers 127.0.0.1:9100,127.0.0.1:9101
+
+after which a client of a can CONNECT_TO someone@b.
+"""
+import json
+import random
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from registry import RegistrySnapshot, CHANGE_HISTORY
+from workers import DirectoryEntry
+
+GOSSIP_INTERVAL = 1.0  # seconds between gossip rounds
+PEER_TIMEOUT = 10  # seconds without news of a node before its clients are taken off the lists
+PEER_RETRY = 1.0  # seconds between attempts to reconnect to a peer
+MAX_CHANGES = 1000  # changes sent in one message; the rest follow in later rounds
+TOMBSTONE_TTL = 60  # most seconds a client who left is remembered, for nodes that have not acknowledged it
+
+
+class NodeState:
+    """
+    What a node knows of one node's clients, its own included, and the log of its changes in the order they were
+    numbered. The log keeps entries that later changes have replaced until they make up half of it.
+    """
+    __slots__ = ("incarnation", "counter", "heartbeat", "heard", "up", "clients", "log", "stale", "tombstones",
+                 "forgotten")
+
+    def __init__(self, incarnation, heard):
+        self.incarnation = incarnation  # when the node started; its counter starts again from 0 every time it does
+        self.counter = 0  # the highest numbered change of the node's that has been applied here
+        self.heartbeat = 0
+        self.heard = heard  # the time.monotonic() the heartbeat last went up
+        self.up = True
+        self.clients = {}  # the node's userID -> (counter, connected, visibility, address)
+        self.log = []  # (counter, userID) of every change, in order, some of them replaced since
+        self.stale = 0  # entries of the log that have been replaced
+        self.tombstones = deque()  # (time.monotonic(), counter, userID) of the clients who have left, oldest first
+        self.forgotten = 0  # the number of the newest tombstone given up here
+
+    def set(self, user_id, entry, now):
+        """
+        Records a change to one of the node's clients.
+        :param entry: (counter, connected, visibility, address)
+        :type entry: tuple
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: None
+        """
+        if user_id in self.clients:
+            self.stale += 1
+        self.clients[user_id] = entry
+        counter = entry[0]
+        if not self.log or self.log[-1][0] < counter:
+            self.log.append((counter, user_id))
+        else:
+            insort(self.log, (counter, user_id))  # heard of out of order, by way of another node
+        if not entry[1]:
+            self.tombstones.append((now, counter, user_id))
+        self._compact()
+
+    def since(self, counter):
+        """
+        The node's changes numbered after counter, oldest first.
+        :rtype: generator of tuple[str,tuple] ((userID, entry))
+        """
+        clients = self.clients
+        for number, user_id in self.log[bisect_left(self.log, (counter + 1,)):]:
+            entry = clients.get(user_id)
+            if entry is not None and entry[0] == number:
+                yield user_id, entry
+
+    def forget(self, keep):
+        """
+        Gives up the oldest tombstones until keep() says to keep one.
+        :param keep: called with the tombstone's time and number
+        :type keep: callable
+        :rtype: None
+        """
+        tombstones = self.tombstones
+        while tombstones:
+            when, counter, user_id = tombstones[0]
+            entry = self.clients.get(user_id)
+            if entry is not None and entry[0] == counter:
+                if keep(when, counter):
+                    break
+                del self.clients[user_id]
+                self.stale += 1
+                self.forgotten = max(self.forgotten, counter)
+            tombstones.popleft()
+        self._compact()
+
+    def clear(self):
+        """
+        Forgets all the node's clients, to be given them afresh.
+        :rtype: dict (the clients as they were)
+        """
+        clients = self.clients
+        self.clients = {}
+        self.counter = self.stale = self.forgotten = 0
+        self.log = []
+        self.tombstones.clear()
+        return clients
+
+    def _compact(self):
+        # drops the replaced entries from the log, once they are half of it
+        if self.stale > 64 and self.stale * 2 > len(self.log):
+            clients = self.clients
+            self.log = [(number, user_id) for number, user_id in self.log
+                        if user_id in clients and clients[user_id][0] == number]
+            self.stale = 0
+
+
+class FederatedDirectory:
+    """
+    The replica of every node's clients, and the public list of all of them.
+
+    It takes the place of workers.SharedDirectory: the registry makes every change to this node's clients here too
+    (claim(), connect(), disconnect(), set_visibility() and release()), and LIST_CLIENTS, FIND and presence read the
+    public list from here. Clients of other nodes are listed as <userID>@<node>, in the order they became public here.
+    """
+
+    def __init__(self, node, timeout=PEER_TIMEOUT, tombstone_ttl=TOMBSTONE_TTL):
+        self.node = node
+        self.timeout = timeout
+        self.tombstone_ttl = tombstone_ttl
+        self.lock = threading.Lock()
+        self.version = 0  # version of the public list, which goes up with every change to it
+        self._own = NodeState(int(time.time() * 1000), time.monotonic())
+        self._nodes = {node: self._own}  # node name -> NodeState
+        self._vectors = {}  # node name -> the version vector it last sent, which says what it has acknowledged
+        self._public = OrderedDict()  # listed userID -> None, in the order they became public
+        self._changes = deque(maxlen=CHANGE_HISTORY)  # (version, "+" or "-", listed userID)
+        self._snapshot = RegistrySnapshot(0, (), ())
+
+    def __contains__(self, user_id):
+        entry = self._own.clients.get(user_id)
+        return entry is not None and entry[1]
+
+    @staticmethod
+    def fit(user_id):
+        """
+        The userID a client of this node can be given: "@" is kept for the names of other nodes' clients.
+        :param user_id: the userID the client asked for
+        :type user_id: str
+        :rtype: str
+        """
+        return user_id.replace("@", "_")
+
+    def lookup(self, user_id):
+        """
+        Looks up a client of another node.
+        :param user_id: <userID>@<node>
+        :type user_id: str
+        :rtype: workers.DirectoryEntry or None if no node that is up has such a client
+        """
+        name, at, node = user_id.rpartition("@")
+        if not at or node == self.node:
+            return None
+        with self.lock:
+            state = self._nodes.get(node)
+            entry = None if state is None or not state.up else state.clients.get(name)
+        if entry is None:
+            return None
+        return DirectoryEntry(node, entry[1], entry[2], tuple(entry[3]) if entry[3] else None)
+
+    # changes to this node's own clients, made by the registry
+    def claim(self, user_id, address, visibility):
+        """
+        Adds a client connected to this node. Their userID only has to be free here, as the registry has checked.
+        :rtype: bool (always True)
+        """
+        self._change(user_id, True, visibility, address)
+        return True
+
+    def reserve(self, user_id):
+        """
+        Keeps a userID for a client of this node that may resume; the other nodes have no need to know.
+        :rtype: bool (always True)
+        """
+        return True
+
+    def connect(self, user_id, address, visibility):
+        self._change(user_id, True, visibility, address)
+        return True
+
+    def disconnect(self, user_id):
+        self._change(user_id, False, "0", None)
+        return True
+
+    def set_visibility(self, user_id, visibility):
+        self._change(user_id, True, visibility, None)
+        return True
+
+    def release(self, user_id):
+        self._change(user_id, False, "0", None)
+
+    def _change(self, user_id, connected, visibility, address):
+        # address None keeps the one already known
+        own = self._own
+        with self.lock:
+            old = own.clients.get(user_id)
+            if address is None and old is not None:
+                address = old[3]
+            own.counter += 1
+            new = (own.counter, connected, visibility, list(address) if address else None)
+            own.set(user_id, new, time.monotonic())
+            self._relist(user_id, old, new)
+
+    # the rest of the changes come from gossip
+    def vector(self):
+        """
+        The version vector: for every node, when it started, the highest numbered change of its that has been applied
+        here, and its heartbeat.
+        :rtype: dict[str,list[int]] (node -> [incarnation, counter, heartbeat])
+        """
+        with self.lock:
+            return {node: [state.incarnation, state.counter, state.heartbeat] for node, state in self._nodes.items()}
+
+    def beat(self, now=None):
+        """
+        Moves this node's heartbeat on, takes the clients of nodes not heard from in a while off the lists, and gives
+        up the tombstones that every node has, or that are older than the tombstone TTL.
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: list[str] (the nodes that have just been given up on)
+        """
+        if now is None:
+            now = time.monotonic()
+        silent = []
+        with self.lock:
+            self._own.heartbeat += 1
+            for node, state in self._nodes.items():
+                if state.up and node != self.node and now - state.heard > self.timeout:
+                    state.up = False
+                    self._show(node, state, False)
+                    silent.append(node)
+            for node, state in self._nodes.items():
+                state.forget(lambda when, counter: now - when <= self.tombstone_ttl
+                             and not self._acknowledged(node, state.incarnation, counter))
+        return silent
+
+    def missing(self, vector, limit=MAX_CHANGES):
+        """
+        The changes a node with this version vector has yet to apply, oldest first for every node.
+        :param vector: the node's version vector (see vector())
+        :type vector: dict
+        :param limit: the most changes to return; the oldest ones of every node are the ones returned, so whoever
+                      applies them is left missing only changes newer than any they have
+        :type limit: int
+        :rtype: tuple[list[list],list[list]] (the changes, [node, incarnation, counter, userID, connected, visibility,
+                address], and [node, incarnation] for every node whose clients they are to be given afresh, having
+                missed tombstones forgotten here; those nodes' changes are sent whole, whatever the limit)
+        """
+        changes = []
+        reset = []
+        with self.lock:
+            for node, state in self._nodes.items():
+                known = vector.get(node)
+                if known is None or known[0] < state.incarnation:
+                    since = 0
+                elif known[0] == state.incarnation:
+                    since = known[1]
+                else:
+                    continue  # they know of a later start of that node than this one does
+                whole = 0 < since < state.forgotten
+                if whole:
+                    since = 0
+                    reset.append([node, state.incarnation])
+                for user_id, (counter, connected, visibility, address) in state.since(since):
+                    if len(changes) >= limit and not whole:
+                        break
+                    changes.append([node, state.incarnation, counter, user_id, connected, visibility, address])
+        return changes, reset
+
+    def own_changes(self, since):
+        """
+        This node's changes numbered after since, oldest first, for pushing to a peer.
+        :param since: the number of the last change the peer was sent
+        :type since: int
+        :rtype: tuple[list[list],list[list],int] (the changes and resets as in missing(), and the number of the last
+                change)
+        """
+        with self.lock:
+            own = self._own
+            reset = []
+            if since < own.forgotten:
+                # the peer may still have clients whose tombstones are gone here, e.g. as it has just reconnected
+                since = 0
+                reset.append([self.node, own.incarnation])
+            return [[self.node, own.incarnation, number, user_id, connected, visibility, address]
+                    for user_id, (number, connected, visibility, address) in own.since(since)], reset, own.counter
+
+    def merge(self, vector, node=None, now=None):
+        """
+        Takes the heartbeats and starts of nodes from another node's version vector.
+        :param vector: the other node's version vector (see vector())
+        :type vector: dict
+        :param node: the node it came from, whose acknowledgements it holds; None if it was passed on by another
+        :type node: str
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: None
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if node is not None:
+                self._vectors[node] = vector
+            for node, (incarnation, _, heartbeat) in vector.items():
+                state = self._state(node, incarnation, now)
+                if state is None or incarnation != state.incarnation or heartbeat <= state.heartbeat:
+                    continue
+                state.heartbeat = heartbeat
+                state.heard = now
+                if not state.up:
+                    state.up = True
+                    self._show(node, state, True)
+
+    def apply(self, changes, reset=(), now=None):
+        """
+        Applies changes to other nodes' clients, skipping any that are older than what is already known.
+        :param changes: the changes, as missing() returns them
+        :type changes: list[list]
+        :param reset: [node, incarnation] of the nodes whose clients the changes hold afresh (see missing())
+        :type reset: list[list]
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: None
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            replaced = {}  # node -> its clients as they were before being given afresh, until they are seen again
+            for node, incarnation in reset:
+                state = self._state(node, incarnation, now)
+                if state is not None and incarnation == state.incarnation:
+                    replaced[node] = state.clear()
+            for node, incarnation, counter, user_id, connected, visibility, address in changes:
+                state = self._state(node, incarnation, now)
+                if state is None or incarnation != state.incarnation:
+                    continue
+                old = state.clients.get(user_id)
+                if old is not None and old[0] >= counter:
+                    continue
+                if old is None and node in replaced:
+                    old = replaced[node].pop(user_id, None)
+                new = (counter, connected, visibility, address)
+                state.set(user_id, new, now)
+                state.counter = max(state.counter, counter)
+                if state.up:
+                    self._relist(user_id + "@" + node, old, new)
+            for node, clients in replaced.items():
+                # the ones not among the changes had left, and their tombstones were forgotten
+                if self._nodes[node].up:
+                    for user_id, entry in clients.items():
+                        self._relist(user_id + "@" + node, entry, None)
+
+    # the rest are always called with the lock held
+    def _acknowledged(self, node, incarnation, counter):
+        # True if every other node that is up has a change of node's, by its last version vector
+        for other, state in self._nodes.items():
+            if other in (self.node, node) or not state.up:
+                continue
+            known = self._vectors.get(other, {}).get(node)
+            if known is None or known[0] != incarnation or known[1] < counter:
+                return False
+        return True
+
+    def _state(self, node, incarnation, now):
+        # the state of another node, started afresh if the node has restarted since it was last heard of
+        if node == self.node:
+            return None
+        state = self._nodes.get(node)
+        if state is None:
+            state = self._nodes[node] = NodeState(incarnation, now)
+        elif incarnation > state.incarnation:
+            if state.up:
+                self._show(node, state, False)
+            state.__init__(incarnation, now)
+        return state
+
+    def _show(self, node, state, shown):
+        # lists a node's public clients, or takes them all off the list
+        for user_id, entry in state.clients.items():
+            if shown:
+                self._relist(user_id + "@" + node, None, entry)
+            else:
+                self._relist(user_id + "@" + node, entry, None)
+
+    def _relist(self, listed, old, new):
+        was_public = old is not None and old[1] and old[2] == "1"
+        public = new is not None and new[1] and new[2] == "1"
+        if public and not was_public:
+            self._public[listed] = None
+        elif was_public and not public:
+            del self._public[listed]
+        else:
+            return
+        self.version += 1
+        self._changes.append((self.version, "+" if public else "-", listed))
+
+    def changes_since(self, version):
+        """
+        The changes to the public list after a version, oldest first, ending at the current version.
+        :param version: a version of the public list
+        :type version: int
+        :rtype: list[tuple[int,str,str]] ((version, "+" or "-", user_ID)) or None if they are not all remembered
+        """
+        with self.lock:
+            if version > self.version:
+                return None
+            if version == self.version:
+                return []
+            if not self._changes or self._changes[0][0] > version + 1:
+                return None
+            return [change for change in self._changes if change[0] > version]
+
+    def snapshot(self):
+        """
+        The public list of every node as it is now.
+        :rtype: RegistrySnapshot
+        """
+        snapshot = self._snapshot
+        if snapshot.version == self.version:
+            return snapshot
+        with self.lock:
+            version = self.version
+            public = tuple(self._public)
+        snapshot = RegistrySnapshot(version, public, tuple(sorted(public)))
+        if version > self._snapshot.version:
+            self._snapshot = snapshot
+        return snapshot
+
+    def find(self, prefix, limit):
+        """
+        Finds public clients of every node whose userID starts with prefix (see RegistrySnapshot.find()).
+        :rtype: list[str]
+        """
+        return self.snapshot().find(prefix, limit)
+
+    def public_snapshot(self):
+        """
+        The userIDs of public clients of every node, in the order they became public here, along with the version of
+        the list.
+        :rtype: tuple[int,tuple[str]]
+        """
+        snapshot = self.snapshot()
+        return snapshot.version, snapshot.public
+
+
+class PeerLinks:
+    """
+    The connections to the other nodes, keyed by node name, with the same send() as workers.WorkerLinks so that
+    workers.RemoteChannel can pass messages to clients of other nodes.
+
+    Each node connects to every peer it was given and only ever sends over those connections; what it receives comes in
+    over the connections the peers made to it. The engine makes the connections and hands each one over to connected().
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.node = directory.node
+        self.lock = threading.Lock()  # keeps each push of changes and the message it goes ahead of together
+        self.channels = {}  # node -> channel to it
+        self._pushed = {}  # node -> the number of the last of this node's changes sent to it
+
+    def connected(self, node, channel):
+        """
+        Starts sending to a node over a new connection; every change of this node's goes to it again.
+        :rtype: None
+        """
+        with self.lock:
+            self.channels[node] = channel
+            self._pushed[node] = 0
+
+    def lost(self, node, channel):
+        """
+        Stops sending to a node whose connection has gone, unless a newer one has taken its place.
+        :rtype: None
+        """
+        with self.lock:
+            if self.channels.get(node) is channel:
+                del self.channels[node]
+
+    def send(self, node, message):
+        """
+        Sends a message to another node, after any changes of this node's it has not been sent yet.
+        :param node: the other node's name
+        :type node: str
+        :param message: what to send; "op" says what it is
+        :type message: dict
+        :rtype: None
+        """
+        with self.lock:
+            channel = self.channels.get(node)
+            if channel is None:
+                raise ConnectionError("no link to node " + node)
+            self._push(node, channel)
+            channel.send(2, self.node, json.dumps(message))
+
+    def push(self):
+        """
+        Pushes this node's new changes to every peer.
+        :rtype: None
+        """
+        with self.lock:
+            for node, channel in list(self.channels.items()):
+                try:
+                    self._push(node, channel)
+                except OSError:
+                    pass  # its connection is going; the reconnection sends everything again
+
+    def _push(self, node, channel):
+        changes, reset, counter = self.directory.own_changes(self._pushed[node])
+        if reset:
+            # a reset must come whole, so it is not split up
+            channel.send(2, self.node, json.dumps({"op": "changes", "changes": changes, "reset": reset}))
+        else:
+            for start in range(0, len(changes), MAX_CHANGES):
+                channel.send(2, self.node, json.dumps({"op": "changes", "changes": changes[start:start + MAX_CHANGES]}))
+        self._pushed[node] = counter
+
+    def gossip(self, node=None):
+        """
+        Sends this node's version vector to a peer, by default one picked at random, starting an exchange of whatever
+        either of them is missing.
+        :rtype: None
+        """
+        if node is None:
+            nodes = list(self.channels)
+            if not nodes:
+                return
+            node = random.choice(nodes)
+        try:
+            self.send(node, {"op": "digest", "vector": self.directory.vector()})
+        except OSError:
+            pass
+
+    def receive(self, node, message):
+        """
+        Acts on a message from another node if it is gossip; anything else is returned for the server to act on, with
+        every userID in it turned from how that node knows them into how this one does.
+        :param node: the node it came from
+        :type node: str
+        :param message: the decoded message; "op" says what it is
+        :type message: dict
+        :rtype: dict or None if there is nothing left to do
+        """
+        op = message["op"]
+        if op == "digest":
+            self.directory.merge(message["vector"], node)
+            self._answer(node, message["vector"], ask=True)
+        elif op == "changes":
+            if "vector" in message:
+                self.directory.merge(message["vector"], node)
+            self.directory.apply(message["changes"], message.get("reset", ()))
+            if message.get("ask"):
+                self._answer(node, message["vector"], ask=False)
+        else:
+            for key in ("user_id", "partner_id"):
+                if key in message:
+                    message[key] = self.localize(node, message[key])
+            if "command" in message:
+                # the commands forwarded are all "<COMMAND> <userID>"
+                command, _, user_id = message["command"].partition(" ")
+                if user_id:
+                    message["command"] = command + " " + self.localize(node, user_id.strip())
+            return message
+        return None
+
+    def _answer(self, node, vector, ask):
+        # sends a node the changes its vector shows it is missing
+        changes, reset = self.directory.missing(vector)
+        try:
+            self.send(node, {"op": "changes", "changes": changes, "reset": reset,
+                             "vector": self.directory.vector(), "ask": ask})
+        except OSError:
+            pass  # not connected to them yet; the next round will do
+
+    def localize(self, node, user_id):
+        """
+        :param node: the node a userID came from
+        :type node: str
+        :param user_id: the userID as that node knows them
+        :type user_id: str
+        :rtype: str (the userID as this node knows them)
+        """
+        name, at, home = user_id.rpartition("@")
+        if not at:
+            return user_id + "@" + node
+        return name if home == self.node else user_id
@@ -0,0 +1,365 @@
+"""
+filetransfer.py - Sending files between two clients in a chat, over TCP connections of their own
+
+A client offers a file through the chat (see KudzaiClient.offer_file()), and serves it from a port of its own. The
+offer carries the file's name and size, the port, and a token the receiver must present, so nobody else can fetch it.
+
+The receiver connects, presents the token, and sends requests, each one a fixed header:
+
+    kind (1) | offset (8) | length (8)
+
+MANIFEST asks for the file's size, chunk size and the CRC-32 of every chunk, sent back as JSON after a 4 byte length.
+RANGE asks for length bytes from offset, which the sender writes straight from the file to the socket with
+os.sendfile(), so they never pass through Python. DONE says the receiver has the whole file.
+
+The receiver preallocates the file, maps it into memory, and reads every range straight into the mapping. It fetches
+one chunk per request, over several connections at once, and checks each chunk against its CRC, asking for it again if
+it does not match. Every chunk that checks out is written down in a progress file next to the partial one, so a
+transfer that is cut off carries on from where it got to the next time the same file is offered.
+"""
+import json
+import mmap
+import os
+import secrets
+import socket
+import struct
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+
+CHUNK_SIZE = 8 * 1024 * 1024  # bytes checked, recorded and asked for at a time
+STREAMS = 4  # connections a file is fetched over at once
+CHUNK_ATTEMPTS = 3  # times a chunk is asked for before giving up on it
+FILE_OFFER_PREFIX = "\x00FILE_OFFER "  # starts a chat message offering a file; nobody can type it
+
+REQUEST = struct.Struct("!BQQ")  # kind, offset, length
+LENGTH = struct.Struct("!I")
+MANIFEST = 0
+RANGE = 1
+DONE = 2
+
+TransferReport = namedtuple("TransferReport", "size received resumed resent seconds streams")
+
+
+class TransferError(Exception):
+    """Raised when a file cannot be fetched whole, e.g. a chunk never matches its checksum."""
+
+
+def recv_exactly(sock, count):
+    """
+    :rtype: bytes (count bytes, or fewer if the connection closed first)
+    """
+    data = bytearray()
+    while len(data) < count:
+        more = sock.recv(count - len(data))
+        if not more:
+            break
+        data += more
+    return bytes(data)
+
+
+def recv_into_exactly(sock, view):
+    """
+    Fills a buffer from a socket.
+    :param view: where the bytes go
+    :type view: memoryview
+    :rtype: None
+    :raises ConnectionError: if the connection closes first
+    """
+    while len(view):
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("connection closed in the middle of a chunk")
+        view = view[received:]
+
+
+def chunk_checksums(path, chunk_size=CHUNK_SIZE):
+    """
+    :param path: the file
+    :type path: str
+    :param chunk_size: bytes per chunk; the last one may be shorter
+    :type chunk_size: int
+    :rtype: list[int] (the CRC-32 of every chunk)
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            return [zlib.crc32(view[start:start + chunk_size]) for start in range(0, size, chunk_size)]
+
+
+class FileServer:
+    """
+    Serves one file to whoever presents the token, until they say they have all of it or it is closed.
+    """
+
+    def __init__(self, path, host="", chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.token = secrets.token_hex(16)
+        self.sock = socket.create_server((host, 0))
+        self.port = self.sock.getsockname()[1]
+        self.done = threading.Event()  # set once the receiver has the whole file
+        self.bytes_sent = 0
+        self.started = None  # the time.perf_counter() the first range was asked for
+        self.finished = None
+        self._manifest = None
+        self._lock = threading.Lock()
+
+    def offer(self):
+        """
+        What the receiver needs to know to fetch the file.
+        :rtype: dict
+        """
+        return {"name": os.path.basename(self.path), "size": self.size, "port": self.port, "token": self.token}
+
+    def start(self):
+        """
+        Serves the file from a thread of its own.
+        :rtype: None
+        """
+        threading.Thread(target=self._accept_forever, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+    def report(self):
+        """
+        :rtype: str (how much was sent and how fast)
+        """
+        seconds = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        return format_rate(self.bytes_sent, seconds)
+
+    def _accept_forever(self):
+        while True:
+            try:
+                connection, address = self.sock.accept()
+            except OSError:
+                return  # closed
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        try:
+            with connection, open(self.path, "rb") as file:
+                self._serve_requests(connection, file)
+        except (OSError, TransferError):
+            pass  # the receiver went away, or the file changed; a receiver that comes back asks for what it is missing
+
+    def _serve_requests(self, connection, file):
+        if not secrets.compare_digest(recv_exactly(connection, len(self.token)), self.token.encode()):
+            return
+        while True:
+            header = recv_exactly(connection, REQUEST.size)
+            if len(header) < REQUEST.size:
+                return
+            kind, offset, length = REQUEST.unpack(header)
+            if kind == MANIFEST:
+                manifest = json.dumps(self.manifest()).encode()
+                connection.sendall(LENGTH.pack(len(manifest)) + manifest)
+            elif kind == RANGE and offset + length <= self.size:
+                with self._lock:
+                    if self.started is None:
+                        self.started = time.perf_counter()
+                self.send_range(connection, file, offset, length)
+                with self._lock:
+                    self.bytes_sent += length
+            elif kind == DONE:
+                self.finished = time.perf_counter()
+                self.done.set()
+                return
+            else:
+                return
+
+    def send_range(self, connection, file, offset, length):
+        """
+        Writes part of the file to a connection, from the kernel's page cache straight to the socket where the
+        platform allows.
+        :rtype: None
+        """
+        if not hasattr(os, "sendfile"):
+            connection.sendfile(file, offset, length)
+            return
+        end = offset + length
+        while offset < end:
+            sent = os.sendfile(connection.fileno(), file.fileno(), offset, end - offset)
+            if not sent:
+                raise TransferError("the file got shorter while it was being sent")
+            offset += sent
+
+    def manifest(self):
+        """
+        The file's size, chunk size and chunk checksums, worked out the first time they are asked for.
+        :rtype: dict
+        """
+        with self._lock:
+            if self._manifest is None:
+                self._manifest = {"size": self.size, "chunk_size": self.chunk_size,
+                                  "checksums": chunk_checksums(self.path, self.chunk_size)}
+            return self._manifest
+
+
+def connect(host, port, token):
+    """
+    :rtype: socket.socket (a connection to a FileServer that has been given the token)
+    """
+    sock = socket.create_connection((host, port))
+    sock.sendall(token.encode())
+    return sock
+
+
+def download_path(directory, name):
+    """
+    Where to save a file offered under name: the partial file of an earlier try at it, or else a name not yet taken.
+    :rtype: str
+    """
+    base, extension = os.path.splitext(os.path.basename(name) or "received")
+    path = os.path.join(directory, base + extension)
+    copy = 0
+    while os.path.exists(path) and not os.path.exists(path + ".part"):
+        copy += 1
+        path = os.path.join(directory, base + " (" + str(copy) + ")" + extension)
+    return path
+
+
+def receive_file(host, port, token, path, streams=STREAMS):
+    """
+    Fetches a file a FileServer is serving, carrying on from the chunks an earlier try left in path's partial file.
+    :param host: the sender's address
+    :type host: str
+    :param port: the port the sender is serving the file on
+    :type port: int
+    :param token: the token from the offer
+    :type token: str
+    :param path: where to save the file
+    :type path: str
+    :param streams: connections to fetch it over at once
+    :type streams: int
+    :rtype: TransferReport
+    :raises OSError: if a connection fails; trying again resumes
+    :raises TransferError: if a chunk never matches its checksum
+    """
+    started = time.perf_counter()
+    connections = [connect(host, port, token)]
+    try:
+        connections[0].sendall(REQUEST.pack(MANIFEST, 0, 0))
+        length, = LENGTH.unpack(recv_exactly(connections[0], LENGTH.size))
+        manifest = json.loads(recv_exactly(connections[0], length))
+        size, chunk_size, checksums = manifest["size"], manifest["chunk_size"], manifest["checksums"]
+        part, progress = path + ".part", path + ".progress"
+        fingerprint = "%d:%d:%08x" % (size, chunk_size, zlib.crc32(json.dumps(checksums).encode()))
+        done = load_progress(progress, fingerprint, part, size)
+        todo = deque(index for index in range(len(checksums)) if index not in done)
+        while len(connections) < min(streams, len(todo)):
+            connections.append(connect(host, port, token))
+        with open(os.open(part, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as file, \
+                open(progress, "a" if done else "w") as record:
+            if not done:
+                record.write(fingerprint + "\n")
+            file.truncate(size)
+            if size and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(file.fileno(), 0, size)  # the disk space is set aside now, not found full halfway
+            totals = {"received": 0, "resent": 0}
+            if size:
+                with mmap.mmap(file.fileno(), size) as mapped:
+                    fetch_chunks(connections, mapped, chunk_size, checksums, todo, record, totals)
+                    mapped.flush()
+        connections[0].sendall(REQUEST.pack(DONE, 0, 0))
+    finally:
+        for connection in connections:
+            connection.close()
+    os.replace(part, path)
+    os.remove(progress)
+    return TransferReport(size, totals["received"], len(done), totals["resent"], time.perf_counter() - started,
+                          len(connections))
+
+
+def load_progress(progress, fingerprint, part, size):
+    """
+    :rtype: set[int] (the chunks an earlier try at the same file has in the partial file already)
+    """
+    try:
+        with open(progress) as file:
+            lines = file.read().split()
+    except OSError:
+        return set()
+    if not lines or lines[0] != fingerprint or not os.path.exists(part) or os.path.getsize(part) != size:
+        return set()
+    return {int(line) for line in lines[1:] if line.isdigit()}
+
+
+def fetch_chunks(connections, mapped, chunk_size, checksums, todo, record, totals):
+    """
+    Fetches the chunks in todo over every connection at once, each connection taking the next chunk as it finishes one.
+    :rtype: None
+    """
+    lock = threading.Lock()
+    failures = []
+    threads = [threading.Thread(target=fetch_chunks_over, args=(connection, mapped, chunk_size, checksums, todo,
+                                                                record, totals, lock, failures))
+               for connection in connections[1:]]
+    for thread in threads:
+        thread.start()
+    fetch_chunks_over(connections[0], mapped, chunk_size, checksums, todo, record, totals, lock, failures)
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+
+
+def fetch_chunks_over(connection, mapped, chunk_size, checksums, todo, record, totals, lock, failures):
+    # one connection's share of fetch_chunks()
+    size = len(mapped)
+    view = memoryview(mapped)
+    try:
+        while True:
+            with lock:
+                if not todo or failures:
+                    return
+                index = todo.popleft()
+            start = index * chunk_size
+            end = min(start + chunk_size, size)
+            for attempt in range(CHUNK_ATTEMPTS):
+                connection.sendall(REQUEST.pack(RANGE, start, end - start))
+                recv_into_exactly(connection, view[start:end])
+                if zlib.crc32(view[start:end]) == checksums[index]:
+                    break
+                with lock:
+                    totals["resent"] += 1
+            else:
+                raise TransferError("chunk " + str(index) + " never matched its checksum")
+            with lock:
+                # what is in the mapping outlives this process, so the chunk can be counted as soon as it checks out
+                record.write(str(index) + "\n")
+                record.flush()
+                totals["received"] += end - start
+    except Exception as error:
+        with lock:
+            # without its traceback, whose frames hold slices of the mapping that would stop it being closed
+            failures.append(error.with_traceback(None))
+    finally:
+        view.release()
+
+
+def format_rate(size, seconds):
+    """
+    :rtype: str (e.g. "1,024.0 MB in 2.10 s (487.6 MB/s)")
+    """
+    megabytes = size / 1e6
+    return f"{megabytes:,.1f} MB in {seconds:.2f} s ({megabytes / seconds if seconds else 0:,.1f} MB/s)"
+
+
+def format_report(report):
+    """
+    :param report: what receive_file() returned
+    :type report: TransferReport
+    :rtype: str
+    """
+    text = format_rate(report.received, report.seconds) + " over " + str(report.streams) + " connection(s)"
+    if report.resumed:
+        text += ", " + str(report.resumed) + " chunk(s) already received earlier"
+    if report.resent:
+        text += ", " + str(report.resent) + " chunk(s) fetched again after a bad checksum"
+    return text
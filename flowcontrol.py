@@ -0,0 +1,227 @@
+"""
+flowcontrol.py - Keeping one slow or chatty client from holding up everyone else
+
+Messages for a client are put on its own bounded outbound queue and written out by a writer thread of its own, so
+nothing that sends to a client (its own handler, another client's CONNECT_TO, the presence publisher) ever waits for
+that client to read. While the socket takes everything straight away, which is nearly always, the message is written
+without waiting and the queue stays empty; the writer thread is only started the first time a message has to wait, so
+a client that keeps up costs no thread besides its handler. Once a client has more than the high water mark queued,
+the server stops reading its commands until the queue drains to the low water mark; a client that lets its queue fill
+up altogether is disconnected.
+
+Token buckets limit how fast a client may send commands, both overall and per command.
+"""
+import socket
+import threading
+import time
+from collections import deque
+from socket import SHUT_RDWR
+
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)  # 0 where there is no such flag, and every message goes on the queue
+
+HIGH_WATER = 1024 * 1024  # bytes queued for a client before its commands stop being read
+LOW_WATER = 256 * 1024  # bytes queued for a client before its commands are read again
+QUEUE_LIMIT = 8 * 1024 * 1024  # bytes queued for a client before it is disconnected as too slow
+WRITE_BATCH = 64 * 1024  # most bytes of queued messages joined into one write
+# messages averaging this many bytes are written with one sendmsg rather than copied into one buffer first; copying
+# smaller ones is cheaper than the extra work sendmsg does per buffer
+VECTOR_ABOVE = 16 * 1024
+
+
+class SlowConsumer(ConnectionError):
+    """Raised when a message is sent to a client whose outbound queue is full."""
+
+
+class OutboundQueue:
+    """
+    The messages waiting to be written to one socket, and the thread that writes them.
+    """
+    __slots__ = ("sock", "high_water", "low_water", "limit", "coalesce", "queued", "written", "overflowed", "_messages",
+                 "_closed", "_condition", "_writer")
+
+    def __init__(self, sock, high_water=HIGH_WATER, low_water=LOW_WATER, limit=QUEUE_LIMIT, coalesce=True):
+        """
+        :param sock: the connected socket to write to
+        :type sock: socket.socket
+        :param high_water: bytes queued before wait_until_drained() starts waiting
+        :type high_water: int
+        :param low_water: bytes queued once wait_until_drained() stops waiting
+        :type low_water: int
+        :param limit: bytes queued before put() gives up on the client
+        :type limit: int
+        :param coalesce: write several queued messages at once; legacy text clients need one message per write
+        :type coalesce: bool
+        """
+        self.sock = sock
+        self.high_water = high_water
+        self.low_water = low_water
+        self.limit = limit
+        self.coalesce = coalesce
+        self.queued = 0  # bytes waiting to be written
+        self.written = 0
+        self.overflowed = False  # True once the client was disconnected for letting the queue fill up
+        self._messages = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer = None  # the writer thread, once a message has had to wait for one
+
+    def put(self, data):
+        """
+        Queues an encoded message for writing. A single message is always accepted by an empty queue, whatever its size.
+        :param data: the encoded message
+        :type data: bytes
+        :rtype: None
+        """
+        with self._condition:
+            if self._closed:
+                raise ConnectionError("connection closed")
+            if self.queued and self.queued + len(data) > self.limit:
+                self.overflowed = True
+                self._shut()
+                raise SlowConsumer("outbound queue full")
+            if not self.queued and MSG_DONTWAIT:
+                # nothing is queued or being written, so this can go straight out if the socket has room for it
+                try:
+                    sent = self.sock.send(data, MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self._shut()  # the client's handler finds its socket shut and cleans up
+                    return
+                self.written += sent
+                if sent == len(data):
+                    return
+                data = data[sent:]
+            self._messages.append(data)
+            self.queued += len(data)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, daemon=True)
+                self._writer.start()
+            self._condition.notify_all()
+
+    def wait_until_drained(self):
+        """
+        Waits, if more than the high water mark is queued, until no more than the low water mark is.
+        :rtype: bool (True if it had to wait)
+        """
+        with self._condition:
+            if self.queued <= self.high_water:
+                return False
+            self._condition.wait_for(lambda: self.queued <= self.low_water or self._closed)
+            return True
+
+    def close(self):
+        """
+        Drops whatever is still queued and stops the writer.
+        :rtype: None
+        """
+        with self._condition:
+            self._closed = True
+            self._messages.clear()
+            self.queued = 0
+            self._condition.notify_all()
+
+    def _shut(self):
+        # called with the lock held; the client's handler finds its socket shut and cleans up
+        self._closed = True
+        self._messages.clear()
+        self.queued = 0
+        self._condition.notify_all()
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._messages or self._closed)
+                if self._closed:
+                    return
+                batch = [self._messages.popleft()]
+                size = len(batch[0])
+                while self.coalesce and self._messages and size + len(self._messages[0]) <= WRITE_BATCH:
+                    size += len(self._messages[0])
+                    batch.append(self._messages.popleft())
+            try:
+                if len(batch) == 1:
+                    self.sock.sendall(batch[0])
+                elif size >= VECTOR_ABOVE * len(batch) and hasattr(self.sock, "sendmsg"):
+                    send_vectored(self.sock, batch)
+                else:
+                    self.sock.sendall(b"".join(batch))
+            except OSError:
+                with self._condition:
+                    self._shut()
+                return
+            with self._condition:
+                if not self._closed:
+                    self.queued -= size
+                self.written += size
+                if self.queued <= self.low_water:
+                    self._condition.notify_all()
+
+
+def send_vectored(sock, buffers):
+    """
+    Writes several buffers, in order, without joining them into one first.
+    :param sock: a blocking socket
+    :type sock: socket.socket
+    :param buffers: what to write
+    :type buffers: list[bytes]
+    :rtype: None
+    """
+    buffers = list(buffers)
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+class TokenBucket:
+    """
+    Allows rate events a second on average, and bursts of up to burst at once. Not thread safe; each client's buckets
+    are only used by that client's own handler.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added a second
+        :type rate: float
+        :param burst: the most tokens the bucket holds; twice the rate, and at least 1, if not given
+        :type burst: float
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(2 * rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """
+        Takes a token if there is one.
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: float (0 if a token was taken, otherwise seconds until there will be one)
+        """
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def parse_rate(text):
+    """
+    Reads a rate given as "RATE" or "RATE:BURST".
+    :param text: e.g. "20" or "0.5:3"
+    :type text: str
+    :rtype: tuple[float,float] (rate, burst or None)
+    """
+    rate, _, burst = text.partition(":")
+    return float(rate), float(burst) if burst else None
@@ -0,0 +1,176 @@
+"""
+handshakes.py - Connection requests that are waiting for an answer
+
+A CONNECT_TO used to hold the requestor's handler until the requested client typed Y or N. Now the request is written
+down here and the handler moves on; the answer is picked up later by the requested client's own handler, and requests
+nobody answers expire.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConnectionRequest:
+    """
+    One client asking to chat with another.
+    """
+    __slots__ = ("requestor_id", "requested_id", "request_id", "expires_at")
+
+    def __init__(self, requestor_id, requested_id, request_id, expires_at):
+        self.requestor_id = requestor_id
+        self.requested_id = requested_id
+        self.request_id = request_id  # the request ID of the requestor's CONNECT_TO, for tagging the eventual answer
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return f"ConnectionRequest({self.requestor_id!r} -> {self.requested_id!r})"
+
+
+class PendingRequests:
+    """
+    The table of unanswered connection requests, keyed by (requestor, requested).
+
+    Every request lives for the same timeout, so the table's insertion order is also its expiry order and expiring
+    requests only ever looks at the ones that are actually due.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout  # seconds a request waits for an answer
+        self.lock = threading.Lock()
+        self._requests = OrderedDict()  # (requestor_id, requested_id) -> ConnectionRequest, oldest first
+        self._waiting_on = {}  # requested_id -> {requestor_id: ConnectionRequest}, oldest first
+        self._made_by = {}  # requestor_id -> set of requested_ids
+
+    def __len__(self):
+        return len(self._requests)
+
+    def add(self, requestor_id, requested_id, request_id=0, now=None):
+        """
+        Records a new connection request.
+        :param requestor_id: the userID of the client requesting to speak to someone
+        :type requestor_id: str
+        :param requested_id: the userID of the client being requested for a chat
+        :type requested_id: str
+        :param request_id: the request ID of the requestor's CONNECT_TO
+        :type request_id: int
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: ConnectionRequest or None if the same request is already waiting
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if (requestor_id, requested_id) in self._requests:
+                return None
+            request = ConnectionRequest(requestor_id, requested_id, request_id, now + self.timeout)
+            self._requests[(requestor_id, requested_id)] = request
+            self._waiting_on.setdefault(requested_id, {})[requestor_id] = request
+            self._made_by.setdefault(requestor_id, set()).add(requested_id)
+        return request
+
+    def waiting_on(self, requested_id):
+        """
+        Whether a client has requests waiting for their answer.
+        :param requested_id: The userID of a client
+        :type requested_id: str
+        :rtype: bool
+        """
+        return requested_id in self._waiting_on
+
+    def requestors_of(self, requested_id):
+        """
+        Who is waiting for a client's answer, oldest request first.
+        :param requested_id: The userID of a client
+        :type requested_id: str
+        :rtype: list[str]
+        """
+        with self.lock:
+            return list(self._waiting_on.get(requested_id, ()))
+
+    def involves(self, user_id):
+        """
+        Whether a client has made, or been sent, a request that is still waiting.
+        :param user_id: The userID of a client
+        :type user_id: str
+        :rtype: bool
+        """
+        return user_id in self._waiting_on or user_id in self._made_by
+
+    def answer(self, requested_id, requestor_id=None):
+        """
+        Takes the request a client is answering off the table.
+        :param requested_id: the userID of the client answering
+        :type requested_id: str
+        :param requestor_id: who they are answering, or None for whoever asked first
+        :type requestor_id: str
+        :rtype: ConnectionRequest or None if there was nothing to answer
+        """
+        with self.lock:
+            waiting = self._waiting_on.get(requested_id)
+            if not waiting:
+                return None
+            if requestor_id is None:
+                requestor_id = next(iter(waiting))
+            elif requestor_id not in waiting:
+                return None
+            return self._remove(self._requests[(requestor_id, requested_id)])
+
+    def cancel(self, requestor_id, requested_id):
+        """
+        Takes back a request before it is answered.
+        :param requestor_id: the userID of the client that made the request
+        :type requestor_id: str
+        :param requested_id: the userID of the client that was asked
+        :type requested_id: str
+        :rtype: ConnectionRequest or None if there was no such request
+        """
+        with self.lock:
+            request = self._requests.get((requestor_id, requested_id))
+            if request is None:
+                return None
+            return self._remove(request)
+
+    def expire(self, now=None):
+        """
+        Takes every request that has waited too long off the table.
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: list[ConnectionRequest]
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self._requests:
+                request = next(iter(self._requests.values()))
+                if request.expires_at > now:
+                    break
+                expired.append(self._remove(request))
+        return expired
+
+    def drop_user(self, user_id):
+        """
+        Takes every request made by or to a client off the table, for when they leave.
+        :param user_id: The userID of the client
+        :type user_id: str
+        :rtype: list[ConnectionRequest]
+        """
+        with self.lock:
+            requests = list(self._waiting_on.get(user_id, {}).values())
+            requests += [self._requests[(user_id, requested_id)] for requested_id in self._made_by.get(user_id, ())]
+            for request in requests:
+                self._remove(request)
+        return requests
+
+    def _remove(self, request):
+        # always called with the lock held
+        del self._requests[(request.requestor_id, request.requested_id)]
+        waiting = self._waiting_on[request.requested_id]
+        del waiting[request.requestor_id]
+        if not waiting:
+            del self._waiting_on[request.requested_id]
+        made = self._made_by[request.requestor_id]
+        made.discard(request.requested_id)
+        if not made:
+            del self._made_by[request.requestor_id]
+        return request
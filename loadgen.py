@@ -0,0 +1,373 @@
+"""
+loadgen.py - Headless load generator for Server.py
+
+Simulates many clients on loopback, each one joining and then running a weighted mix of commands back to back. Bots
+answer the connection requests they are sent with a scripted Y or N, and a bot that ends up in a chat reconnects so
+it is available again. Throughput and latency percentiles are reported per command, and --json writes them out for
+comparing one version of the server with another (--compare prints the comparison). --processes runs the bots from
+several processes, for servers with more cores than one process of bots can keep busy (see Server.py --workers).
+
+Usage: python loadgen.py [host] [port] [--clients N] [--duration S] [--mix COMMAND=WEIGHT,...] [--start-server]
+                         [--processes N]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from socket import socket, AF_INET, SOCK_STREAM
+from KudzaiClient import ServerConnection, open_channel
+
+DEFAULT_MIX = "LIST_CLIENTS=40,FIND=20,VISIBILITY=20,CONNECT_TO=10,TERMINATE=10"
+COMMANDS = ["LIST_CLIENTS", "FIND", "VISIBILITY", "CONNECT_TO", "TERMINATE", "STATS"]
+REPLY_TIMEOUT = 30  # a CONNECT_TO waits for the other bot to answer
+
+
+def parse_mix(text):
+    """
+    Reads a command mix such as "LIST_CLIENTS=40,CONNECT_TO=10".
+    :param text: comma separated COMMAND=WEIGHT pairs
+    :type text: str
+    :rtype: dict[str, float]
+    """
+    mix = {}
+    for pair in text.split(","):
+        command, weight = pair.split("=")
+        command = command.strip().upper()
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError("unknown command in mix: " + command)
+        mix[command] = float(weight)
+    return mix
+
+
+def percentile(samples, fraction):
+    """
+    :param samples: sorted latencies
+    :type samples: list[float]
+    :param fraction: 0.5 for the median, 0.99 for p99 and so on
+    :type fraction: float
+    :rtype: float
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Recorder:
+    """
+    Collects the latency of every command every bot runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # command -> [seconds]
+        self.errors = {}  # command -> count
+        self.outcomes = {}  # "CONNECT_TO accepted" and the like -> count
+
+    def record(self, command, seconds):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(seconds)
+
+    def error(self, command):
+        with self.lock:
+            self.errors[command] = self.errors.get(command, 0) + 1
+
+    def outcome(self, name):
+        with self.lock:
+            self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+    def merge(self, latencies, errors, outcomes):
+        """
+        Adds in what another process's recorder collected.
+        :rtype: None
+        """
+        with self.lock:
+            for command, samples in latencies.items():
+                self.latencies.setdefault(command, []).extend(samples)
+            for command, count in errors.items():
+                self.errors[command] = self.errors.get(command, 0) + count
+            for name, count in outcomes.items():
+                self.outcomes[name] = self.outcomes.get(name, 0) + count
+
+    def summary(self, elapsed):
+        """
+        :param elapsed: seconds the load ran for
+        :type elapsed: float
+        :rtype: dict
+        """
+        commands = {}
+        for command in sorted(set(self.latencies) | set(self.errors)):
+            samples = sorted(self.latencies.get(command, []))
+            commands[command] = {
+                "count": len(samples),
+                "errors": self.errors.get(command, 0),
+                "throughput": len(samples) / elapsed,
+                "mean_ms": sum(samples) / len(samples) * 1000 if samples else 0.0,
+                "p50_ms": percentile(samples, 0.5) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+                "p999_ms": percentile(samples, 0.999) * 1000,
+                "max_ms": samples[-1] * 1000 if samples else 0.0,
+            }
+        total = sum(len(samples) for samples in self.latencies.values())
+        return {"elapsed": elapsed, "operations": total, "throughput": total / elapsed,
+                "commands": commands, "outcomes": dict(self.outcomes)}
+
+
+class Bot:
+    """
+    One headless client.
+    """
+
+    def __init__(self, number, names, options, recorder, stop_at):
+        self.name = names[number]
+        self.names = names
+        self.options = options
+        self.recorder = recorder
+        self.stop_at = stop_at
+        self.random = random.Random(options.seed * 100003 + number)
+        self.mix = list(options.mix.items())
+        self.public = True
+        self.server = None
+        self.in_chat = threading.Event()  # set once the server has paired this bot with another one
+
+    def run(self):
+        try:
+            self.join()
+            while time.monotonic() < self.stop_at:
+                if self.in_chat.is_set():
+                    self.rejoin("chat")
+                    continue
+                command = self.random.choices([c for c, w in self.mix], [w for c, w in self.mix])[0]
+                getattr(self, command.lower())()
+        except Exception as error:
+            self.recorder.error("BOT")
+            print(self.name + " stopped: " + repr(error), file=sys.stderr)
+        finally:
+            if self.server is not None:
+                # say goodbye rather than just hanging up, or the server keeps the session in case the bot resumes it
+                # and other bots' requests to this one go unanswered until they expire
+                self.server.request("TERMINATE")
+                self.server.close()
+
+    def join(self):
+        # timed until the server has taken the bot on, not just until the hello is sent
+        start = time.perf_counter()
+        channel = open_channel(self.options.host, self.options.port, self.name, 1)
+        self.public = True
+        self.in_chat.clear()
+        self.server = ServerConnection(channel, self.name)
+        if not self.server.wait_joined(REPLY_TIMEOUT):
+            self.recorder.error("JOIN")
+            raise ConnectionRefusedError("the server did not take " + self.name + " on")
+        self.recorder.record("JOIN", time.perf_counter() - start)
+        threading.Thread(target=self.answer_pushes, args=(self.server,), daemon=True).start()
+
+    def rejoin(self, reason):
+        """
+        Says goodbye and joins again under the same name.
+        """
+        server = self.server
+        start = time.perf_counter()
+        try:
+            server.request("TERMINATE").result(REPLY_TIMEOUT)
+            self.recorder.record("TERMINATE", time.perf_counter() - start)
+        except Exception:
+            self.recorder.error("TERMINATE")
+        server.close()
+        self.server = None
+        self.recorder.outcome("rejoin after " + reason)
+        self.join()
+
+    def answer_pushes(self, server):
+        while True:
+            push = server.pushes.get()
+            if push is None:
+                return
+            message_type, user_id, message = push
+            if message_type == 4:
+                requestor = message.split()[0]
+                accept = self.random.random() < self.options.accept
+                try:
+                    server.send(1, ("Y " if accept else "N ") + requestor)
+                except OSError:
+                    return  # this bot has just said goodbye
+                self.recorder.outcome("requests answered " + ("Y" if accept else "N"))
+            elif message_type == 1 and "address: " in message and server is self.server:
+                self.in_chat.set()
+
+    def timed(self, command, text):
+        start = time.perf_counter()
+        try:
+            reply = self.server.request(text).result(REPLY_TIMEOUT)
+        except Exception:
+            self.recorder.error(command)
+            return None
+        self.recorder.record(command, time.perf_counter() - start)
+        return reply
+
+    def list_clients(self):
+        self.timed("LIST_CLIENTS", "LIST_CLIENTS")
+
+    def find(self):
+        name = self.random.choice(self.names)
+        self.timed("FIND", "FIND " + name[:max(1, len(name) - 2)])
+
+    def visibility(self):
+        self.public = not self.public
+        self.timed("VISIBILITY", "VISIBILITY " + ("public" if self.public else "private"))
+
+    def connect_to(self):
+        other = self.random.choice(self.names)
+        if other == self.name:
+            return
+        reply = self.timed("CONNECT_TO", "CONNECT_TO " + other)
+        if reply is None:
+            return
+        message_type, user_id, message = reply
+        if message_type == 1 and "address: " in message:
+            self.recorder.outcome("CONNECT_TO accepted")
+            self.in_chat.set()
+        else:
+            self.recorder.outcome("CONNECT_TO refused")
+
+    def stats(self):
+        self.timed("STATS", "STATS")
+
+    def terminate(self):
+        self.rejoin("TERMINATE")
+
+
+def run_bots(numbers, names, options, recorder, stop_at):
+    """
+    Runs some of the bots, each on a thread of its own, until they stop.
+    :param numbers: which bots
+    :type numbers: range
+    :rtype: None
+    """
+    threads = [threading.Thread(target=Bot(i, names, options, recorder, stop_at).run) for i in numbers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_bots_in_process(numbers, names, options, stop_at, results):
+    """
+    Runs some of the bots in a process of their own, and sends back what they recorded.
+    :param results: where to put the recorder's latencies, errors and outcomes
+    :type results: multiprocessing.Queue
+    :rtype: None
+    """
+    recorder = Recorder()
+    run_bots(numbers, names, options, recorder, stop_at)
+    results.put((recorder.latencies, recorder.errors, recorder.outcomes))
+
+
+def start_server(options):
+    """
+    Starts Server.py on a free loopback port, for runs that should not depend on a server someone left running.
+    :rtype: subprocess.Popen
+    """
+    probe = socket(AF_INET, SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    options.host, options.port = probe.getsockname()
+    probe.close()
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Server.py")  # wherever this is run from
+    arguments = [sys.executable, server, options.host, str(options.port)] + options.server_args.split()
+    process = subprocess.Popen(arguments, stdout=subprocess.DEVNULL)
+    for attempt in range(100):
+        try:
+            socket(AF_INET, SOCK_STREAM).connect((options.host, options.port))
+            time.sleep(0.1)  # let the server finish with the probe connection
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    sys.exit("the server did not start")
+
+
+def print_summary(summary):
+    print(f"{summary['operations']:,} operations in {summary['elapsed']:.1f} s ({summary['throughput']:,.0f}/s)\n")
+    print(f"{'command':<14}{'count':>9}{'errors':>8}{'per s':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for command, row in summary["commands"].items():
+        print(f"{command:<14}{row['count']:>9,}{row['errors']:>8,}{row['throughput']:>10,.0f}{row['p50_ms']:>10.2f}"
+              f"{row['p99_ms']:>10.2f}{row['p999_ms']:>10.2f}{row['max_ms']:>10.2f}")
+    if summary["outcomes"]:
+        print()
+        for name, count in sorted(summary["outcomes"].items()):
+            print(f"{name:<30}{count:>9,}")
+
+
+def print_comparison(before, after):
+    print("\ncompared with the earlier run (ratio of this run to that one, below 1 is faster)")
+    print(f"{'command':<14}{'per s':>10}{'p50':>10}{'p99':>10}{'p999':>10}")
+    for command, row in after["commands"].items():
+        old = before["commands"].get(command)
+        if not old:
+            continue
+        ratios = [row[key] / old[key] if old[key] else float("nan")
+                  for key in ("throughput", "p50_ms", "p99_ms", "p999_ms")]
+        print(f"{command:<14}" + "".join(f"{ratio:>10.2f}" for ratio in ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates many headless clients against Server.py")
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=12000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the mix for")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="weights of each command, default " + DEFAULT_MIX)
+    parser.add_argument("--accept", type=float, default=0.5, help="fraction of connection requests answered Y")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=1, help="processes to run the bots from")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="a --json file from an earlier run to compare against")
+    parser.add_argument("--start-server", action="store_true", help="run Server.py on a free loopback port")
+    parser.add_argument("--server-args", default="", help="extra arguments for --start-server, e.g. --asyncio")
+    options = parser.parse_args()
+
+    server = start_server(options) if options.start_server else None
+    names = ["bot" + str(i) for i in range(options.clients)]
+    recorder = Recorder()
+    stop_at = time.monotonic() + options.duration
+    start = time.perf_counter()
+    if options.processes > 1:
+        # every process takes every processes'th bot, and the monotonic clock they stop by is the same in all of them
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_bots_in_process, args=(
+            range(first, options.clients, options.processes), names, options, stop_at, results))
+            for first in range(options.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            recorder.merge(*results.get())
+        for process in processes:
+            process.join()
+    else:
+        run_bots(range(options.clients), names, options, recorder, stop_at)
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.terminate()  # a server with --workers stops its workers when terminated, but not when killed
+        server.wait()
+
+    summary = recorder.summary(elapsed)
+    summary["config"] = {"clients": options.clients, "duration": options.duration, "mix": options.mix,
+                         "accept": options.accept, "seed": options.seed, "server_args": options.server_args,
+                         "processes": options.processes, "python": platform.python_version()}
+    print_summary(summary)
+    if options.compare:
+        with open(options.compare) as file:
+            print_comparison(json.load(file), summary)
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
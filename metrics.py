@@ -0,0 +1,214 @@
+"""
+metrics.py - Cheap counters and latency histograms for finding out where the server spends its time
+
+Histograms keep counts in fixed buckets that grow by a quarter of an octave (about 19%), from a microsecond up to a
+couple of minutes, so recording a sample is a bisect and an increment and percentiles are accurate to a bucket.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+BUCKET_BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(4 * 27)]  # seconds, 1 us up to about 134 s
+
+
+class Histogram:
+    """
+    Latencies in seconds, bucketed.
+    """
+    __slots__ = ("counts", "count", "total", "max", "_lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)  # the last bucket holds everything above the last bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        index = bisect_left(BUCKET_BOUNDS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        :param fraction: 0.5 for the median, 0.99 for p99 and so on
+        :type fraction: float
+        :rtype: float (the upper bound of the bucket the percentile falls in, in seconds)
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKET_BOUNDS[index], self.max) if index < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        """
+        :rtype: dict (count, and mean, p50, p99, p999 and max in milliseconds)
+        """
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "p999_ms": self.percentile(0.999) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class TimedLock:
+    """
+    Wraps a Lock or RLock and records how long threads wait for it. Taking a free lock costs one extra failed-or-not
+    non-blocking acquire; only waits that actually block are timed.
+    """
+
+    def __init__(self, lock, waits):
+        self._lock = lock
+        self.waits = waits  # Histogram of blocked acquires
+        self.acquisitions = 0  # only ever changed while holding the lock
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self._lock.acquire(False):
+            if not blocking:
+                return False
+            start = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            self.waits.record(time.perf_counter() - start)
+        self.acquisitions += 1
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ServerStats:
+    """
+    Everything the server measures about itself.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}  # command name -> Histogram of handling time
+        self.locks = {}  # lock name -> TimedLock
+        self.counters = {}  # event name -> how many times it happened
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.closed_bytes_in = 0  # traffic of connections that have gone, so totals survive them
+        self.closed_bytes_out = 0
+        self._lock = threading.Lock()
+
+    def command(self, name):
+        """
+        :param name: The command keyword
+        :type name: str
+        :rtype: Histogram
+        """
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands.setdefault(name, Histogram())
+        return histogram
+
+    def count(self, name):
+        """
+        Counts one occurrence of an event, such as a client being evicted.
+        :rtype: None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def timed_lock(self, name, lock):
+        """
+        Wraps a lock so the time spent waiting for it shows up under name.
+        :rtype: TimedLock
+        """
+        timed = TimedLock(lock, Histogram())
+        self.locks[name] = timed
+        return timed
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def connection_closed(self, connection):
+        """
+        :param connection: the channel of a client that has gone
+        :type connection: protocol.Channel or protocol.AsyncChannel
+        """
+        with self._lock:
+            self.connections_closed += 1
+            self.closed_bytes_in += connection.bytes_in
+            self.closed_bytes_out += connection.bytes_out
+
+    def snapshot(self, sessions, pending, top=10):
+        """
+        Puts everything measured so far into one dict.
+        :param sessions: the sessions of every connected client
+        :type sessions: list[registry.Session]
+        :param pending: how many connection requests are waiting for an answer
+        :type pending: int
+        :param top: how many of the busiest connections to list
+        :type top: int
+        :rtype: dict
+        """
+        states = {}
+        for session in sessions:
+            states[session.state] = states.get(session.state, 0) + 1
+        busiest = sorted(sessions, key=lambda s: s.connection.bytes_in + s.connection.bytes_out, reverse=True)[:top]
+        return {
+            "uptime": time.time() - self.started,
+            "sessions": len(sessions),
+            "session_states": states,
+            "pending_requests": pending,
+            "connections_opened": self.connections_opened,
+            "connections_closed": self.connections_closed,
+            "bytes_in": self.closed_bytes_in + sum(s.connection.bytes_in for s in sessions),
+            "bytes_out": self.closed_bytes_out + sum(s.connection.bytes_out for s in sessions),
+            "busiest_connections": [{"user_id": s.user_id, "bytes_in": s.connection.bytes_in,
+                                     "bytes_out": s.connection.bytes_out} for s in busiest],
+            "counters": dict(sorted(self.counters.items())),
+            "commands": {name: histogram.summary() for name, histogram in sorted(self.commands.items())},
+            "lock_waits": {name: dict(lock.waits.summary(), acquisitions=lock.acquisitions)
+                           for name, lock in sorted(self.locks.items())},
+        }
+
+
+def format_snapshot(snapshot):
+    """
+    Renders a snapshot as the text the STATS command replies with.
+    :param snapshot: what ServerStats.snapshot() returned
+    :type snapshot: dict
+    :rtype: str
+    """
+    lines = ["-------SERVER STATS-------",
+             f"uptime {snapshot['uptime']:.0f} s, {snapshot['sessions']} sessions "
+             + str(snapshot["session_states"]) + f", {snapshot['pending_requests']} pending requests",
+             f"connections opened {snapshot['connections_opened']}, closed {snapshot['connections_closed']}, "
+             f"bytes in {snapshot['bytes_in']:,}, bytes out {snapshot['bytes_out']:,}",
+             ", ".join(f"{name} {count}" for name, count in snapshot["counters"].items()),
+             "",
+             f"{'command':<16}{'count':>9}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}"]
+    for name, row in snapshot["commands"].items():
+        lines.append(f"{name:<16}{row['count']:>9}{row['mean_ms']:>10.3f}{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}"
+                     f"{row['p999_ms']:>10.3f}{row['max_ms']:>10.3f}")
+    lines += ["", f"{'lock':<16}{'taken':>9}{'waited':>9}{'p99 ms':>10}{'max ms':>10}"]
+    for name, row in snapshot["lock_waits"].items():
+        lines.append(f"{name:<16}{row['acquisitions']:>9}{row['count']:>9}{row['p99_ms']:>10.3f}{row['max_ms']:>10.3f}")
+    lines += ["", f"{'busiest clients':<16}{'bytes in':>12}{'bytes out':>12}"]
+    for row in snapshot["busiest_connections"]:
+        lines.append(f"{row['user_id']:<16}{row['bytes_in']:>12,}{row['bytes_out']:>12,}")
+    return "\n".join(lines) + "\n"
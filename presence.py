@@ -0,0 +1,153 @@
+"""
+presence.py - Pushing changes to the public list to clients that subscribe, instead of having them poll LIST_CLIENTS
+
+A subscriber first gets a snapshot of the list tagged with its version:
+
+    PRESENCE_SNAPSHOT <version>
+    <user_ID>
+    ...
+
+and after that, every so often, what changed since the version it was last brought up to:
+
+    PRESENCE_DELTA <from version> <to version>
+    +<user_ID who became public>
+    -<user_ID who left the list>
+
+Changes are gathered over a short window and netted out, so someone who joins and leaves within it is never
+mentioned. A subscriber whose version does not match the start of a delta has missed something, and subscribes again
+with the version it has; it is sent either the changes since then or, if those are no longer remembered, a snapshot.
+"""
+import threading
+
+SNAPSHOT = "PRESENCE_SNAPSHOT"
+DELTA = "PRESENCE_DELTA"
+
+
+def net_changes(changes):
+    """
+    Works out what a run of changes adds up to: a client made public and private again is left out.
+    :param changes: (version, "+" or "-", user_ID), oldest first
+    :type changes: list[tuple[int,str,str]]
+    :rtype: list[str] ("+user_ID" or "-user_ID", in the order the clients were first mentioned)
+    """
+    first = {}
+    last = {}
+    for version, change, user_id in changes:
+        first.setdefault(user_id, change)
+        last[user_id] = change
+    # a client whose first change was "-" was on the list before, and one whose last change was "+" is on it after
+    return [last[user_id] + user_id for user_id in first if (first[user_id] == "-") != (last[user_id] == "+")]
+
+
+def format_snapshot(version, user_ids):
+    return SNAPSHOT + " " + str(version) + "".join("\n" + user_id for user_id in user_ids)
+
+
+def format_delta(from_version, to_version, changes):
+    return DELTA + " " + str(from_version) + " " + str(to_version) + "".join("\n" + change for change in changes)
+
+
+class PresenceHub:
+    """
+    The server's list of presence subscribers and the version of the public list each one has been brought up to.
+    """
+
+    def __init__(self, registry, window=0.2):
+        self.registry = registry
+        self.window = window  # seconds changes are gathered for before they are pushed
+        self._subscribers = {}  # Session -> version of the public list it has been sent
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, session, version=None):
+        """
+        Adds a subscriber, or brings an existing one back in step.
+        :param session: the subscribing client's session
+        :type session: registry.Session
+        :param version: the version the client already has, if any
+        :type version: int
+        :rtype: str (the snapshot or delta to reply with)
+        """
+        with self._lock:
+            message, self._subscribers[session] = self._catch_up(version)
+        return message
+
+    def unsubscribe(self, session):
+        """
+        :rtype: bool (False if they were not subscribed)
+        """
+        with self._lock:
+            return self._subscribers.pop(session, None) is not None
+
+    def publish(self):
+        """
+        Works out what every subscriber that is behind needs to be sent. Subscribers at the same version share one
+        message.
+        :rtype: list[tuple[registry.Session,str]]
+        """
+        if not self._subscribers:
+            return []
+        deliveries = []
+        with self._lock:
+            current = self.registry.version
+            messages = {}  # version -> (message, version it brings the subscriber up to)
+            for session, version in self._subscribers.items():
+                if version == current:
+                    continue
+                if version not in messages:
+                    messages[version] = self._catch_up(version)
+                message, self._subscribers[session] = messages[version]
+                deliveries.append((session, message))
+        return deliveries
+
+    def _catch_up(self, version):
+        # called with the lock held
+        if version is not None:
+            changes = self.registry.changes_since(version)
+            if changes is not None:
+                to_version = version + len(changes)
+                return format_delta(version, to_version, net_changes(changes)), to_version
+        version, user_ids = self.registry.public_snapshot()
+        return format_snapshot(version, user_ids), version
+
+
+class PresenceView:
+    """
+    A client's copy of the public list, kept up to date from the snapshots and deltas the server pushes.
+    """
+
+    def __init__(self):
+        self.version = None  # None until the first snapshot arrives
+        self.users = {}  # user_IDs of public clients (values unused), in the order they became public
+
+    def apply(self, message):
+        """
+        Applies a snapshot or delta.
+        :param message: what the server sent
+        :type message: str
+        :rtype: bool (False if a delta did not follow on from this view's version, which means subscribing again with it)
+        """
+        lines = message.split("\n")
+        words = lines[0].split()
+        if words[0] == SNAPSHOT:
+            self.version = int(words[1])
+            self.users = dict.fromkeys(lines[1:])
+            return True
+        from_version, to_version = int(words[1]), int(words[2])
+        if self.version is None:
+            return True  # a delta overtook the snapshot it follows on from; the snapshot is on its way
+        if from_version != self.version:
+            return False
+        for change in lines[1:]:
+            if change[0] == "+":
+                self.users[change[1:]] = None
+            else:
+                self.users.pop(change[1:], None)
+        self.version = to_version
+        return True
+
+    @staticmethod
+    def is_presence(message):
+        return message.startswith(SNAPSHOT) or message.startswith(DELTA)
@@ -0,0 +1,902 @@
+"""
+protocol.py - The wire format shared by Server.py and KudzaiClient.py
+
+Every message is sent as a binary frame: a fixed header followed by the sender's user_ID and the message.
+
+    magic (1) | version (1) | type (1) | flags (1) | sender length (2) | payload length (4) | sender | payload
+
+When the FLAG_REQUEST_ID flag is set, a 4 byte request ID sits between the header and the sender. Clients number their
+commands this way and the server copies the number onto its reply, so several commands can be waiting at once.
+
+When the FLAG_COMPRESSED flag is set, the payload is deflated, using COMPRESSION_DICTIONARY as its preset dictionary so
+that even the protocol's own wording costs next to nothing. A client that can inflate payloads sets
+FLAG_ACCEPTS_COMPRESSED on its hello, and only then does the server compress what it sends it, and only payloads big
+enough to be worth it. Both ends must inflate with the same dictionary, so the flag always comes with DICTIONARY_ID, a
+checksum of it: in the request ID of a binary hello and of the server's acknowledgement, which answer no command, and
+after the flags of a text hello asking for frames. An end whose dictionary has another ID does not compress.
+
+The old comma separated text format ("type,user_id,message") is still understood so that older clients keep working.
+A client that does not know what the server speaks says hello in the text format, with a fourth field asking for the
+frames: "1,<user_ID>,<visibility>,PROTOCOL 1 <flags> <dictionary ID>" (see upgrade_hello()). Older servers only ever read
+the first three fields, so they take it as an ordinary hello. A server that speaks the frames answers with PROTOCOL_ACK,
+as it does a binary hello, and sends nothing but frames from then on; the client keeps sending text until the
+acknowledgement arrives, and frames after it, so neither end ever waits to find out what the other speaks. Until then
+the client ends every text message with a newline, which older servers take no notice of, so that newer ones can tell
+where each ends however TCP joins or splits them, and where the first frame starts. A message with a newline of its
+own, such as a BATCH, has to wait for the acknowledgement.
+"""
+import asyncio
+import json
+import struct
+import threading
+import zlib
+from socket import MSG_PEEK, SHUT_RDWR
+from flowcontrol import OutboundQueue, SlowConsumer, HIGH_WATER, LOW_WATER, QUEUE_LIMIT
+
+MAGIC = 0xCB  # can never be the first byte of a legacy message, which always starts with an ASCII digit
+VERSION = 1
+HEADER = struct.Struct("!BBBBHI")
+HEADER_SIZE = HEADER.size
+REQUEST_ID = struct.Struct("!I")
+FLAG_REQUEST_ID = 0x01  # a request ID follows the header
+FLAG_COMPRESSED = 0x02  # the payload is deflated
+FLAG_ACCEPTS_COMPRESSED = 0x04  # on a hello: the client can take compressed payloads
+FLAG_UPGRADE = 0x08  # on a text hello: the client asked for binary frames (never sent in a header)
+MAX_PAYLOAD = 16 * 1024 * 1024  # anything bigger than this is treated as a corrupt stream
+RECV_SIZE = 65536
+LEGACY_RECV_SIZE = 2048  # a legacy message is whatever one read of up to this many bytes returns
+COMPRESS_ABOVE = 1024  # payloads of more bytes than this are compressed for clients that can take it
+COMPRESS_LEVEL = 1  # a fifth of the CPU of the default level 6, for replies about 15% bigger
+# the strings the server's replies are made of, most common last, where deflate finds them cheapest; nothing in it
+# depends on where the server runs, so every build has the same dictionary
+COMPRESSION_DICTIONARY = "".join([
+    "PROTOCOL SESSION PRESENCE_DELTA PRESENCE_SNAPSHOT BATCH_RESULTS ",
+    '{"command": "LIST_CLIENTS", "status": "ok", "type": 2, "reply": "', '"}, ',
+    " wants to speak to you. Type 'Y' to accept, and 'N' to deny.",
+    " no longer wants to speak to you.", "'s address: ",
+    "-------CLIENTS STARTING WITH ",
+    " does not want to speak to you!\nPlease view the list of other available clients:\n",
+    " is not available.\nPlease view the list of other available clients:\n",
+    "USER:", "-------LIST OF AVAILABLE CLIENTS",
+    "-------\n1. ", "\n2. ", "\n3. ", "\n4. ", "\n5. ", "\n6. ", "\n7. ", "\n8. ", "\n9. ", "\n10. ",
+]).encode('utf-8')
+DICTIONARY_ID = zlib.adler32(COMPRESSION_DICTIONARY)  # sent along with FLAG_ACCEPTS_COMPRESSED
+
+PROTOCOL_ACK = "PROTOCOL " + str(VERSION)  # CONTROL message the server sends back to a binary or upgrade hello
+UPGRADE_PREFIX = PROTOCOL_ACK + " "  # the fourth field of a text hello asking for binary frames, before its flags
+SESSION_PREFIX = "SESSION "  # CONTROL message after the ack: "SESSION <user_ID> <resumption token> new|resumed"
+RESUME_PREFIX = "RESUME "  # CONTROL hello of a client resuming its session: "RESUME <token> <visibility>"
+BATCH_PREFIX = "BATCH_RESULTS "  # CONTROL reply to a BATCH, followed by a JSON list of what became of each command
+
+
+class ProtocolError(Exception):
+    """Raised when the bytes on a connection cannot be a valid frame."""
+
+
+class BufferPool:
+    """
+    Receive buffers shared by every connection. A connection only holds one from reading into it until it has decoded
+    what arrived, so an idle connection holds none, and a busy server does not allocate a fresh one for every read.
+    """
+    __slots__ = ("size", "keep", "_free")
+
+    def __init__(self, size=RECV_SIZE, keep=64):
+        self.size = size
+        self.keep = keep  # buffers kept for reuse; any more given back are left to the garbage collector
+        self._free = []
+
+    def acquire(self):
+        """
+        :rtype: bytearray (a buffer of self.size bytes, holding whatever was last read into it)
+        """
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        """
+        Gives back a buffer from acquire(), once nothing refers to what was read into it.
+        :type buffer: bytearray
+        :rtype: None
+        """
+        if len(self._free) < self.keep:
+            self._free.append(buffer)
+
+
+receive_buffers = BufferPool()
+PEEK_BUFFER = bytearray(1)  # what a blocked thread waits for data with; shared, as what is peeked at is never looked at
+
+
+def serialize(message_type, user_id, message):
+    """
+    Encodes messages so that they are received in a certain order. The order imitates the protocol header.
+    This is the legacy text format, kept for clients that do not speak the binary frames.
+
+    :param message_type: The type of message needing to be sent
+    :type message_type: str
+    :param user_id: The user_ID of sender
+    :type user_id: str
+    :param message: The actual message needing to be sent
+    :type message: str
+    :rtype: bytes
+
+    """
+    byte_message = f"{message_type},{user_id},{message}"
+    return byte_message.encode('utf-8')
+
+
+def deserialize(data, size=None):
+    """
+    Decodes data and returns the parts of the data in the correct order.
+    This is the legacy text format, kept for clients that do not speak the binary frames.
+
+    :param data: the data needing to be decoded
+    :type data: bytes or bytearray
+    :param size: how many bytes at the start of data were received, e.g. into a reused buffer; all of them if None
+    :type size: int
+    :rtype: tuple of str
+
+    """
+    decoded_data = (data if size is None else data[:size]).decode('utf-8')
+    segments = decoded_data.split(',')
+    message_type = segments[0]
+    user_id = segments[1]
+    message = segments[2]
+    return message_type, user_id, message
+
+
+def upgrade_hello(visibility, flags=0):
+    """
+    The message of a text hello that asks for binary frames, which older servers take as an ordinary hello.
+    :param visibility: 0 for private, 1 for public
+    :type visibility: int
+    :param flags: the flags a binary hello would have, e.g. FLAG_ACCEPTS_COMPRESSED
+    :type flags: int
+    :rtype: str
+    """
+    return f"{visibility},{UPGRADE_PREFIX}{flags} {DICTIONARY_ID}"
+
+
+def upgrade_flags(data, size=None):
+    """
+    The flags of a text message that asks for binary frames, made by upgrade_hello().
+    :param data: the data received
+    :type data: bytes or bytearray
+    :param size: how many bytes at the start of data were received; all of them if None
+    :type size: int
+    :rtype: int (the flags asked for along with FLAG_UPGRADE, or 0 if the message does not ask; FLAG_ACCEPTS_COMPRESSED
+            is left out unless the client's dictionary is this one)
+    """
+    hello = bytes(data if size is None else data[:size]).split(b'\n', 1)[0].decode('utf-8')  # frames may follow
+    segments = hello.split(',')
+    if len(segments) < 4 or not segments[3].startswith(UPGRADE_PREFIX):
+        return 0
+    fields = segments[3][len(UPGRADE_PREFIX):].split()
+    try:
+        flags = int(fields[0])
+        dictionary_id = int(fields[1]) if len(fields) > 1 else 0
+    except (IndexError, ValueError):
+        return 0
+    return agreed_flags(flags, dictionary_id) | FLAG_UPGRADE
+
+
+def agreed_flags(flags, dictionary_id):
+    """
+    :param flags: the flags of a hello, or of the server's acknowledgement of one
+    :type flags: int
+    :param dictionary_id: the DICTIONARY_ID the other end sent with them
+    :type dictionary_id: int
+    :rtype: int (the flags, without FLAG_ACCEPTS_COMPRESSED if the other end has another dictionary)
+    """
+    return flags if dictionary_id == DICTIONARY_ID else flags & ~FLAG_ACCEPTS_COMPRESSED
+
+
+def encode_batch(commands):
+    """
+    Puts several commands in one BATCH command, which the server carries out in order and answers once.
+    :param commands: the commands, none of them containing a newline
+    :type commands: list[str]
+    :rtype: str
+    """
+    return "\n".join(["BATCH"] + list(commands))
+
+
+def encode_batch_results(results):
+    """
+    :param results: one dict per command in the BATCH, in order, each with the command, its status ("ok", "error",
+                    "refused" or "pending" if its answer comes later on its own), and the type and text of its reply
+    :type results: list[dict]
+    :rtype: str
+    """
+    return BATCH_PREFIX + json.dumps(results)
+
+
+def decode_batch_results(message):
+    """
+    :param message: the server's reply to a BATCH
+    :type message: str
+    :rtype: list[dict] (see encode_batch_results())
+    """
+    return json.loads(message[len(BATCH_PREFIX):])
+
+
+def compress_payload(payload):
+    """
+    :param payload: an encoded message
+    :type payload: bytes
+    :rtype: bytes (the payload deflated with the preset dictionary)
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def decompress_payload(payload):
+    """
+    :param payload: what compress_payload() made
+    :type payload: bytes or bytearray or memoryview
+    :rtype: bytes
+    :raises ProtocolError: if it is not deflated data, or would inflate to more than MAX_PAYLOAD
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+    try:
+        data = decompressor.decompress(payload, MAX_PAYLOAD)
+    except zlib.error as error:
+        raise ProtocolError("bad compressed payload: " + str(error))
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("compressed frame too large")
+    return data
+
+
+class PayloadCompressor:
+    """
+    Compresses the payloads that are worth it, remembering the last one: the same long reply, such as the list of
+    clients until someone joins or leaves, is often sent to one client after another, and is then compressed only once.
+    """
+
+    def __init__(self, threshold=COMPRESS_ABOVE):
+        self.threshold = threshold  # payloads of this many bytes or fewer are sent as they are
+        self._last = (None, None)  # (message, its compressed payload)
+
+    def compress(self, message):
+        """
+        :param message: the message about to be sent
+        :type message: str or bytes
+        :rtype: bytes or None (the compressed payload, None if it is not worth compressing)
+        """
+        last_message, compressed = self._last
+        if message is last_message:
+            return compressed
+        if len(message) <= self.threshold:
+            return None
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        compressed = compress_payload(payload)
+        if len(compressed) >= len(payload):
+            compressed = None
+        self._last = (message, compressed)  # one assignment, so another thread sees either the old pair or the new
+        return compressed
+
+
+def encode_frame(message_type, user_id, message, flags=0, request_id=0, compressor=None):
+    """
+    Encodes a message as a binary frame.
+
+    :param message_type: The type of message needing to be sent
+    :type message_type: int
+    :param user_id: The user_ID of sender
+    :type user_id: str
+    :param message: The actual message needing to be sent
+    :type message: str or bytes
+    :param flags: Bit flags describing the payload
+    :type flags: int
+    :param request_id: the command this message is, or answers; 0 for none
+    :type request_id: int
+    :param compressor: compresses the message if it is worth it; None to send it as it is
+    :type compressor: PayloadCompressor
+    :rtype: bytes
+
+    """
+    sender = user_id.encode('utf-8')
+    payload = compressor.compress(message) if compressor is not None else None
+    if payload is not None:
+        flags |= FLAG_COMPRESSED
+    else:
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+    if request_id:
+        return HEADER.pack(MAGIC, VERSION, int(message_type), flags | FLAG_REQUEST_ID, len(sender), len(payload)) \
+            + REQUEST_ID.pack(request_id) + sender + payload
+    return HEADER.pack(MAGIC, VERSION, int(message_type), flags, len(sender), len(payload)) + sender + payload
+
+
+class FrameDecoder:
+    """
+    Reassembles frames from a stream of bytes, no matter how TCP splits or joins them.
+
+    Frames are decoded as soon as the bytes completing them are fed in, straight out of those bytes, so they can be
+    read into a buffer that is used again for the next read. Only the start of a frame that has not all arrived yet is
+    copied, into a buffer of the decoder's own that is emptied once the frame is complete, so an idle connection holds
+    no received bytes.
+
+    A decoder for the legacy text format takes each read to be one whole message, as the legacy clients always have.
+    One that does not know the format yet (legacy=None) decodes each read that starts with anything but MAGIC as a text
+    message, and from the first frame on expects only frames. Once the text has been an upgrade hello, every text
+    message after it ends with a newline, so the text is split into lines instead, however it was read, until a line
+    starts with MAGIC.
+    """
+    __slots__ = ("legacy", "_lines", "_partial", "_frames", "_next")
+
+    def __init__(self, legacy=False):
+        self.legacy = legacy  # None while either format may come, which the first frame settles
+        self._lines = False  # True after an upgrade hello, while the text is still coming one line per message
+        self._partial = bytearray()  # the start of a frame, or of a line of text, that is still arriving
+        self._frames = []  # frames decoded but not yet taken by next_frame()
+        self._next = 0  # the index in _frames of the next one to take
+
+    def feed(self, data, size=None):
+        """
+        Decodes the frames that received bytes complete. data is not kept, so it can be reused once this returns.
+
+        :param data: bytes read from the socket
+        :type data: bytes or bytearray
+        :param size: how many bytes at the start of data were read; all of them if None
+        :type size: int
+        :rtype: None
+        :raises ProtocolError: if the bytes cannot be a valid frame
+        """
+        if size is None:
+            size = len(data)
+        if self._lines:
+            self._feed_lines(data, size)
+            return
+        if self.legacy is None and size and data[0] == MAGIC:
+            self.legacy = False
+        if self.legacy is not False:
+            flags = upgrade_flags(data, size) if self.legacy is None else 0
+            if not flags:
+                message_type, user_id, message = deserialize(data, size)
+                self._frames.append((int(message_type), 0, 0, user_id, message))
+                return
+            self._lines = True
+            self._feed_lines(data, size, flags)
+            return
+        partial = self._partial
+        if partial:
+            partial += memoryview(data)[:size]
+            end = self._decode(partial, len(partial))
+            if end == len(partial):
+                partial.clear()
+            else:
+                del partial[:end]
+        else:
+            end = self._decode(data, size)
+            if end < size:
+                partial += memoryview(data)[end:size]
+
+    def _feed_lines(self, data, size, hello_flags=0):
+        # decodes every whole line of text, the first carrying hello_flags, up to the first frame
+        text = self._partial
+        text += memoryview(data)[:size]
+        start = 0
+        while start < len(text):
+            if text[start] == MAGIC:
+                self._lines = False
+                self.legacy = False
+                rest = bytes(text[start:])
+                text.clear()
+                self.feed(rest)
+                return
+            end = text.find(b"\n", start)
+            if end < 0:
+                break
+            if end > start:
+                message_type, user_id, message = deserialize(text[start:end])
+                self._frames.append((int(message_type), hello_flags, 0, user_id, message))
+                hello_flags = 0
+            start = end + 1
+        del text[:start]
+
+    def _decode(self, data, size):
+        # decodes every whole frame in the first size bytes of data, returning where the first incomplete one starts
+        frames = self._frames
+        start = 0
+        while size - start >= HEADER_SIZE:
+            magic, version, message_type, flags, sender_length, payload_length = HEADER.unpack_from(data, start)
+            if magic != MAGIC or version != VERSION:
+                raise ProtocolError("bad frame header")
+            if payload_length > MAX_PAYLOAD:
+                raise ProtocolError("frame too large")
+            sender_start = start + HEADER_SIZE
+            request_id = 0
+            if flags & FLAG_REQUEST_ID:
+                if size < sender_start + REQUEST_ID.size:
+                    break
+                request_id = REQUEST_ID.unpack_from(data, sender_start)[0]
+                sender_start += REQUEST_ID.size
+            payload_start = sender_start + sender_length
+            end = payload_start + payload_length
+            if size < end:
+                break
+            user_id = data[sender_start:payload_start].decode('utf-8')
+            if flags & FLAG_COMPRESSED:
+                message = decompress_payload(data[payload_start:end]).decode('utf-8')
+            else:
+                message = data[payload_start:end].decode('utf-8')
+            frames.append((message_type, flags, request_id, user_id, message))
+            start = end
+        return start
+
+    def pending(self):
+        """
+        Number of buffered bytes that have not been decoded yet.
+        :rtype: int
+        """
+        return len(self._partial)
+
+    def next_frame(self):
+        """
+        Takes the next frame decoded.
+
+        :rtype: tuple[int,int,int,str,str] (type, flags, request ID, sender, message)
+                or None if a whole frame has not arrived yet
+        """
+        frames = self._frames
+        if self._next == len(frames):
+            return None
+        frame = frames[self._next]
+        self._next += 1
+        if self._next == len(frames):
+            frames.clear()
+            self._next = 0
+        return frame
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
+class Channel:
+    """
+    A connected socket that sends and receives whole messages, in either the binary or the legacy text format.
+    Sending is thread safe, so other client handlers may push messages to this connection.
+
+    recv() remembers the request ID of the message it returned in reply_to, and reply() sends with that ID, so whoever
+    handles a command can answer it without passing the ID around.
+
+    After queue_outbound(), sending never waits for the other end: what the socket cannot take straight away is queued,
+    and a writer thread of the channel's own writes it out.
+
+    A channel made with binary=None sends text, one line per message, and takes either format, until the first message
+    received settles binary: True if it was a frame. Setting binary to True then, e.g. on an upgrade hello, switches to
+    sending frames.
+    """
+    __slots__ = ("sock", "binary", "reply_to", "flags", "compressor", "bytes_in", "bytes_out", "outbound", "_decoder",
+                 "_send_lock")
+
+    def __init__(self, sock, binary=True):
+        self.sock = sock
+        self.binary = binary
+        self.reply_to = 0  # request ID of the last message received
+        self.flags = 0  # flags of the last message received
+        self.compressor = None  # the PayloadCompressor for what is sent, once the other end says it can take it
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.outbound = None  # the flowcontrol.OutboundQueue, once queue_outbound() is called
+        self._decoder = FrameDecoder(legacy=None if binary is None else not binary)
+        self._send_lock = threading.Lock()
+
+    def queue_outbound(self, high_water=HIGH_WATER, low_water=LOW_WATER, limit=QUEUE_LIMIT):
+        """
+        Makes send() queue messages instead of writing them, so it never waits for the other end to read.
+        :rtype: None
+        """
+        self.outbound = OutboundQueue(self.sock, high_water, low_water, limit, coalesce=self.binary)
+
+    @property
+    def overflowed(self):
+        """
+        True if the connection was dropped for letting too much pile up unread.
+        """
+        return self.outbound is not None and self.outbound.overflowed
+
+    def wait_until_drained(self):
+        """
+        Waits while the other end is far behind reading what was sent to it.
+        :rtype: bool (True if it had to wait)
+        """
+        return self.outbound is not None and self.outbound.wait_until_drained()
+
+    def send(self, message_type, user_id, message, request_id=0, flags=0):
+        """
+        Sends one message.
+
+        :param message_type: The type of message needing to be sent
+        :type message_type: int
+        :param user_id: The user_ID of sender
+        :type user_id: str
+        :param message: The actual message needing to be sent
+        :type message: str
+        :param request_id: the command this message is, or answers; 0 for none
+        :type request_id: int
+        :param flags: Bit flags describing the payload
+        :type flags: int
+        :rtype: None
+        """
+        if self.binary:
+            data = encode_frame(message_type, user_id, message, flags, request_id, self.compressor)
+        elif self.binary is None:
+            data = serialize(message_type, user_id, message) + b"\n"  # see the module docstring
+        else:
+            data = serialize(message_type, user_id, message)
+        self.send_encoded(data)
+
+    def send_encoded(self, data):
+        """
+        Sends a message already encoded for this channel, e.g. one being sent to many channels, which is encoded once.
+        :param data: the frame, or the legacy text message
+        :type data: bytes
+        :rtype: None
+        """
+        with self._send_lock:
+            if self.outbound is not None:
+                self.outbound.put(data)
+            else:
+                self.sock.sendall(data)
+            self.bytes_out += len(data)
+
+    def reply(self, message_type, user_id, message):
+        """
+        Sends one message answering the last message received.
+        :rtype: None
+        """
+        self.send(message_type, user_id, message, self.reply_to)
+
+    def recv(self):
+        """
+        Receives one message, waiting until all of it has arrived.
+
+        :rtype: tuple[int,str,str]
+        """
+        message_type, self.reply_to, user_id, message = self.recv_frame()
+        return message_type, user_id, message
+
+    def recv_frame(self):
+        """
+        Receives one message along with its request ID.
+
+        :rtype: tuple[int,int,str,str] (type, request ID, sender, message)
+        """
+        frame = self._decoder.next_frame()
+        while frame is None:
+            # wait holding no buffer, so the threads of idle clients do not tie up the pool's buffers
+            if not self.sock.recv_into(PEEK_BUFFER, 1, MSG_PEEK):
+                raise ConnectionError("connection closed")
+            buffer = receive_buffers.acquire()
+            try:
+                received = self.sock.recv_into(buffer, RECV_SIZE if self.binary else LEGACY_RECV_SIZE)
+                if not received:
+                    raise ConnectionError("connection closed")
+                self.bytes_in += received
+                self._decoder.feed(buffer, received)
+            finally:
+                receive_buffers.release(buffer)
+            if self.binary is None:
+                self.binary = self._decoder.legacy is False
+            frame = self._decoder.next_frame()
+        message_type, self.flags, request_id, user_id, message = frame
+        return message_type, request_id, user_id, message
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def close(self):
+        if self.outbound is not None:
+            self.outbound.close()
+        # shut down first: a plain close() leaves the connection open while another thread is blocked in recv()
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class AsyncChannel(asyncio.BufferedProtocol):
+    """
+    The asyncio version of Channel, and the protocol of its own connection: the event loop reads straight into a buffer
+    from the shared pool (get_buffer()), and what arrived is decoded before the buffer goes back (buffer_updated()).
+    Sending never blocks: the message is handed to the transport's buffer and the event loop flushes it. The
+    transport's buffer plays the part of Channel's outbound queue.
+
+    Messages can be waited for one at a time with recv(), or, after serve(), be handed to a callback as they arrive, so
+    that a connection with nothing to say needs no task waiting on it.
+    """
+    __slots__ = ("transport", "binary", "reply_to", "flags", "compressor", "bytes_in", "bytes_out", "overflowed",
+                 "_limit", "_decoder", "_buffer", "_task", "_waiter", "_lost", "_handler", "_on_close", "_holds",
+                 "_writing_paused", "_draining")
+
+    def __init__(self, connected=None, binary=None):
+        """
+        :param connected: a coroutine function to run with the channel once it is connected, e.g. to read a hello
+        :type connected: callable
+        :param binary: whether the other end speaks the binary frames; None to work it out from the first message it
+                       sends, as Channel does
+        :type binary: bool
+        """
+        self.transport = None
+        self.binary = binary
+        self.reply_to = 0  # request ID of the last message received
+        self.flags = 0  # flags of the last message received
+        self.compressor = None  # the PayloadCompressor for what is sent, once the other end says it can take it
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.overflowed = False  # True once the connection was dropped for letting too much pile up unread
+        self._limit = None  # bytes buffered before the connection is dropped, None for no limit
+        self._decoder = FrameDecoder(legacy=None if binary is None else not binary)
+        self._buffer = None  # the pool's buffer being read into
+        self._task = connected  # and then the task running it, until it finishes
+        self._waiter = None  # the future recv() is waiting on
+        self._lost = None  # why the connection closed, once it has
+        self._handler = None  # what serve() hands messages to
+        self._on_close = None
+        self._holds = 0  # reasons, such as hold(), not to hand over messages or read any more for now
+        self._writing_paused = False  # True while the transport has more buffered than the high water mark
+        self._draining = False  # True while held by wait_until_drained()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._task is not None:
+            self._task = asyncio.ensure_future(self._task(self))
+            self._task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._task = None
+
+    def get_buffer(self, sizehint):
+        if self._buffer is None:
+            self._buffer = receive_buffers.acquire()
+        if self.binary is False:
+            return memoryview(self._buffer)[:LEGACY_RECV_SIZE]
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        buffer, self._buffer = self._buffer, None
+        self.bytes_in += nbytes
+        try:
+            self._decoder.feed(buffer, nbytes)
+            if self.binary is None:
+                self.binary = self._decoder.legacy is False
+        except Exception as error:
+            self._fail(error)
+            return
+        finally:
+            receive_buffers.release(buffer)
+        self._deliver()
+
+    def eof_received(self):
+        return False  # so the transport closes, and connection_lost() follows
+
+    def connection_lost(self, error):
+        if self._buffer is not None:
+            receive_buffers.release(self._buffer)
+            self._buffer = None
+        self._fail(error or ConnectionError("connection closed"))
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._draining:
+            self._draining = False
+            self._release()
+
+    def queue_outbound(self, high_water=HIGH_WATER, low_water=LOW_WATER, limit=QUEUE_LIMIT):
+        """
+        Sets the write buffer sizes at which wait_until_drained() waits and at which the connection is dropped.
+        :rtype: None
+        """
+        self.transport.set_write_buffer_limits(high=high_water, low=low_water)
+        self._limit = limit
+
+    def wait_until_drained(self):
+        """
+        After serve(), if the other end is far behind reading what was sent to it, hands over no more messages until it
+        has caught up.
+        :rtype: bool (True if it has to wait)
+        """
+        if not self._writing_paused or self._draining or self.transport.is_closing():
+            return False
+        self._draining = True
+        self._hold()
+        return True
+
+    def send(self, message_type, user_id, message, request_id=0, flags=0):
+        """
+        Queues one message for sending.
+
+        :param message_type: The type of message needing to be sent
+        :type message_type: int
+        :param user_id: The user_ID of sender
+        :type user_id: str
+        :param message: The actual message needing to be sent
+        :type message: str
+        :param request_id: the command this message is, or answers; 0 for none
+        :type request_id: int
+        :param flags: Bit flags describing the payload
+        :type flags: int
+        :rtype: None
+        """
+        if self.binary:
+            data = encode_frame(message_type, user_id, message, flags, request_id, self.compressor)
+        elif self.binary is None:
+            data = serialize(message_type, user_id, message) + b"\n"  # see the module docstring
+        else:
+            data = serialize(message_type, user_id, message)
+        self.send_encoded(data)
+
+    def send_encoded(self, data):
+        """
+        Queues a message already encoded for this channel, e.g. one being sent to many channels, which is encoded once.
+        :param data: the frame, or the legacy text message
+        :type data: bytes
+        :rtype: None
+        """
+        transport = self.transport
+        if transport.is_closing():
+            raise ConnectionError("connection closed")
+        buffered = transport.get_write_buffer_size()
+        if self._limit is not None and buffered and buffered + len(data) > self._limit:
+            self.overflowed = True
+            transport.abort()
+            raise SlowConsumer("outbound queue full")
+        transport.write(data)
+        self.bytes_out += len(data)
+
+    def reply(self, message_type, user_id, message):
+        """
+        Queues one message answering the last message received.
+        :rtype: None
+        """
+        self.send(message_type, user_id, message, self.reply_to)
+
+    async def recv(self):
+        """
+        Receives one message, waiting until all of it has arrived.
+
+        :rtype: tuple[int,str,str]
+        """
+        frame = self._decoder.next_frame()
+        while frame is None:
+            if self._lost is not None:
+                raise self._lost
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+            frame = self._decoder.next_frame()
+        message_type, self.flags, self.reply_to, user_id, message = frame
+        return message_type, user_id, message
+
+    def serve(self, handler, on_close):
+        """
+        Hands every message from now on, and any already received, to a callback as soon as it has arrived, in place
+        of recv(). If the callback raises, the connection is closed.
+        :param handler: called with the type, sender and text of each message
+        :type handler: callable
+        :param on_close: called once with the exception the connection closed with, however that came about
+        :type on_close: callable
+        :rtype: None
+        """
+        self._handler = handler
+        self._on_close = on_close
+        if self._lost is not None:
+            on_close(self._lost)
+        else:
+            self._deliver()
+
+    def hold(self, delay, callback, *args):
+        """
+        Hands over no more messages, and stops reading, for delay seconds, and then calls callback(*args) before
+        carrying on. The other end's TCP window fills up meanwhile, which slows it down.
+        :rtype: None
+        """
+        self._hold()
+        asyncio.get_running_loop().call_later(delay, self._end_hold, callback, args)
+
+    def _hold(self):
+        self._holds += 1
+        if self._holds == 1:
+            self.transport.pause_reading()
+
+    def _release(self):
+        self._holds -= 1
+        if not self._holds:
+            self.transport.resume_reading()
+            self._deliver()
+
+    def _end_hold(self, callback, args):
+        if self._lost is None:
+            try:
+                callback(*args)
+            except Exception as error:
+                self._fail(error)
+        self._release()
+
+    def _deliver(self):
+        # hands decoded messages to the handler until there are none left or the channel is held, or else wakes recv()
+        if self._handler is None:
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_result(None)
+            return
+        while not self._holds and self._lost is None:
+            frame = self._decoder.next_frame()
+            if frame is None:
+                return
+            message_type, self.flags, self.reply_to, user_id, message = frame
+            try:
+                self._handler(message_type, user_id, message)
+            except Exception as error:
+                self._fail(error)
+
+    def _fail(self, error):
+        # the connection is done with, for the first reason to come along
+        if self._lost is not None:
+            return
+        self._lost = error
+        if self.transport is not None:
+            self.transport.close()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        if self._on_close is not None:
+            self._on_close(error)
+
+    def getsockname(self):
+        return self.transport.get_extra_info('sockname')
+
+    def close(self):
+        self.transport.close()
+
+
+def accept_channel(sock):
+    """
+    Works out which format a newly accepted client speaks by peeking at the first byte it sent. A text client may yet
+    ask for binary frames in its hello, so its channel takes either format.
+
+    :param sock: The newly accepted client socket
+    :type sock: socket.socket
+    :rtype: Channel
+    """
+    first = sock.recv(1, MSG_PEEK)
+    if not first:
+        raise ConnectionError("connection closed before hello")
+    return Channel(sock, binary=first[0] == MAGIC or None)
+
+
+async def open_async_channel(host=None, port=None, sock=None):
+    """
+    The AsyncChannel version of asyncio.open_connection(), for connections that only ever carry binary frames.
+    :param sock: an already connected socket to use, instead of connecting to host and port
+    :type sock: socket.socket
+    :rtype: AsyncChannel
+    """
+    loop = asyncio.get_running_loop()
+    transport, channel = await loop.create_connection(lambda: AsyncChannel(binary=True), host, port, sock=sock)
+    return channel
+
+
+async def start_async_server(connected, sock, binary=None):
+    """
+    The AsyncChannel version of asyncio.start_server(): every connection accepted gets a channel of its own, and
+    connected is run with it as a task.
+    :param connected: a coroutine function taking the channel
+    :type connected: callable
+    :param sock: the listening socket
+    :type sock: socket.socket
+    :param binary: whether the other ends speak the binary frames; None to work it out for each from its first byte
+    :type binary: bool
+    :rtype: asyncio.Server
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: AsyncChannel(connected, binary), sock=sock)
@@ -0,0 +1,509 @@
+"""
+registry.py - The server's record of who is connected
+
+Sessions are kept in a dict keyed by user_ID, and the user_IDs of public clients are kept separately, so looking a
+client up, changing their visibility or removing them never has to scan the other clients, nor move them all along.
+"""
+import threading
+import heapq
+import time
+from bisect import bisect_left, insort
+from collections import ChainMap, deque
+from itertools import chain, islice
+
+ACTIVE = "active"            # connected and able to send commands
+HANDSHAKING = "handshaking"  # waiting to answer (or hear back about) a connection request
+CHATTING = "chatting"        # has been sent a peer's address and gone off to chat
+
+LAST_CHARACTER = chr(0x10FFFF)  # sorts after every other character
+CHANGE_HISTORY = 4096  # changes to the public list remembered for clients catching up from an older version
+SNAPSHOT_TRIES = 3  # lock-free copies tried before a reader gives up and waits for the writers
+BUCKET_SIZE = 512  # userIDs per bucket of the sorted index; a bucket is split in two once it has twice as many
+
+
+class Session:
+    """
+    Everything the server knows about one connected client.
+    """
+    __slots__ = ("user_id", "connection", "address", "visibility", "state", "last_seen", "last_command", "pinged_at",
+                 "bucket", "command_buckets", "token")
+
+    def __init__(self, user_id, connection, address, visibility):
+        self.user_id = user_id
+        self.connection = connection  # the client's protocol.Channel or protocol.AsyncChannel
+        self.address = address        # (host, port)
+        self.visibility = visibility  # "1" for public, "0" for private
+        self.state = ACTIVE
+        self.last_seen = self.last_command = time.monotonic()  # last message of any kind, and last one that was not a PONG
+        self.pinged_at = 0.0  # when the PING still waiting for an answer was sent, 0 if none is
+        self.bucket = None  # flowcontrol.TokenBucket limiting how fast the client may send, None for no limit
+        self.command_buckets = None  # command name -> flowcontrol.TokenBucket, for commands with limits of their own
+        self.token = None  # the resumption token the client was given, None if it cannot resume
+
+    def __repr__(self):
+        return f"Session({self.user_id!r}, {self.address!r}, visibility={self.visibility!r}, state={self.state!r})"
+
+
+class UsernameGenerator:
+    """
+    Hands out unique userIDs. The first client to ask for a name gets it as it is, and later clients asking for the same
+    name get it with the lowest free suffix ("bob_1", "bob_2", ...), the same names the old scan would have picked.
+
+    Each base name has a counter for the next suffix never handed out and a heap of suffixes given back by clients that
+    left, so a join costs the same whether 1 or 50 000 clients already share the name.
+    Not thread safe on its own; the registry calls it with its lock held.
+    """
+
+    def __init__(self, in_use):
+        self._in_use = in_use  # anything supporting "in", holding the userIDs currently taken
+        self._next_suffix = {}  # base name -> the next suffix never handed out
+        self._free_suffixes = {}  # base name -> heap of suffixes given back
+        self._given = {}  # suffixed userID -> (base name, suffix)
+        self._outstanding = {}  # base name -> how many suffixed userIDs are in use
+
+    def generate(self, userID):
+        """
+        Generates username for a client, to ensure there are no duplicates among the connected clients.
+        :param userID: the userID initially given by client
+        :type userID: str
+        :rtype: str
+        """
+        if userID not in self._in_use:
+            return userID  # user_ID is unique
+
+        free = self._free_suffixes.get(userID)
+        while free:
+            suffix = heapq.heappop(free)
+            new_ID = userID + "_" + str(suffix)
+            if new_ID not in self._in_use:  # somebody may have joined with this exact name in the meantime
+                self._give(new_ID, userID, suffix)
+                return new_ID
+
+        suffix = self._next_suffix.get(userID, 1)
+        new_ID = userID + "_" + str(suffix)
+        while new_ID in self._in_use:
+            suffix += 1
+            new_ID = userID + "_" + str(suffix)
+        self._next_suffix[userID] = suffix + 1
+        self._give(new_ID, userID, suffix)
+        return new_ID
+
+    def _give(self, new_ID, base, suffix):
+        self._given[new_ID] = (base, suffix)
+        self._outstanding[base] = self._outstanding.get(base, 0) + 1
+
+    def release(self, user_id):
+        """
+        Gives a userID back once its client has left, so its suffix can be handed out again.
+        :param user_id: The userID of the client that left
+        :type user_id: str
+        :rtype: None
+        """
+        given = self._given.pop(user_id, None)
+        if given is None:
+            return
+        base, suffix = given
+        self._outstanding[base] -= 1
+        if self._outstanding[base]:
+            heapq.heappush(self._free_suffixes.setdefault(base, []), suffix)
+        else:
+            # every suffix is back, so forget about this name altogether
+            del self._outstanding[base]
+            del self._next_suffix[base]
+            self._free_suffixes.pop(base, None)
+
+    def clear(self):
+        self._next_suffix.clear()
+        self._free_suffixes.clear()
+        self._given.clear()
+        self._outstanding.clear()
+
+
+class SortedUserIDs:
+    """
+    UserIDs in sorted order, kept in buckets of up to 2 * BUCKET_SIZE. Adding or removing one moves the rest of its
+    bucket along, rather than every userID after it as one sorted list would, so it costs the same with 100k public
+    clients as with 1k.
+    """
+    __slots__ = ("_buckets", "_maxes")
+
+    def __init__(self):
+        self._buckets = []  # lists of userIDs, each sorted, each one's all before the next one's
+        self._maxes = []  # the last userID of each bucket, for finding the bucket a userID belongs in
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def add(self, user_id):
+        buckets = self._buckets
+        maxes = self._maxes
+        if not buckets:
+            buckets.append([user_id])
+            maxes.append(user_id)
+            return
+        index = bisect_left(maxes, user_id)
+        if index == len(maxes):
+            index -= 1  # after everything there is: it goes at the end of the last bucket
+            buckets[index].append(user_id)
+            maxes[index] = user_id
+        else:
+            insort(buckets[index], user_id)
+        bucket = buckets[index]
+        if len(bucket) > 2 * BUCKET_SIZE:
+            buckets.insert(index + 1, bucket[BUCKET_SIZE:])
+            del bucket[BUCKET_SIZE:]
+            maxes.insert(index, bucket[-1])
+
+    def remove(self, user_id):
+        index = bisect_left(self._maxes, user_id)
+        bucket = self._buckets[index]
+        del bucket[bisect_left(bucket, user_id)]
+        if bucket:
+            self._maxes[index] = bucket[-1]
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+
+    def copy(self):
+        """
+        :rtype: tuple[str] (every userID, sorted)
+        """
+        # a single C call, like copying a list, so no writer can change the buckets in the middle of it
+        return tuple(chain.from_iterable(self._buckets))
+
+    def clear(self):
+        self._buckets.clear()
+        self._maxes.clear()
+
+
+class RegistrySnapshot:
+    """
+    The public list as it was at one version. It is never changed once made, so any number of threads can read it
+    without a lock.
+    """
+    __slots__ = ("version", "public", "public_sorted")
+
+    def __init__(self, version, public, public_sorted):
+        self.version = version
+        self.public = public  # tuple of public user_IDs, in the order they became public
+        self.public_sorted = public_sorted  # the same user_IDs, sorted
+
+    def find(self, prefix, limit):
+        """
+        Finds public clients whose userID starts with prefix. An exact match comes first, then shorter userIDs, then
+        alphabetical order. The work done grows with the number of matches, not with the number of clients.
+        :param prefix: the start of the userIDs being looked for
+        :type prefix: str
+        :param limit: the most results to return
+        :type limit: int
+        :rtype: list[str]
+        """
+        public_sorted = self.public_sorted
+        # every userID starting with prefix sorts between prefix and prefix followed by the highest character
+        matches = public_sorted[bisect_left(public_sorted, prefix):bisect_left(public_sorted, prefix + LAST_CHARACTER)]
+        return heapq.nsmallest(limit, matches, key=lambda user_id: (user_id != prefix, len(user_id), user_id))
+
+
+class ClientRegistry:
+    """
+    The connected clients, keyed by user_ID.
+
+    Every change happens under one lock so joins and leaves from different threads cannot interleave. Readers never
+    take it. Single lookups read the dict directly, since reading one key of a dict is atomic. Listing and searching
+    read an immutable RegistrySnapshot of the public list, which is swapped in with a single assignment.
+
+    The public list carries a version number that goes up whenever someone joins, leaves or changes visibility in a way
+    that changes the list. Writers only change the live list and bump the version, which is what makes the snapshot
+    out of date; the first reader to see a newer version copies the list into a new snapshot, so a burst of changes
+    with no reads in between costs one copy, and every read sees every change committed before it. The copy is made
+    without the lock, and is made again if a writer was part way through a change (a sequence lock); only if writers
+    keep getting in the way does a reader take the lock to copy.
+    The most recent changes are also remembered, so a client that knows an older version can be told just what changed.
+
+    The userIDs of clients that may yet resume their sessions are reserved, so nobody else is given them meanwhile.
+
+    When the server runs as several workers, every change is also made to the directory the workers share (see
+    workers.SharedDirectory), and a userID is only handed out once the directory has it for this worker. When it shares
+    its clients with other nodes, the changes go to the directory it gossips to them instead (see
+    federation.FederatedDirectory).
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._sessions = {}  # user_ID -> Session, in the order clients joined
+        self._reserved = {}  # user_IDs kept for clients that may resume (values unused)
+        self._taken = ChainMap(self._sessions, self._reserved)  # every userID that cannot be handed out
+        self._usernames = UsernameGenerator(self._taken)
+        self.directory = None  # the workers.SharedDirectory or federation.FederatedDirectory, if there is one
+        self._public = {}  # user_IDs of public clients (values unused), in the order they became public
+        self._public_sorted = SortedUserIDs()  # the same user_IDs, sorted
+        self.version = 0  # version of the public list
+        self._sequence = 0  # goes up before and after every change to the public list, so it is odd during one
+        self._snapshot = RegistrySnapshot(0, (), ())  # the latest snapshot a reader has made
+        self._changes = deque(maxlen=CHANGE_HISTORY)  # (version, "+" or "-", user_ID), one per version, oldest first
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def use_directory(self, directory):
+        """
+        Shares the registry's userIDs with the other workers or nodes through their directory.
+        :param directory: the directory of every worker's or node's clients
+        :type directory: workers.SharedDirectory or federation.FederatedDirectory
+        :rtype: None
+        """
+        self.directory = directory
+        self._taken.maps.append(directory)
+
+    def get(self, user_id):
+        """
+        Looks a client up by user_ID.
+        :param user_id: The userID of a client
+        :type user_id: str
+        :rtype: Session or None if nobody by that name is connected
+        """
+        return self._sessions.get(user_id)
+
+    def join(self, user_id, connection, address, visibility):
+        """
+        Adds a client, renaming them if their userID is already taken.
+        :param user_id: the userID the client asked for
+        :type user_id: str
+        :param connection: The client's channel
+        :type connection: protocol.Channel or protocol.AsyncChannel
+        :param address: The client IP and port number (host,port)
+        :type address: tuple
+        :param visibility: "1" for public, "0" for private
+        :type visibility: str
+        :rtype: Session
+        """
+        with self.lock:
+            wanted = user_id if self.directory is None else self.directory.fit(user_id)
+            user_id = self._usernames.generate(wanted)
+            while self.directory is not None and not self.directory.claim(user_id, address, visibility):
+                # another worker took it first; now that the directory has it, the next name will be different
+                self._usernames.release(user_id)
+                user_id = self._usernames.generate(wanted)
+            session = Session(user_id, connection, address, visibility)
+            self._sessions[user_id] = session
+            if visibility == "1":
+                self._add_public(user_id)
+        return session
+
+    def claim(self, user_id, connection, address, visibility):
+        """
+        Adds a client under a userID reserved for them, for a client resuming their session.
+        :param user_id: the reserved userID
+        :type user_id: str
+        :param connection: The client's channel
+        :type connection: protocol.Channel or protocol.AsyncChannel
+        :param address: The client IP and port number (host,port)
+        :type address: tuple
+        :param visibility: "1" for public, "0" for private
+        :type visibility: str
+        :rtype: Session or None if the userID is not reserved
+        """
+        with self.lock:
+            if self._reserved.pop(user_id, False) is False:
+                return None
+            if self.directory is not None:
+                self.directory.connect(user_id, address, visibility)
+            session = Session(user_id, connection, address, visibility)
+            self._sessions[user_id] = session
+            if visibility == "1":
+                self._add_public(user_id)
+        return session
+
+    def leave(self, user_id, reserve=False):
+        """
+        Removes a client.
+        :param user_id: The userID of a client
+        :type user_id: str
+        :param reserve: keep their userID for them, as they may resume
+        :type reserve: bool
+        :rtype: Session or None if nobody by that name was connected
+        """
+        with self.lock:
+            session = self._sessions.pop(user_id, None)
+            if session is not None:
+                if reserve:
+                    self._reserved[user_id] = None
+                    if self.directory is not None:
+                        self.directory.disconnect(user_id)
+                else:
+                    self._usernames.release(user_id)
+                    if self.directory is not None:
+                        self.directory.release(user_id)
+            if user_id in self._public:
+                self._remove_public(user_id)
+        return session
+
+    def reserve(self, user_id):
+        """
+        Keeps a userID for a client that may resume, such as one that was connected before the server restarted.
+        :rtype: bool (False if someone is connected under it)
+        """
+        with self.lock:
+            if user_id in self._sessions:
+                return False
+            if self.directory is not None and not self.directory.reserve(user_id):
+                return False
+            self._reserved[user_id] = None
+            return True
+
+    def unreserve(self, user_id):
+        """
+        Gives up a reserved userID once its client can no longer resume.
+        :rtype: None
+        """
+        with self.lock:
+            if self._reserved.pop(user_id, False) is None:
+                self._usernames.release(user_id)
+                if self.directory is not None:
+                    self.directory.release(user_id)
+
+    def set_visibility(self, user_id, visibility):
+        """
+        Changes a client's visibility.
+        :param user_id: The userID of a client
+        :type user_id: str
+        :param visibility: "1" for public, "0" for private
+        :type visibility: str
+        :rtype: bool (False if nobody by that name is connected)
+        """
+        with self.lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return False
+            session.visibility = visibility
+            if self.directory is not None:
+                self.directory.set_visibility(user_id, visibility)
+            if visibility == "1" and user_id not in self._public:
+                self._add_public(user_id)
+            elif visibility != "1" and user_id in self._public:
+                self._remove_public(user_id)
+        return True
+
+    def is_public(self, user_id):
+        return user_id in self._public
+
+    # the next three are always called with the lock held
+    def _add_public(self, user_id):
+        self._sequence += 1
+        try:
+            self._public[user_id] = None
+            self._public_sorted.add(user_id)
+            self._public_changed("+", user_id)
+        finally:
+            self._sequence += 1
+
+    def _remove_public(self, user_id):
+        self._sequence += 1
+        try:
+            del self._public[user_id]
+            self._public_sorted.remove(user_id)
+            self._public_changed("-", user_id)
+        finally:
+            self._sequence += 1
+
+    def _public_changed(self, change=None, user_id=None):
+        self.version += 1
+        if change is None:
+            self._changes.clear()  # the change cannot be described, so everyone has to start again from a snapshot
+        else:
+            self._changes.append((self.version, change, user_id))
+
+    def changes_since(self, version):
+        """
+        The changes to the public list after a version, oldest first, ending at the current version.
+        :param version: a version of the public list
+        :type version: int
+        :rtype: list[tuple[int,str,str]] ((version, "+" or "-", user_ID)) or None if they are not all remembered
+        """
+        with self.lock:
+            if version > self.version:
+                return None
+            if version == self.version:
+                return []
+            if not self._changes or self._changes[0][0] > version + 1:
+                return None
+            # versions in the history are consecutive, so the first change wanted is found by counting
+            return list(islice(self._changes, version + 1 - self._changes[0][0], None))
+
+    def snapshot(self):
+        """
+        The public list as it is now, without taking the lock.
+        :rtype: RegistrySnapshot
+        """
+        snapshot = self._snapshot
+        if snapshot.version == self.version:
+            return snapshot
+        for attempt in range(SNAPSHOT_TRIES):
+            sequence = self._sequence
+            if not sequence & 1:
+                version = self.version
+                # each copy is a single C call, so no writer can change the list in the middle of one
+                public = tuple(self._public)
+                public_sorted = self._public_sorted.copy()
+                if self._sequence == sequence:
+                    break
+            time.sleep(0)  # a writer is part way through a change; let it finish
+        else:
+            with self.lock:
+                version = self.version
+                public = tuple(self._public)
+                public_sorted = self._public_sorted.copy()
+        snapshot = RegistrySnapshot(version, public, public_sorted)
+        if version > self._snapshot.version:
+            self._snapshot = snapshot
+        return snapshot
+
+    def find(self, prefix, limit):
+        """
+        Finds public clients whose userID starts with prefix (see RegistrySnapshot.find()).
+        :rtype: list[str]
+        """
+        return self.snapshot().find(prefix, limit)
+
+    def public_snapshot(self):
+        """
+        The userIDs of public clients, in the order they became public, along with the version of the list.
+        :rtype: tuple[int,tuple[str]]
+        """
+        snapshot = self.snapshot()
+        return snapshot.version, snapshot.public
+
+    def public_ids(self):
+        """
+        The userIDs of public clients, in the order they became public.
+        :rtype: tuple[str]
+        """
+        return self.public_snapshot()[1]
+
+    def sessions(self):
+        """
+        A copy of every session, in the order the clients joined.
+        :rtype: list[Session]
+        """
+        # copying the values is a single C call, so it sees the dict either before or after any change
+        return list(self._sessions.values())
+
+    def clear(self):
+        """
+        Removes every client.
+        :rtype: list[Session] (the sessions that were removed)
+        """
+        with self.lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+            self._reserved.clear()
+            self._usernames.clear()
+            self._sequence += 1
+            self._public.clear()
+            self._public_sorted.clear()
+            self._public_changed()
+            self._sequence += 1
+        return sessions
@@ -0,0 +1,289 @@
+"""
+replay.py - Plays traffic captured with Server.py --capture-file back against a server
+
+Every captured session is played back over a connection of its own, with the same hello and the same messages under
+the same request IDs, either on the capture's own schedule (--speed scales it) or as fast as the server keeps up
+(--fast). Either way the order between sessions is kept: before a message from one session is sent, the message
+before it from another session must have been handled. That is known from its reply, or else from the reply to a
+probe sent after it on the same connection, for messages with no reply yet (a CONNECT_TO, or the answer to one).
+
+What every session received is kept with what changes from run to run taken out: tokens, addresses, STATS numbers,
+and presence deltas, which are grouped by time. --save writes the responses to a file and --compare checks them
+against a file saved earlier, so a captured workload both times the server and checks it still answers the same.
+Legacy text sessions cannot be kept in order, so they are left out.
+
+Usage: python replay.py CAPTURE [host] [port] [--fast | --speed X] [--save FILE] [--compare FILE] [--start-server]
+"""
+import argparse
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+from socket import create_connection, IPPROTO_TCP, TCP_NODELAY
+from capture import read_capture, START, HELLO, MESSAGE, CLOSE, FLAG_LEGACY
+from loadgen import Recorder, print_summary, start_server
+from protocol import Channel, ProtocolError, PayloadCompressor, PROTOCOL_ACK, SESSION_PREFIX, BATCH_PREFIX, \
+    FLAG_ACCEPTS_COMPRESSED, DICTIONARY_ID, agreed_flags, decode_batch_results, encode_batch_results
+from presence import DELTA
+
+PROBE = "REPLAY_SYNC"  # not a command, so all the server does is say it does not recognise it
+PROBE_IDS = 1 << 31  # request IDs of probes start here, well clear of the ones clients number their commands with
+REPLY_TIMEOUT = 10
+CLOSE_PAUSE = 0.05  # a connection closed without a goodbye has no reply to wait for, so the next session waits instead
+SETTLE_TIME = 0.5  # seconds to wait at the end for messages still on their way
+STATS_HEADER = "-------SERVER STATS-------"
+ADDRESS = re.compile(r"address: [^\s\"\\]+")
+
+
+def normalise(message):
+    """
+    Takes out of a message what changes from one run to the next.
+    :param message: a message from the server
+    :type message: str
+    :rtype: str
+    """
+    if message.startswith(SESSION_PREFIX):
+        words = message.split()
+        return " ".join(words[:2] + ["<token>"] + words[3:])
+    if message.startswith(STATS_HEADER):
+        return STATS_HEADER
+    if message.startswith(BATCH_PREFIX):
+        results = decode_batch_results(message)
+        for result in results:
+            result["reply"] = normalise(result["reply"])
+        return encode_batch_results(results)
+    return ADDRESS.sub("address: <address>", message)
+
+
+class ReplaySession:
+    """
+    One captured session, played back over a connection of its own.
+    """
+
+    def __init__(self, record, options, recorder):
+        self.user_id = record.user_id
+        self.recorder = recorder
+        self.responses = []  # [type, request ID, message] of everything received, normalised
+        self.joined = threading.Event()  # set once the server has taken the session on, or turned it away
+        self.closed = False
+        self.said_goodbye = False  # True once the server has answered a TERMINATE, so has forgotten the session
+        self._waiting = {}  # request ID -> (Event, command name, time sent)
+        self._last = None  # the Event of the last message sent, None if it has no reply to wait for
+        self._probe_ids = itertools.count(PROBE_IDS)
+        self._lock = threading.Lock()
+        sock = create_connection((options.host, options.port))
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)  # a probe follows the message before it straight away
+        self.channel = Channel(sock)
+        self._offered_compression = record.flags & FLAG_ACCEPTS_COMPRESSED
+        self.channel.send(record.message_type, record.user_id, record.message,
+                          DICTIONARY_ID if self._offered_compression else 0, flags=record.flags)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, record):
+        """
+        Sends a captured message, remembering how to tell when the server has handled it.
+        :type record: capture.Record
+        :rtype: None
+        """
+        name = record.message.split()[0] if record.message.split() else ""
+        self._last = None
+        if record.message_type == 0 and record.request_id and name != "CONNECT_TO":
+            self._last = self._expect(record.request_id, name)
+        try:
+            self.channel.send(record.message_type, record.user_id, record.message, record.request_id)
+        except OSError:
+            self.recorder.error(name or "MESSAGE")
+
+    def settle(self):
+        """
+        Waits until the server has handled the last message sent.
+        :rtype: None
+        """
+        if self.closed:
+            if not self.said_goodbye:
+                time.sleep(CLOSE_PAUSE)
+            return
+        event, self._last = self._last, None
+        if event is None:
+            probe_id = next(self._probe_ids)
+            event = self._expect(probe_id, None)
+            try:
+                self.channel.send(0, self.user_id, PROBE, probe_id)
+            except OSError:
+                return
+        event.wait(REPLY_TIMEOUT)
+
+    def close(self):
+        self.closed = True
+        self.channel.close()
+
+    def _expect(self, request_id, name):
+        event = threading.Event()
+        with self._lock:
+            self._waiting[request_id] = (event, name, time.perf_counter())
+        return event
+
+    def _read(self):
+        try:
+            while True:
+                message_type, request_id, user_id, message = self.channel.recv_frame()
+                if message_type == 2 and message == "PING":
+                    self.channel.send(2, self.user_id, "PONG")
+                    continue
+                if message == PROTOCOL_ACK:
+                    if self._offered_compression and \
+                            agreed_flags(self.channel.flags, request_id) & FLAG_ACCEPTS_COMPRESSED:
+                        self.channel.compressor = PayloadCompressor()
+                    request_id = 0  # the dictionary ID, not a reply
+                if message.startswith(SESSION_PREFIX) or not self.joined.is_set() and message_type == 3:
+                    self.joined.set()
+                with self._lock:
+                    waiting = self._waiting.pop(request_id, None) if request_id else None
+                if waiting is not None:
+                    event, name, sent = waiting
+                    if name is not None:
+                        self.recorder.record(name, time.perf_counter() - sent)
+                        self.said_goodbye = name == "TERMINATE"
+                    event.set()
+                    if name is None:
+                        continue  # the reply to a probe
+                if not message.startswith(DELTA):
+                    self.responses.append([message_type, request_id, normalise(message)])
+        except (OSError, ProtocolError, ValueError):
+            pass
+        finally:
+            self.joined.set()
+            with self._lock:
+                waiting, self._waiting = list(self._waiting.values()), {}
+            for event, name, sent in waiting:
+                if name is not None:
+                    self.recorder.error(name)
+                event.set()
+
+
+def replay(records, options, recorder):
+    """
+    Plays captured records back in order.
+    :param records: what read_capture() read
+    :type records: iterator of capture.Record
+    :rtype: tuple[dict,dict] ((run, session) -> ReplaySession, counts of what was played back and left out)
+    """
+    sessions = {}
+    counts = {"messages": 0, "sessions": 0, "legacy sessions left out": 0, "messages without a hello": 0,
+              "most seconds behind": 0.0}
+    previous = None  # the session the last record was from
+    start = time.perf_counter()
+    run_start = last = 0.0  # where in the replay the current run starts, and where the last record was
+    for record in records:
+        if record.kind == START:
+            # the server restarted, so everyone still connected was cut off; runs are played back to back
+            for session in sessions.values():
+                if not session.closed:
+                    session.close()
+            run_start = last
+            continue
+        last = run_start + record.seconds
+        if not options.fast:
+            delay = start + last / options.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                counts["most seconds behind"] = max(counts["most seconds behind"], -delay)
+        key = (record.run, record.session)
+        session = sessions.get(key)
+        if previous is not None and previous is not session:
+            previous.settle()
+        if record.kind == HELLO:
+            if record.flags & FLAG_LEGACY:
+                counts["legacy sessions left out"] += 1
+                continue
+            session = sessions[key] = ReplaySession(record, options, recorder)
+            session.joined.wait(REPLY_TIMEOUT)
+            counts["sessions"] += 1
+        elif session is None or session.closed:
+            if record.kind == MESSAGE:
+                counts["messages without a hello"] += 1  # the capture started part way through the session
+            continue
+        elif record.kind == MESSAGE:
+            session.send(record)
+            counts["messages"] += 1
+        elif record.kind == CLOSE:
+            session.settle()  # the reply to a TERMINATE just before, say, is part of what the session received
+            session.close()
+        previous = session
+    time.sleep(SETTLE_TIME)
+    for session in sessions.values():
+        if not session.closed:
+            session.close()
+    return sessions, counts
+
+
+def compare(expected, sessions, shown=5):
+    """
+    Prints how the responses of this replay differ from those of an earlier one.
+    :param expected: "run:session" -> responses, as saved by --save
+    :type expected: dict
+    :param sessions: (run, session) -> ReplaySession
+    :type sessions: dict
+    :param shown: how many differences to print in full
+    :type shown: int
+    :rtype: bool (True if every session received the same)
+    """
+    got = {str(run) + ":" + str(number): session.responses for (run, number), session in sessions.items()}
+    different = [key for key in sorted(set(expected) | set(got)) if expected.get(key) != got.get(key)]
+    print(f"\n{len(got) - len(different)} of {len(set(expected) | set(got))} sessions received the same as before")
+    for key in different[:shown]:
+        before, after = expected.get(key, []), got.get(key, [])
+        index = next((i for i, (a, b) in enumerate(zip(before, after)) if a != b), min(len(before), len(after)))
+        print(f"session {key}, message {index + 1}:")
+        print("  before: " + (repr(before[index])[:200] if index < len(before) else "nothing"))
+        print("  now:    " + (repr(after[index])[:200] if index < len(after) else "nothing"))
+    return not different
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays traffic captured with Server.py --capture-file back")
+    parser.add_argument("capture")
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=12000)
+    parser.add_argument("--fast", action="store_true", help="send every message as soon as the server can take it")
+    parser.add_argument("--speed", type=float, default=1, help="how many times faster than captured to play it back")
+    parser.add_argument("--save", help="write what every session received to this file")
+    parser.add_argument("--compare", help="a --save file from an earlier replay to check the responses against")
+    parser.add_argument("--start-server", action="store_true", help="run Server.py on a free loopback port")
+    parser.add_argument("--server-args", default="", help="extra arguments for --start-server, e.g. --asyncio")
+    options = parser.parse_args()
+
+    server = start_server(options) if options.start_server else None
+    recorder = Recorder()
+    start = time.perf_counter()
+    try:
+        sessions, counts = replay(read_capture(options.capture), options, recorder)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    elapsed = time.perf_counter() - start - SETTLE_TIME
+
+    print(f"{counts['messages']:,} messages from {counts['sessions']:,} sessions in {elapsed:.2f} s "
+          f"({counts['messages'] / elapsed:,.0f}/s)")
+    for name, count in counts.items():
+        if name not in ("messages", "sessions") and count:
+            print(f"{name:<30}{count:>9,.2f}" if isinstance(count, float) else f"{name:<30}{count:>9,}")
+    print()
+    print_summary(recorder.summary(elapsed))
+    same = True
+    if options.compare:
+        with open(options.compare) as file:
+            same = compare(json.load(file), sessions)
+    if options.save:
+        with open(options.save, "w") as file:
+            json.dump({str(run) + ":" + str(number): session.responses
+                       for (run, number), session in sessions.items()}, file, indent=1)
+    sys.exit(0 if same else 1)
+
+
+if __name__ == "__main__":
+    main()
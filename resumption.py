@@ -0,0 +1,164 @@
+"""
+resumption.py - Letting a client that lost its connection come back as who it was
+
+Every binary client is given a resumption token when it joins. If its connection drops without a TERMINATE, its
+session is parked for a grace period: its userID is kept for it, and so are the connection requests it was part of. A
+client that reconnects within the grace period and says hello with
+
+    RESUME <token> <visibility>
+
+(as a type 2 message instead of the usual type 1) gets its userID, visibility and requests back in that one round trip.
+If the token is unknown or too old, the visibility is used to join as a new client instead.
+
+The sessions can also be written to disk, so that after a restart the server parks them all again and clients can
+resume instead of starting over.
+"""
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+def new_token():
+    """
+    :rtype: str (a token that cannot be guessed)
+    """
+    return secrets.token_urlsafe(16)
+
+
+def same_token(token, presented):
+    """
+    Compares tokens in constant time, so how long it takes gives nothing away.
+    :rtype: bool
+    """
+    return secrets.compare_digest(token.encode(), presented.encode())
+
+
+class ParkedSession:
+    """
+    What is kept of a client between losing its connection and resuming.
+    """
+    __slots__ = ("user_id", "visibility", "token", "expires_at")
+
+    def __init__(self, user_id, visibility, token, expires_at):
+        self.user_id = user_id
+        self.visibility = visibility  # "1" for public, "0" for private
+        self.token = token
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return f"ParkedSession({self.user_id!r}, visibility={self.visibility!r})"
+
+
+class ParkedSessions:
+    """
+    The parked sessions, keyed by userID.
+
+    Every session is parked for the same grace period, so the table's insertion order is also its expiry order, as with
+    handshakes.PendingRequests.
+    """
+
+    def __init__(self, grace):
+        self.grace = grace  # seconds a session stays parked; 0 for never parking
+        self.lock = threading.Lock()
+        self._parked = OrderedDict()  # user_ID -> ParkedSession, oldest first
+
+    def __len__(self):
+        return len(self._parked)
+
+    def park(self, user_id, visibility, token, now=None):
+        """
+        Keeps a client's session for them until the grace period is up.
+        :param user_id: The userID of the client
+        :type user_id: str
+        :param visibility: "1" for public, "0" for private
+        :type visibility: str
+        :param token: the token the client must present to resume
+        :type token: str
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: ParkedSession
+        """
+        if now is None:
+            now = time.monotonic()
+        parked = ParkedSession(user_id, visibility, token, now + self.grace)
+        with self.lock:
+            self._parked.pop(user_id, None)
+            self._parked[user_id] = parked
+        return parked
+
+    def claim(self, user_id, token):
+        """
+        Takes a parked session back for the client resuming it.
+        :param user_id: The userID the client was given
+        :type user_id: str
+        :param token: the token the client presented
+        :type token: str
+        :rtype: ParkedSession or None if there is no such session or the token is wrong
+        """
+        with self.lock:
+            parked = self._parked.get(user_id)
+            if parked is None or not same_token(parked.token, token):
+                return None
+            return self._parked.pop(user_id)
+
+    def expire(self, now=None):
+        """
+        Takes every session parked for longer than the grace period off the table.
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: list[ParkedSession]
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self._parked:
+                parked = next(iter(self._parked.values()))
+                if parked.expires_at > now:
+                    break
+                expired.append(self._parked.popitem(last=False)[1])
+        return expired
+
+    def sessions(self):
+        """
+        A copy of every parked session, oldest first.
+        :rtype: list[ParkedSession]
+        """
+        with self.lock:
+            return list(self._parked.values())
+
+
+def save_sessions(path, sessions):
+    """
+    Writes sessions to a file, replacing the previous file in one step so a crash never leaves half of one. The file
+    holds resumption tokens, so only its owner may read it.
+    :param path: where to write
+    :type path: str
+    :param sessions: the sessions to save, connected or parked
+    :type sessions: list[registry.Session or ParkedSession]
+    :rtype: None
+    """
+    temporary = path + ".tmp"
+    with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+        json.dump([{"user_id": session.user_id, "visibility": session.visibility, "token": session.token}
+                   for session in sessions], file)
+    os.replace(temporary, path)
+
+
+def load_sessions(path):
+    """
+    Reads the sessions save_sessions() wrote.
+    :param path: where they were written
+    :type path: str
+    :rtype: list[dict] (user_id, visibility and token; empty if there is no readable file)
+    """
+    try:
+        with open(path) as file:
+            sessions = json.load(file)
+    except (OSError, ValueError):
+        return []
+    return [session for session in sessions
+            if isinstance(session, dict) and {"user_id", "visibility", "token"} <= set(session)]
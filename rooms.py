@@ -0,0 +1,179 @@
+"""
+rooms.py - Group chat rooms, relayed through the server
+
+A client opens a room with CREATE_ROOM <room>, others come in with JOIN_ROOM <room>, and ROOM_SEND <room> <text>
+reaches everyone else in it as a message from the sender's user_ID:
+
+    ROOM_MESSAGE <room>
+    <text>
+
+Unlike the 1:1 chats, which go straight from client to client once the server has exchanged their addresses, room
+messages go through the server. Each is encoded once for every wire format its members speak (see deliver()), and the
+same bytes go on every member's outbound queue, so a room of thousands costs one encoding and a queue append per
+member. Nothing waits for a member to read: one that lets its queue fill up is disconnected as a slow consumer, like
+any other client, and the sender is told how many members the message reached.
+
+Members are kept by user_ID, so a client that resumes its session is still in its rooms. A room is closed once its
+last member leaves.
+"""
+import threading
+from protocol import encode_frame, serialize, LEGACY_RECV_SIZE
+from flowcontrol import SlowConsumer
+
+ROOM_PREFIX = "ROOM_MESSAGE"
+ROOM_NAME_LIMIT = 64  # longest room name, in characters
+
+
+class Room:
+    """
+    The user_IDs of a room's members, in the order they joined.
+    """
+    __slots__ = ("name", "members", "_snapshot")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # user_ID -> None, a set that keeps the order they joined in
+        self._snapshot = None  # the members as a tuple, until someone joins or leaves
+
+    def snapshot(self):
+        """
+        :rtype: tuple[str] (the members, kept until they change, so a busy room is not copied for every message)
+        """
+        if self._snapshot is None:
+            self._snapshot = tuple(self.members)
+        return self._snapshot
+
+    def changed(self):
+        self._snapshot = None
+
+
+class RoomDirectory:
+    """
+    Every room on the server and the rooms each client is in. Thread safe.
+    """
+
+    def __init__(self):
+        self._rooms = {}  # name -> Room
+        self._joined = {}  # user_ID -> set of the names of the rooms they are in
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def create(self, name, user_id):
+        """
+        Opens a room, with whoever opened it as its first member.
+        :rtype: bool (False if there is already a room by that name)
+        """
+        with self._lock:
+            if name in self._rooms:
+                return False
+            self._rooms[name] = Room(name)
+            self._add(name, user_id)
+            return True
+
+    def join(self, name, user_id):
+        """
+        :rtype: int or None (how many members the room has now, None if there is no room by that name)
+        """
+        with self._lock:
+            if name not in self._rooms:
+                return None
+            self._add(name, user_id)
+            return len(self._rooms[name].members)
+
+    def leave(self, name, user_id):
+        """
+        :rtype: bool (False if they were not in that room)
+        """
+        with self._lock:
+            return self._remove(name, user_id)
+
+    def leave_all(self, user_id):
+        """
+        Takes a client out of every room they are in, such as when they leave the server.
+        :rtype: list[str] (the names of the rooms they were in)
+        """
+        with self._lock:
+            names = list(self._joined.get(user_id, ()))
+            for name in names:
+                self._remove(name, user_id)
+            return names
+
+    def members(self, name, user_id):
+        """
+        The members of a room that a client is in.
+        :param name: the room
+        :type name: str
+        :param user_id: the client asking, who must be a member
+        :type user_id: str
+        :rtype: tuple[str] or None (None if there is no such room, or the client is not in it)
+        """
+        with self._lock:
+            room = self._rooms.get(name)
+            if room is None or user_id not in room.members:
+                return None
+            return room.snapshot()
+
+    def _add(self, name, user_id):
+        # called with the lock held
+        room = self._rooms[name]
+        if user_id not in room.members:
+            room.members[user_id] = None
+            room.changed()
+            self._joined.setdefault(user_id, set()).add(name)
+
+    def _remove(self, name, user_id):
+        # called with the lock held
+        room = self._rooms.get(name)
+        if room is None or user_id not in room.members:
+            return False
+        del room.members[user_id]
+        room.changed()
+        if not room.members:
+            del self._rooms[name]
+        joined = self._joined[user_id]
+        joined.discard(name)
+        if not joined:
+            del self._joined[user_id]
+        return True
+
+
+def deliver(connections, message_type, user_id, message):
+    """
+    Sends one message to many connections, encoding it once for each format they take (binary frames, compressed
+    frames or legacy text) rather than once per connection. Nothing waits for a connection to read; one whose outbound
+    queue is full is dropped, and one that is already closing is skipped, as is a legacy client the message is too long
+    for: they take each read to be one whole message.
+    :param connections: the channels to send to
+    :type connections: iterable of protocol.Channel or protocol.AsyncChannel
+    :param message_type: The type of message needing to be sent
+    :type message_type: int
+    :param user_id: The user_ID of sender
+    :type user_id: str
+    :param message: The actual message needing to be sent
+    :type message: str
+    :rtype: tuple[int,int] (how many connections it was sent to, how many were dropped as too slow)
+    """
+    encoded = {}  # the channel's compressor, or False for legacy text -> the message encoded for it
+    sent = dropped = 0
+    for connection in connections:
+        kind = connection.compressor if connection.binary else False
+        data = encoded.get(kind)
+        if data is None:
+            if connection.binary:
+                data = encode_frame(message_type, user_id, message, compressor=connection.compressor)
+            else:
+                data = serialize(message_type, user_id, message)
+            encoded[kind] = data
+        if kind is False and len(data) > LEGACY_RECV_SIZE:
+            continue
+        try:
+            connection.send_encoded(data)
+        except SlowConsumer:
+            dropped += 1
+        except OSError:
+            continue  # they are on their way out
+        else:
+            sent += 1
+    return sent, dropped
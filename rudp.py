@@ -0,0 +1,240 @@
+"""
+rudp.py - Reliable, ordered messages over UDP, for the peer to peer chat
+
+Messages are cut into numbered fragments that fit in one datagram. The receiver acknowledges every fragment with the
+next sequence number it is waiting for plus the ranges it already holds beyond that (selective ACKs), and hands whole
+messages over in the order they were sent. The sender keeps at most a window of fragments unacknowledged, times each
+one out after a retransmission timeout worked out from measured round trip times (RFC 6298), and resends a fragment
+straight away once several later ones have been acknowledged past it.
+
+Sequence numbers are 32 bits and never wrap, which is plenty for a chat.
+"""
+import struct
+import threading
+import time
+from collections import deque
+from queue import Queue
+from socket import timeout as socket_timeout
+
+DATA = 0
+ACK = 1
+DATA_HEADER = struct.Struct("!BIHH")  # kind, sequence number, fragment index, fragment count
+ACK_HEADER = struct.Struct("!BIB")  # kind, next sequence number expected, number of SACK blocks
+SACK_BLOCK = struct.Struct("!II")  # first and one past the last sequence number held beyond the cumulative ACK
+
+MAX_FRAGMENT = 1200  # payload bytes per datagram, small enough to avoid IP fragmentation
+MAX_FRAGMENTS = 65535  # per message, so the largest message is about 75 MB
+MAX_SACK_BLOCKS = 16
+WINDOW = 64  # fragments in flight
+DUPLICATE_THRESHOLD = 3  # later fragments acknowledged before a missing one is resent without waiting for its timer
+INITIAL_RTO = 0.5
+MIN_RTO = 0.02
+MAX_RTO = 4.0
+TICK = 0.005  # how often the timers are checked when nothing arrives
+
+
+class InFlight:
+    """
+    A fragment that has been sent and not acknowledged yet.
+    """
+    __slots__ = ("packet", "sent_at", "deadline", "timeouts", "retransmitted", "fast_retransmitted")
+
+    def __init__(self, packet, sent_at, deadline):
+        self.packet = packet
+        self.sent_at = sent_at
+        self.deadline = deadline
+        self.timeouts = 0
+        self.retransmitted = False  # round trips of resent fragments are ambiguous, so they are not measured (Karn)
+        self.fast_retransmitted = False
+
+
+class ReliableChannel:
+    """
+    Sends and receives whole messages to and from one peer over a UDP socket.
+
+    A background thread owns the socket's receiving side and the retransmission timers. send() never waits for the
+    network; received messages are put on the messages queue as bytes.
+    """
+
+    def __init__(self, sock, peer, window=WINDOW):
+        self.sock = sock
+        self.peer = peer  # (host, port)
+        self.window = window
+        self.messages = Queue()
+        self.rto = INITIAL_RTO
+        self.srtt = None
+        self.rttvar = None
+        self.packets_sent = 0
+        self.retransmissions = 0
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self._next_seq = 0
+        self._unsent = deque()  # (seq, packet) waiting for room in the window
+        self._in_flight = {}  # seq -> InFlight
+        self._expected = 0  # next sequence number to hand over
+        self._out_of_order = {}  # seq -> (fragment index, fragment count, payload), received ahead of _expected
+        self._fragments = []  # payloads of the message being put back together
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.sock.settimeout(TICK)
+        self._thread.start()
+
+    def send(self, message):
+        """
+        Queues a message for reliable delivery.
+        :param message: the message to send
+        :type message: str or bytes
+        :rtype: None
+        """
+        data = message.encode('utf-8') if isinstance(message, str) else message
+        count = max(1, -(-len(data) // MAX_FRAGMENT))
+        if count > MAX_FRAGMENTS:
+            raise ValueError("message too large")
+        with self._lock:
+            for index in range(count):
+                seq = self._next_seq
+                self._next_seq += 1
+                fragment = data[index * MAX_FRAGMENT:(index + 1) * MAX_FRAGMENT]
+                self._unsent.append((seq, DATA_HEADER.pack(DATA, seq, index, count) + fragment))
+            self._fill_window(time.monotonic())
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything sent so far has been acknowledged.
+        :param timeout: seconds to wait at most
+        :type timeout: float
+        :rtype: bool (False if it timed out)
+        """
+        with self._lock:
+            return self._drained.wait_for(lambda: not self._unsent and not self._in_flight, timeout)
+
+    def close(self, timeout=2.0):
+        """
+        Waits a little for unacknowledged messages to get through, then stops the background thread.
+        :param timeout: seconds to wait for outstanding messages
+        :type timeout: float
+        :rtype: None
+        """
+        self.flush(timeout)
+        self._closed = True
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                packet, address = self.sock.recvfrom(65535)
+            except socket_timeout:
+                packet = None
+            except OSError:
+                break
+            now = time.monotonic()
+            with self._lock:
+                if packet and address == self.peer:
+                    if packet[0] == DATA:
+                        self._receive_data(packet)
+                    elif packet[0] == ACK:
+                        self._receive_ack(packet, now)
+                self._check_timers(now)
+
+    # everything below runs with the lock held
+
+    def _transmit(self, packet):
+        self.packets_sent += 1
+        try:
+            self.sock.sendto(packet, self.peer)
+        except OSError:
+            pass  # a lost datagram is resent like any other
+
+    def _fill_window(self, now):
+        while self._unsent and len(self._in_flight) < self.window:
+            seq, packet = self._unsent.popleft()
+            self._in_flight[seq] = InFlight(packet, now, now + self.rto)
+            self._transmit(packet)
+
+    def _receive_data(self, packet):
+        if len(packet) < DATA_HEADER.size:
+            return
+        kind, seq, index, count = DATA_HEADER.unpack_from(packet)
+        payload = packet[DATA_HEADER.size:]
+        if seq == self._expected:
+            self._deliver(index, count, payload)
+            while self._expected in self._out_of_order:
+                self._deliver(*self._out_of_order.pop(self._expected))
+        elif self._expected < seq < self._expected + 4 * self.window:
+            self._out_of_order[seq] = (index, count, payload)
+        self._send_ack()
+
+    def _deliver(self, index, count, payload):
+        self._expected += 1
+        self._fragments.append(payload)
+        if index == count - 1:
+            self.messages.put(b"".join(self._fragments))
+            self._fragments = []
+
+    def _send_ack(self):
+        blocks = []
+        for seq in sorted(self._out_of_order):
+            if blocks and blocks[-1][1] == seq:
+                blocks[-1][1] = seq + 1
+            elif len(blocks) < MAX_SACK_BLOCKS:
+                blocks.append([seq, seq + 1])
+            else:
+                break
+        self._transmit(ACK_HEADER.pack(ACK, self._expected, len(blocks))
+                       + b"".join(SACK_BLOCK.pack(start, end) for start, end in blocks))
+
+    def _receive_ack(self, packet, now):
+        if len(packet) < ACK_HEADER.size:
+            return
+        kind, cumulative, block_count = ACK_HEADER.unpack_from(packet)
+        acked = [seq for seq in self._in_flight if seq < cumulative]
+        highest_sacked = cumulative
+        for i in range(block_count):
+            offset = ACK_HEADER.size + i * SACK_BLOCK.size
+            if len(packet) < offset + SACK_BLOCK.size:
+                break
+            start, end = SACK_BLOCK.unpack_from(packet, offset)
+            acked += [seq for seq in range(start, min(end, self._next_seq)) if seq in self._in_flight]
+            highest_sacked = max(highest_sacked, end)
+
+        for seq in acked:
+            fragment = self._in_flight.pop(seq, None)
+            if fragment is not None and not fragment.retransmitted:
+                self._measure(now - fragment.sent_at)
+
+        # fragments with enough later ones acknowledged past them, that have also had a round trip and a bit to
+        # arrive, are lost rather than overtaken
+        reordering_allowance = (self.srtt or INITIAL_RTO) * 1.25
+        for seq, fragment in self._in_flight.items():
+            if seq + DUPLICATE_THRESHOLD >= highest_sacked:
+                break
+            if not fragment.fast_retransmitted and now - fragment.sent_at > reordering_allowance:
+                fragment.fast_retransmitted = fragment.retransmitted = True
+                fragment.deadline = now + self.rto
+                self.retransmissions += 1
+                self._transmit(fragment.packet)
+
+        self._fill_window(now)
+        if not self._in_flight and not self._unsent:
+            self._drained.notify_all()
+
+    def _measure(self, rtt):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def _check_timers(self, now):
+        for fragment in self._in_flight.values():
+            if fragment.deadline <= now:
+                # each fragment backs off on its own, so one unlucky fragment does not slow down the rest
+                fragment.timeouts += 1
+                fragment.retransmitted = True
+                fragment.deadline = now + min(MAX_RTO, self.rto * 2 ** fragment.timeouts)
+                self.retransmissions += 1
+                self._transmit(fragment.packet)
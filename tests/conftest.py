@@ -0,0 +1,188 @@
+"""
+conftest.py - Starts servers on free loopback ports, and speaks to them the way KudzaiClient.py does
+"""
+import itertools
+import os
+import subprocess
+import sys
+import time
+from socket import socket, create_connection, AF_INET, SOCK_STREAM
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import Channel, PROTOCOL_ACK, SESSION_PREFIX, RESUME_PREFIX, serialize, deserialize  # noqa: E402
+
+START_TIMEOUT = 10  # seconds for a server to start listening
+REPLY_TIMEOUT = 5  # seconds to wait for any one message
+ENGINES = {"threads": [], "asyncio": ["--asyncio"]}
+
+
+def free_port():
+    """
+    :rtype: int (a loopback port nobody is listening on)
+    """
+    probe = socket(AF_INET, SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def start_server(port, *arguments):
+    """
+    Starts Server.py and waits until it is listening. Heartbeats are off, so no PINGs need answering.
+    :rtype: subprocess.Popen
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "Server.py"), "127.0.0.1", str(port), "--quiet",
+                                "--heartbeat-interval", "0"] + list(arguments),
+                               cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited with " + str(process.returncode))
+        try:
+            create_connection(("127.0.0.1", port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("the server did not start")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(REPLY_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def eventually(check, timeout=REPLY_TIMEOUT):
+    """
+    Calls check until it returns something true, such as once gossip has reached another node.
+    :rtype: the first true result
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result or time.monotonic() > deadline:
+            return result
+        time.sleep(0.05)
+
+
+class Client:
+    """
+    A client speaking the binary frames, with each command numbered so its reply can be told from everything else.
+    """
+
+    def __init__(self, port, user_id, visibility=1, token=None):
+        self.channel = Channel(create_connection(("127.0.0.1", port), timeout=REPLY_TIMEOUT))
+        if token is None:
+            self.channel.send(1, user_id, str(visibility))
+        else:
+            self.channel.send(2, user_id, RESUME_PREFIX + token + " " + str(visibility))
+        self.pushes = []  # (type, message) of everything received that was not a reply
+        self._request_ids = itertools.count(1)
+        assert self.receive() == (2, PROTOCOL_ACK)
+        message_type, message = self.receive()
+        assert message.startswith(SESSION_PREFIX)
+        words = message.split()
+        self.user_id, self.token, self.resumed = words[1], words[2], words[3] == "resumed"
+
+    def receive(self):
+        """
+        :rtype: tuple[int,str] (type, message)
+        """
+        message_type, request_id, user_id, message = self.channel.recv_frame()
+        return message_type, message
+
+    def command(self, command):
+        """
+        Sends a command and waits for its reply.
+        :rtype: tuple[int,str] (type, message)
+        """
+        request_id = next(self._request_ids)
+        self.channel.send(0, self.user_id, command, request_id)
+        while True:
+            message_type, reply_to, user_id, message = self.channel.recv_frame()
+            if reply_to == request_id:
+                return message_type, message
+            self.pushes.append((message_type, message))
+
+    def push(self):
+        """
+        Waits for the next message that is not a reply.
+        :rtype: tuple[int,str] (type, message)
+        """
+        if self.pushes:
+            return self.pushes.pop(0)
+        return self.receive()
+
+    def send(self, message_type, message):
+        self.channel.send(message_type, self.user_id, message)
+
+    def listed(self):
+        """
+        :rtype: list[str] (the userIDs LIST_CLIENTS shows)
+        """
+        message_type, message = self.command("LIST_CLIENTS")
+        return [line.split(". ", 1)[1] for line in message.split("\n")[1:] if ". " in line]
+
+    def close(self):
+        self.channel.close()
+
+
+class LegacyClient:
+    """
+    A client speaking only the legacy text format, as the original KudzaiClient.py did.
+    """
+
+    def __init__(self, port, user_id, visibility=1):
+        self.sock = create_connection(("127.0.0.1", port), timeout=REPLY_TIMEOUT)
+        self.user_id = user_id
+        self.sock.sendall(serialize(1, user_id, str(visibility)))
+        time.sleep(0.1)  # each read is one message to the server, so the hello must not run into the first command
+
+    def command(self, command):
+        self.sock.sendall(serialize(0, self.user_id, command))
+        message_type, user_id, message = deserialize(self.sock.recv(2048))
+        return int(message_type), message
+
+    def close(self):
+        self.sock.close()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "server_args(*arguments): more arguments for the server the test connects to")
+
+
+@pytest.fixture(params=list(ENGINES))
+def server(request):
+    """
+    The port of a server running each engine in turn, with the arguments of the test's server_args mark, if any.
+    """
+    mark = request.node.get_closest_marker("server_args")
+    port = free_port()
+    process = start_server(port, *ENGINES[request.param], *(mark.args if mark else ()))
+    yield port
+    stop_server(process)
+
+
+@pytest.fixture
+def connect(server):
+    """
+    Connects clients to the server, closing them at the end of the test.
+    """
+    clients = []
+
+    def connect(user_id, visibility=1, legacy=False, token=None):
+        client = LegacyClient(server, user_id, visibility) if legacy else Client(server, user_id, visibility, token)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.close()
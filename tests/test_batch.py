@@ -0,0 +1,55 @@
+"""
+test_batch.py - Several commands in one BATCH, answered at once, on both engines
+"""
+from protocol import BATCH_PREFIX, encode_batch, decode_batch_results
+
+
+def batch(client, commands):
+    """
+    :rtype: list[tuple[str,str]] (the status and reply of each command)
+    """
+    message_type, message = client.command(encode_batch(commands))
+    assert message_type == 2 and message.startswith(BATCH_PREFIX)
+    return [(result["status"], result["reply"]) for result in decode_batch_results(message)]
+
+
+def test_batch_answers_each_command(connect):
+    alice = connect("alice")
+    connect("bob")
+    assert batch(alice, ["LIST_CLIENTS", "VISIBILITY private", "FIND ", "VISIBILITY sometimes", "NOPE"]) == [
+        ("ok", "-------LIST OF AVAILABLE CLIENTS-------\n1. alice\n2. bob\n"),
+        ("ok", "Visibility status changed successfully"),
+        ("error", "Usage: FIND <prefix> [limit]"),
+        ("error", "Usage: VISIBILITY public|private"),
+        ("error", "Command not recognised: NOPE"),
+    ]
+    assert alice.listed() == ["bob"]  # carried on past the errors, with what came before them done
+
+
+def test_batch_refuses_terminate_and_batch(connect):
+    alice = connect("alice")
+    assert batch(alice, ["TERMINATE", "BATCH", "LIST_CLIENTS"]) == [
+        ("refused", "TERMINATE cannot be part of a BATCH"),
+        ("refused", "BATCH cannot be part of a BATCH"),
+        ("ok", "-------LIST OF AVAILABLE CLIENTS-------\n1. alice\n"),
+    ]
+
+
+def test_batch_connect_to_is_answered_later(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    assert batch(alice, ["CONNECT_TO bob"]) == [("pending", "")]
+    message_type, message = bob.push()
+    assert message_type == 4 and message.startswith("alice wants to speak to you.")
+    bob.send(1, "Y")
+    message_type, message = alice.push()
+    assert message.startswith("bob's address: 127.0.0.1:")
+
+
+def test_batch_limits(connect):
+    alice = connect("alice")
+    usage = (3, "Usage: BATCH followed by 1 to 50 commands, one per line")
+    assert alice.command(encode_batch([])) == usage
+    assert alice.command(encode_batch(["LIST_CLIENTS"] * 51)) == usage
+    legacy = connect("bob", legacy=True)
+    assert legacy.command(encode_batch(["LIST_CLIENTS"])) == (3, "BATCH needs a client that speaks binary frames")
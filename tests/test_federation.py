@@ -0,0 +1,150 @@
+"""
+test_federation.py - Three nodes sharing their clients, and the replicated directory underneath
+"""
+import pytest
+from conftest import Client, free_port, start_server, stop_server, eventually
+from federation import FederatedDirectory
+
+NODES = "abc"
+
+
+@pytest.fixture
+def nodes():
+    """
+    The client ports of three nodes, a, b and c, each a peer of the others, and their processes.
+    """
+    ports = [free_port() for node in NODES]
+    peer_ports = [free_port() for node in NODES]
+    processes = []
+    try:
+        for index, node in enumerate(NODES):
+            peers = ",".join("127.0.0.1:" + str(port) for port in peer_ports if port != peer_ports[index])
+            processes.append(start_server(ports[index], "--node", node, "--peer-port", str(peer_ports[index]),
+                                          "--peers", peers, "--gossip-interval", "0.1", "--peer-timeout", "1"))
+        yield dict(zip(NODES, ports)), dict(zip(NODES, processes))
+    finally:
+        for process in processes:
+            stop_server(process)
+
+
+def test_list_and_find_across_nodes(nodes):
+    ports, processes = nodes
+    alice = Client(ports["a"], "alice")
+    bob = Client(ports["b"], "bob")
+    carol = Client(ports["c"], "carol")
+    assert eventually(lambda: sorted(carol.listed()) == ["alice@a", "bob@b", "carol"])
+    message_type, message = carol.command("FIND b")
+    assert message_type == 2 and message.split("\n")[1] == "1. bob@b"
+    message_type, message = alice.command("FIND c")
+    assert message.split("\n")[1] == "1. carol@c"
+    for client in (alice, bob, carol):
+        client.close()
+
+
+def test_connect_to_across_nodes(nodes):
+    ports, processes = nodes
+    alice = Client(ports["a"], "alice")
+    bob = Client(ports["b"], "bob")
+    # each node only sends over the link it dialled, so both must be up
+    assert eventually(lambda: "bob@b" in alice.listed() and "alice@a" in bob.listed())
+    alice.channel.send(0, "alice", "CONNECT_TO bob@b", 1)
+    message_type, message = bob.push()
+    assert message_type == 4 and message.startswith("alice@a wants to speak to you.")
+    bob.send(1, "Y alice@a")
+    message_type, reply_to, user_id, message = alice.channel.recv_frame()
+    assert reply_to == 1 and message.startswith("bob's address: 127.0.0.1:")
+    assert bob.push()[1].startswith("alice@a's address: 127.0.0.1:")
+    alice.close()
+    bob.close()
+
+
+def test_client_leaving_is_seen_by_other_nodes(nodes):
+    ports, processes = nodes
+    alice = Client(ports["a"], "alice")
+    bob = Client(ports["b"], "bob")
+    assert eventually(lambda: "bob@b" in alice.listed())
+    assert bob.command("TERMINATE") == (2, "Good bye and take care!")
+    assert eventually(lambda: alice.listed() == ["alice"])
+    message_type, message = alice.command("CONNECT_TO bob@b")
+    assert message_type == 3 and message.startswith("USER:bob@b is not available.")
+    alice.close()
+
+
+def test_node_leaving_is_taken_off_the_lists(nodes):
+    ports, processes = nodes
+    alice = Client(ports["a"], "alice")
+    carol = Client(ports["c"], "carol")
+    assert eventually(lambda: "carol@c" in alice.listed())
+    stop_server(processes["c"])
+    assert eventually(lambda: alice.listed() == ["alice"])
+    message_type, message = alice.command("FIND carol")
+    assert message.split("\n")[1:] == [""]
+    alice.close()
+    carol.close()
+
+
+def exchange(asker, answerer):
+    # one round of gossip between two directories, as PeerLinks carries it
+    changes, reset = answerer.missing(asker.vector())
+    asker.merge(answerer.vector(), answerer.node)
+    asker.apply(changes, reset)
+    changes, reset = asker.missing(answerer.vector())
+    answerer.merge(asker.vector(), asker.node)
+    answerer.apply(changes, reset)
+
+
+def test_missing_sends_only_newer_changes():
+    a, b = FederatedDirectory("a"), FederatedDirectory("b")
+    for number in range(100):
+        a.claim("user" + str(number), ("127.0.0.1", number), "1")
+    exchange(b, a)
+    a.set_visibility("user5", "0")
+    a.claim("new", ("127.0.0.1", 1000), "1")
+    changes, reset = a.missing(b.vector())
+    assert [change[3] for change in changes] == ["user5", "new"]
+    assert reset == []
+    changes, reset, counter = a.own_changes(b.vector()["a"][1])
+    assert [change[3] for change in changes] == ["user5", "new"] and counter == 102
+
+
+def test_tombstones_are_forgotten_once_every_node_has_them():
+    a, b, c = FederatedDirectory("a"), FederatedDirectory("b"), FederatedDirectory("c")
+    a.claim("alice", ("127.0.0.1", 1), "1")
+    a.claim("bob", ("127.0.0.1", 2), "1")
+    exchange(b, a)
+    exchange(c, a)
+    a.release("bob")
+    exchange(b, a)
+    a.beat()
+    assert "bob" in a._own.clients  # c has not heard yet
+    exchange(c, a)
+    a.beat()
+    assert "bob" not in a._own.clients
+    assert [user_id for user_id in b.snapshot().public] == ["alice@a"]
+    assert [user_id for user_id in c.snapshot().public] == ["alice@a"]
+
+
+def test_tombstones_are_forgotten_after_the_ttl():
+    a, b = FederatedDirectory("a", tombstone_ttl=10), FederatedDirectory("b")
+    a.claim("alice", ("127.0.0.1", 1), "1")
+    exchange(b, a)
+    a.release("alice")
+    a.beat(now=a._own.tombstones[0][0] + 5)
+    assert "alice" in a._own.clients  # b is up and has not acknowledged it
+    a.beat(now=a._own.tombstones[0][0] + 11)
+    assert "alice" not in a._own.clients
+
+
+def test_node_behind_forgotten_tombstones_is_given_clients_afresh():
+    a, b = FederatedDirectory("a", tombstone_ttl=0), FederatedDirectory("b")
+    a.claim("alice", ("127.0.0.1", 1), "1")
+    a.claim("bob", ("127.0.0.1", 2), "1")
+    exchange(b, a)
+    a.release("bob")
+    a.claim("carol", ("127.0.0.1", 3), "1")
+    a.beat()  # forgets bob's tombstone before b has it
+    assert "bob" not in a._own.clients
+    version = b.version
+    exchange(b, a)
+    assert sorted(b.snapshot().public) == ["alice@a", "carol@a"]
+    assert b.version == version + 2  # bob went and carol came; alice was not taken off and put back
@@ -0,0 +1,62 @@
+"""
+test_flowcontrol.py - Rate limits, slow consumers and the limit on sessions, on both engines
+"""
+import time
+from socket import create_connection
+import pytest
+from conftest import REPLY_TIMEOUT
+from protocol import Channel
+
+
+@pytest.mark.server_args("--rate-limit", "10:2")
+def test_fast_client_is_read_more_slowly(connect):
+    alice = connect("alice")
+    start = time.monotonic()
+    for number in range(1, 13):
+        alice.channel.send(0, "alice", "LIST_CLIENTS", number)
+    replies = [alice.channel.recv_frame() for number in range(12)]
+    # two straight away, then one every tenth of a second; none of them refused
+    assert time.monotonic() - start >= 0.8
+    assert [reply[1] for reply in replies] == list(range(1, 13)) and all(reply[0] == 2 for reply in replies)
+
+
+@pytest.mark.server_args("--command-limit", "LIST_CLIENTS=1:2")
+def test_command_over_its_limit_is_refused(connect):
+    alice = connect("alice")
+    assert alice.command("LIST_CLIENTS")[0] == 2
+    assert alice.command("LIST_CLIENTS")[0] == 2
+    assert alice.command("LIST_CLIENTS") == (3, "Too many LIST_CLIENTS commands. Please slow down.")
+    assert alice.command("FIND a")[0] == 2  # other commands are not limited
+    time.sleep(1)
+    assert alice.command("LIST_CLIENTS")[0] == 2
+
+
+@pytest.mark.server_args("--queue-limit", "100000", "--high-water", "50000", "--low-water", "10000")
+def test_client_too_far_behind_is_disconnected(connect):
+    alice = connect("alice")
+    bob = connect("bob")  # never reads what is sent to him
+    assert alice.command("CREATE_ROOM team")[0] == 2
+    assert bob.command("JOIN_ROOM team")[0] == 2
+    text = "x" * 50000
+    for attempt in range(1000):
+        message_type, message = alice.command("ROOM_SEND team " + text)
+        if message.endswith("1 disconnected for falling too far behind"):
+            break
+    else:
+        pytest.fail("bob was never disconnected")
+    assert alice.listed() == ["alice"]
+
+
+@pytest.mark.server_args("--max-sessions", "1")
+def test_server_full(connect, server):
+    alice = connect("alice")
+    channel = Channel(create_connection(("127.0.0.1", server), timeout=REPLY_TIMEOUT))
+    try:
+        channel.send(1, "bob", "1")
+        assert channel.recv() == (3, "Server", "The server is full. Please try again later.")
+        with pytest.raises(ConnectionError):
+            channel.recv()
+    finally:
+        channel.close()
+    assert alice.command("TERMINATE")[0] == 2
+    assert connect("bob").user_id == "bob"
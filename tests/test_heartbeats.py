@@ -0,0 +1,36 @@
+"""
+test_heartbeats.py - Clients that stop answering PINGs, or stop sending commands, are evicted, on both engines
+"""
+import pytest
+from conftest import eventually
+
+HEARTBEATS = ("--heartbeat-interval", "0.5", "--heartbeat-timeout", "0.5")
+
+
+@pytest.mark.server_args(*HEARTBEATS)
+def test_client_answering_pings_stays(connect):
+    bob = connect("bob")
+    for ping in range(2):
+        assert bob.receive() == (2, "PING")
+        bob.send(2, "PONG")
+    assert sorted(connect("alice").listed()) == ["alice", "bob"]
+
+
+@pytest.mark.server_args(*HEARTBEATS)
+def test_client_not_answering_pings_is_evicted(connect):
+    alice = connect("alice")  # keeps sending commands, which show she is alive as well as a PONG would
+    bob = connect("bob")
+    assert bob.receive() == (2, "PING")
+    assert eventually(lambda: alice.listed() == ["alice"])
+    with pytest.raises(ConnectionError):
+        bob.receive()
+
+
+@pytest.mark.server_args("--idle-timeout", "1")
+def test_client_sending_no_commands_is_evicted(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    bob.send(2, "PONG")  # alive, but not a command
+    assert eventually(lambda: alice.listed() == ["alice"])
+    with pytest.raises(ConnectionError):
+        bob.receive()
@@ -0,0 +1,51 @@
+"""
+test_presence.py - Subscribers to the public list being pushed what changes in it, on both engines
+"""
+import time
+import pytest
+from presence import SNAPSHOT, DELTA
+
+
+def parse(message):
+    """
+    :rtype: tuple[str,list[int],list[str]] (SNAPSHOT or DELTA, its versions, the user_IDs or changes)
+    """
+    lines = message.split("\n")
+    words = lines[0].split()
+    return words[0], [int(version) for version in words[1:]], lines[1:]
+
+
+def test_subscriber_gets_snapshot_then_deltas(connect):
+    alice = connect("alice")
+    kind, [version], user_ids = parse(alice.command("SUBSCRIBE_PRESENCE")[1])
+    assert kind == SNAPSHOT and user_ids == ["alice"]
+    bob = connect("bob")
+    kind, versions, changes = parse(alice.push()[1])
+    assert kind == DELTA and versions[0] == version and changes == ["+bob"]
+    assert bob.command("VISIBILITY private")[0] == 2
+    kind, [start, version], changes = parse(alice.push()[1])
+    assert start == versions[1] and changes == ["-bob"]
+    # caught up from the version already seen, nothing has changed since
+    kind, versions, changes = parse(alice.command("SUBSCRIBE_PRESENCE " + str(version))[1])
+    assert kind == DELTA and versions == [version, version] and changes == []
+
+
+@pytest.mark.server_args("--presence-window", "1")
+def test_changes_within_a_window_are_netted_out(connect):
+    alice = connect("alice")
+    alice.command("SUBSCRIBE_PRESENCE")
+    assert connect("bob").command("TERMINATE")[0] == 2
+    connect("carol")
+    kind, versions, changes = parse(alice.push()[1])
+    assert kind == DELTA and changes == ["+carol"]
+
+
+def test_unsubscribed_client_is_pushed_nothing(connect):
+    alice = connect("alice")
+    alice.command("SUBSCRIBE_PRESENCE")
+    assert alice.command("UNSUBSCRIBE_PRESENCE") == (2, "Unsubscribed from presence updates")
+    connect("bob")
+    time.sleep(0.5)  # longer than the window, so a delta would have been sent by now
+    assert alice.command("UNSUBSCRIBE_PRESENCE") == (3, "You are not subscribed to presence updates")
+    assert sorted(alice.listed()) == ["alice", "bob"]
+    assert alice.pushes == []
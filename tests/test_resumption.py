@@ -0,0 +1,45 @@
+"""
+test_resumption.py - Clients resuming the session their dropped connection left behind, on both engines
+"""
+import time
+import pytest
+from conftest import eventually
+
+
+def test_resume_after_the_connection_drops(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    alice.close()
+    assert eventually(lambda: bob.listed() == ["bob"])
+    # the userID is kept for her meanwhile
+    other = connect("alice")
+    assert other.user_id != "alice"
+    assert other.command("TERMINATE")[0] == 2
+    resumed = connect("alice", token=alice.token)
+    assert resumed.user_id == "alice" and resumed.resumed and resumed.token != alice.token
+    assert sorted(bob.listed()) == ["alice", "bob"]
+
+
+def test_resume_before_the_server_notices(connect):
+    alice = connect("alice")
+    resumed = connect("alice", token=alice.token)
+    assert resumed.user_id == "alice" and resumed.resumed
+    with pytest.raises(ConnectionError):
+        alice.receive()
+    assert resumed.listed() == ["alice"]
+
+
+def test_wrong_token_joins_afresh(connect):
+    alice = connect("alice")
+    alice.close()
+    other = connect("alice", token="not-" + alice.token)
+    assert other.user_id != "alice" and not other.resumed
+
+
+@pytest.mark.server_args("--resume-grace", "0.5")
+def test_session_is_forgotten_after_the_grace(connect):
+    alice = connect("alice")
+    alice.close()
+    time.sleep(2)  # parked sessions are looked at every second
+    other = connect("alice", token=alice.token)
+    assert other.user_id == "alice" and not other.resumed
@@ -0,0 +1,36 @@
+"""
+test_rooms.py - Group chat rooms relayed by the server, on both engines
+"""
+from rooms import ROOM_PREFIX
+
+
+def test_room_message_reaches_the_other_members(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    carol = connect("carol")
+    dave = connect("dave")
+    assert alice.command("CREATE_ROOM team") == (2, "Room team created")
+    assert bob.command("JOIN_ROOM team") == (2, "Joined room team (2 members)")
+    assert carol.command("JOIN_ROOM team") == (2, "Joined room team (3 members)")
+    assert alice.command("ROOM_SEND team hello,  all") == (2, "Sent to 2 of 2 members of team")
+    for member in (bob, carol):
+        assert member.channel.recv() == (2, "alice", ROOM_PREFIX + " team\nhello,  all")
+    assert dave.command("ROOM_SEND team hi") == (3, "You are not in a room called team")
+    assert bob.command("LEAVE_ROOM team") == (2, "Left room team")
+    assert carol.command("TERMINATE")[0] == 2
+    assert alice.command("ROOM_SEND team anyone?") == (2, "Sent to 0 of 0 members of team")
+    # nothing more reached those who are not in the room, which a command's reply would have been queued behind
+    bob.listed()
+    dave.listed()
+    assert bob.pushes == [] and dave.pushes == []
+
+
+def test_room_commands_that_cannot_be_carried_out(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    assert alice.command("CREATE_ROOM team")[0] == 2
+    assert bob.command("CREATE_ROOM team") == (3, "There is already a room called team")
+    assert bob.command("JOIN_ROOM nowhere") == (3, "There is no room called nowhere")
+    assert bob.command("LEAVE_ROOM team") == (3, "You are not in a room called team")
+    assert bob.command("JOIN_ROOM") == (3, "Usage: JOIN_ROOM <room>")
+    assert alice.command("ROOM_SEND team") == (3, "Usage: ROOM_SEND <room> <text>")
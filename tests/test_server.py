@@ -0,0 +1,215 @@
+"""
+test_server.py - The commands every client relies on, against both engines (see the server fixture)
+"""
+from socket import create_connection
+import time
+import pytest
+from conftest import REPLY_TIMEOUT, free_port, start_server, stop_server
+from protocol import Channel, PROTOCOL_ACK, SESSION_PREFIX, UPGRADE_PREFIX, FLAG_ACCEPTS_COMPRESSED, FLAG_COMPRESSED, \
+    DICTIONARY_ID, upgrade_hello, serialize, encode_frame, encode_batch, \
+    decode_batch_results
+from KudzaiClient import ServerConnection, open_channel
+
+
+def test_hello_binary(connect):
+    alice = connect("alice")
+    assert alice.user_id == "alice"
+    assert alice.command("LIST_CLIENTS") == (2, "-------LIST OF AVAILABLE CLIENTS-------\n1. alice\n")
+
+
+def test_hello_duplicate_user_id(connect):
+    connect("alice")
+    assert connect("alice").user_id != "alice"
+
+
+def test_hello_upgrade(server):
+    # a text hello asking for frames, followed straight away by a text command, as a new client sends to any server
+    channel = Channel(create_connection(("127.0.0.1", server), timeout=REPLY_TIMEOUT), binary=None)
+    try:
+        channel.send(1, "alice", upgrade_hello(1, FLAG_ACCEPTS_COMPRESSED))
+        channel.send(0, "alice", "LIST_CLIENTS")
+        assert channel.recv() == (2, "Server", PROTOCOL_ACK)
+        assert channel.binary
+        assert channel.recv()[2].startswith(SESSION_PREFIX)
+        assert channel.recv()[2] == "-------LIST OF AVAILABLE CLIENTS-------\n1. alice\n"
+        channel.send(0, "alice", "VISIBILITY private", 7)
+        assert channel.recv_frame() == (2, 7, "Server", "Visibility status changed successfully")
+    finally:
+        channel.close()
+
+
+def upgraded(port, *reads):
+    """
+    Says an upgrade hello and sends each read in one go, then takes the acknowledgement and the session.
+    :rtype: protocol.Channel (binary, for what the server sends after)
+    """
+    sock = create_connection(("127.0.0.1", port), timeout=REPLY_TIMEOUT)
+    sock.sendall(serialize(1, "bob", upgrade_hello(1)) + b"\n")
+    for data in reads:
+        sock.sendall(data)
+        time.sleep(0.05)
+    channel = Channel(sock)
+    assert channel.recv() == (2, "Server", PROTOCOL_ACK)
+    assert channel.recv()[2].startswith(SESSION_PREFIX)
+    return channel
+
+
+def test_text_command_and_frame_in_one_read(server):
+    # the client's last text command before it heard the acknowledgement, and its first frame after
+    channel = upgraded(server, serialize(0, "bob", "LIST_CLIENTS") + b"\n" + encode_frame(0, "bob", "FIND bob", 0, 5))
+    try:
+        assert channel.recv_frame() == (2, 0, "Server", "-------LIST OF AVAILABLE CLIENTS-------\n1. bob\n")
+        assert channel.recv_frame() == (2, 5, "Server", "-------CLIENTS STARTING WITH bob-------\n1. bob\n")
+    finally:
+        channel.close()
+
+
+def test_text_commands_joined_and_split(server):
+    first, second = serialize(0, "bob", "VISIBILITY private") + b"\n", serialize(0, "bob", "LIST_CLIENTS") + b"\n"
+    channel = upgraded(server, first + second[:5], second[5:])
+    try:
+        assert channel.recv()[2] == "Visibility status changed successfully"
+        assert channel.recv()[2] == "-------LIST OF AVAILABLE CLIENTS-------\n"
+    finally:
+        channel.close()
+
+
+def test_client_sends_batch_once_joined(server):
+    # a BATCH has newlines of its own, so it cannot go as a line of text
+    client = ServerConnection(open_channel("127.0.0.1", server, "bob", 1), "bob")
+    try:
+        message_type, user_id, message = client.request(encode_batch(["LIST_CLIENTS", "FIND b"])).result(REPLY_TIMEOUT)
+        assert [result["reply"] for result in decode_batch_results(message)] == [
+            "-------LIST OF AVAILABLE CLIENTS-------\n1. bob\n", "-------CLIENTS STARTING WITH b-------\n1. bob\n"]
+        assert client.wait_joined() and client.user_id == "bob"
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize("hello, compressed", [
+    (upgrade_hello(1, FLAG_ACCEPTS_COMPRESSED), True),
+    ("1," + UPGRADE_PREFIX + str(FLAG_ACCEPTS_COMPRESSED) + " " + str(DICTIONARY_ID + 1), False),
+    ("1," + UPGRADE_PREFIX + str(FLAG_ACCEPTS_COMPRESSED), False),
+])
+def test_compression_needs_the_same_dictionary(hello, compressed):
+    port = free_port()
+    process = start_server(port, "--compress-above", "10")
+    channel = Channel(create_connection(("127.0.0.1", port), timeout=REPLY_TIMEOUT), binary=None)
+    try:
+        channel.send(1, "alice", hello)
+        message_type, request_id, user_id, message = channel.recv_frame()
+        assert message == PROTOCOL_ACK and request_id == DICTIONARY_ID
+        channel.recv()  # the session
+        channel.send(0, "alice", "LIST_CLIENTS", 1)
+        assert channel.recv_frame() == (2, 1, "Server", "-------LIST OF AVAILABLE CLIENTS-------\n1. alice\n")
+        assert bool(channel.flags & FLAG_COMPRESSED) == compressed
+    finally:
+        channel.close()
+        stop_server(process)
+
+
+def test_hello_legacy(connect):
+    alice = connect("alice", legacy=True)
+    bob = connect("bob")
+    assert bob.listed() == ["alice", "bob"]
+    assert alice.command("LIST_CLIENTS") == (2, "-------LIST OF AVAILABLE CLIENTS-------\n1. alice\n2. bob\n")
+
+
+def test_list_clients_leaves_out_private(connect):
+    alice = connect("alice")
+    connect("bob", visibility=0)
+    connect("carol")
+    assert alice.listed() == ["alice", "carol"]
+
+
+def test_list_clients_pages(connect):
+    alice = connect("alice")
+    for name in ("bob", "carol", "dave"):
+        connect(name)
+    message_type, message = alice.command("LIST_CLIENTS 1 2")
+    assert message_type == 2
+    assert "bob" in message and "carol" in message and "alice" not in message and "dave" not in message
+    message_type, message = alice.command("LIST_CLIENTS 5 2")
+    assert message_type == 2 and message.startswith("-------NO CLIENTS AT OFFSET 5 (of 4, version ")
+
+
+def test_visibility(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    assert alice.command("VISIBILITY private") == (2, "Visibility status changed successfully")
+    assert bob.listed() == ["bob"]
+    assert alice.command("VISIBILITY public") == (2, "Visibility status changed successfully")
+    assert sorted(bob.listed()) == ["alice", "bob"]
+
+
+def test_connect_to_accepted(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    alice.channel.send(0, "alice", "CONNECT_TO bob", 1)
+    message_type, message = bob.push()
+    assert message_type == 4 and message.startswith("alice wants to speak to you.")
+    bob.send(1, "Y")
+    message_type, reply_to, user_id, message = alice.channel.recv_frame()
+    assert reply_to == 1 and message.startswith("bob's address: 127.0.0.1:")
+    message_type, message = bob.push()
+    assert message.startswith("alice's address: 127.0.0.1:")
+    # chatting, so neither is listed
+    assert connect("carol").listed() == ["carol"]
+
+
+def test_connect_to_denied(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    alice.channel.send(0, "alice", "CONNECT_TO bob", 1)
+    assert bob.push()[0] == 4
+    bob.send(1, "N")
+    message_type, reply_to, user_id, message = alice.channel.recv_frame()
+    assert (message_type, reply_to) == (3, 1)
+    assert message.startswith("USER:bob does not want to speak to you!")
+
+
+def test_cancel_request(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    alice.channel.send(0, "alice", "CONNECT_TO bob", 100)
+    assert bob.push()[0] == 4
+    assert alice.command("CANCEL_REQUEST bob") == (2, "Request to bob cancelled")
+    # the CONNECT_TO is answered too, just before
+    assert alice.pushes == [(3, "Request to bob cancelled")]
+    assert bob.push() == (2, "alice no longer wants to speak to you.")
+    assert alice.command("CANCEL_REQUEST bob") == (3, "You have not asked bob to chat.")
+    assert alice.command("CANCEL_REQUEST") == (3, "Usage: CANCEL_REQUEST <user_id>")
+
+
+def test_connect_to_nobody(connect):
+    alice = connect("alice")
+    message_type, message = alice.command("CONNECT_TO nobody")
+    assert message_type == 3 and message.startswith("USER:nobody is not available.")
+
+
+def test_bad_commands_get_usage(connect):
+    alice = connect("alice")
+    assert alice.command("") == (3, "Command not recognised: ")
+    assert alice.command("   ") == (3, "Command not recognised:    ")
+    assert alice.command("VISIBILITY") == (3, "Usage: VISIBILITY public|private")
+    assert alice.command("VISIBILITY sometimes") == (3, "Usage: VISIBILITY public|private")
+    assert alice.command("CONNECT_TO") == (3, "Usage: CONNECT_TO <user_id>")
+    # still connected, and still public
+    assert alice.listed() == ["alice"]
+
+
+def test_terminate(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    assert alice.command("TERMINATE") == (2, "Good bye and take care!")
+    assert bob.listed() == ["bob"]
+    # the userID is free again straight away
+    assert connect("alice").user_id == "alice"
+
+
+def test_terminate_legacy(connect):
+    alice = connect("alice", legacy=True)
+    bob = connect("bob")
+    assert alice.command("TERMINATE") == (2, "Good bye and take care!")
+    assert bob.listed() == ["bob"]
+
@@ -0,0 +1,33 @@
+"""
+test_stats.py - The STATS command, against both engines
+"""
+
+
+def stats_rows(message):
+    """
+    :rtype: dict (command name -> its count, from the table in a STATS reply)
+    """
+    lines = message.split("\n")
+    table = lines[next(i for i, line in enumerate(lines) if line.startswith("command")) + 1:]
+    rows = {}
+    for line in table[:table.index("")]:
+        words = line.split()
+        rows[words[0]] = int(words[1])
+    return rows
+
+
+def test_stats_counts_sessions_and_commands(connect):
+    alice = connect("alice")
+    connect("bob", visibility=0)
+    for each in range(3):
+        alice.command("LIST_CLIENTS")
+    alice.command("FIND b")
+    message_type, message = alice.command("STATS")
+    assert message_type == 2
+    lines = message.split("\n")
+    assert lines[0] == "-------SERVER STATS-------"
+    assert ", 2 sessions " in lines[1]
+    rows = stats_rows(message)
+    assert rows["LIST_CLIENTS"] == 3 and rows["FIND"] == 1
+    message_type, message = alice.command("STATS")
+    assert stats_rows(message)["STATS"] == 1
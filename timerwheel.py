@@ -0,0 +1,88 @@
+"""
+timerwheel.py - A hashed timing wheel, for keeping a timer per connected client
+
+Time is cut into ticks, and each timer sits in the slot its deadline's tick hashes to. Scheduling, rescheduling and
+cancelling a timer are dict operations whatever the number of timers, and advancing the wheel only looks at the
+slots for the ticks that have passed. Timers fire up to one tick late, never early.
+"""
+import math
+import threading
+
+
+class TimerWheel:
+    """
+    Deadlines for any hashable keys, with at most one timer per key.
+    """
+
+    def __init__(self, tick=0.5, slots=512, now=0.0):
+        """
+        :param tick: seconds per slot, which is also how late a timer may fire
+        :type tick: float
+        :param slots: how many slots the wheel has; deadlines further than slots * tick away go round more than once
+        :type slots: int
+        :param now: the current time.monotonic()
+        :type now: float
+        """
+        self.tick = tick
+        self._slots = [{} for i in range(slots)]  # key -> absolute tick number it is due on
+        self._due = {}  # key -> absolute tick number, to find a key's slot when it is rescheduled or cancelled
+        self._current = int(now / tick)  # the last tick advance() has dealt with
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def schedule(self, key, deadline):
+        """
+        Sets a key's timer, replacing any timer it already had.
+        :param key: what the timer is for
+        :param deadline: the time.monotonic() it should fire at
+        :type deadline: float
+        :rtype: None
+        """
+        with self._lock:
+            due = max(math.ceil(deadline / self.tick), self._current + 1)
+            old = self._due.get(key)
+            if old is not None:
+                del self._slots[old % len(self._slots)][key]
+            self._due[key] = due
+            self._slots[due % len(self._slots)][key] = due
+
+    def cancel(self, key):
+        """
+        Removes a key's timer, if it has one.
+        :rtype: bool (False if it had none)
+        """
+        with self._lock:
+            due = self._due.pop(key, None)
+            if due is None:
+                return False
+            del self._slots[due % len(self._slots)][key]
+            return True
+
+    def advance(self, now):
+        """
+        Moves the wheel on to now and takes off every timer that is due.
+        :param now: the current time.monotonic()
+        :type now: float
+        :rtype: list (the keys whose timers fired)
+        """
+        fired = []
+        with self._lock:
+            target = int(now / self.tick)
+            # after a full turn every slot has been looked at, so a long gap costs no more than one turn
+            last = min(target, self._current + len(self._slots))
+            for tick in range(self._current + 1, last + 1):
+                slot = self._slots[tick % len(self._slots)]
+                if not slot:
+                    continue
+                due_keys = [key for key, due in slot.items() if due <= target]
+                for key in due_keys:
+                    del slot[key]
+                    del self._due[key]
+                fired += due_keys
+            self._current = max(self._current, target)
+        return fired
@@ -0,0 +1,491 @@
+"""
+workers.py - Running the server as several worker processes sharing one port
+
+With --workers N the server forks N worker processes, and each one listens on the same port with SO_REUSEPORT, so the
+kernel shares new connections out between them and each worker serves its clients on a core of its own.
+
+Each worker keeps its own ClientRegistry for the clients connected to it. What the workers need to know about each
+other's clients (their userIDs, visibility, address, and which worker they are on) is kept in a SharedDirectory, a
+hash table in memory that every worker maps, so looking up a client on another worker costs no more than looking up a
+local one. The public list and its recent changes are kept there too, so LIST_CLIENTS, FIND and presence cover every
+worker.
+
+Anything that has to reach a client on another worker, such as being asked to chat, is sent to that worker over a Unix
+socket (see WorkerLinks), and that worker passes it on to the client. A client resuming a session that another worker
+kept for them is handed over to that worker, connection and all.
+"""
+import json
+import mmap
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import zlib
+from collections import namedtuple
+from registry import RegistrySnapshot, CHANGE_HISTORY
+
+NAME_BYTES = 64  # the longest userID the directory holds, in UTF-8
+ADDRESS_BYTES = 50
+SUFFIX_BYTES = 16  # room left at the end of a userID for the suffix that makes it unique
+DIRECTORY_SIZE = 16384  # clients the directory has room for
+LINK_QUEUE_LIMIT = 64 * 1024 * 1024  # bytes queued for another worker before it is given up on
+COPY_FRACTION = 16  # a snapshot copies the table rather than reading it in place once this fraction of it is public
+
+HEADER = struct.Struct("<QQQ")  # version of the public list, the last public order handed out, entries
+HEADER_SIZE = 64
+CHANGE = struct.Struct("<QBB%ds" % NAME_BYTES)  # version, "+" or "-", userID length, userID
+# state, visibility, worker, public order, userID length, userID, address length, address
+SLOT = struct.Struct("<BBHQB%dsB%ds" % (NAME_BYTES, ADDRESS_BYTES))
+LISTED = struct.Struct("<QB%ds" % NAME_BYTES)  # just the public order and userID of a slot
+LISTED_OFFSET = 4
+
+EMPTY = 0
+CONNECTED = 1
+RESERVED = 2  # kept for a client that may resume its session
+
+DirectoryEntry = namedtuple("DirectoryEntry", "worker connected visibility address")
+
+
+class SharedDirectory:
+    """
+    Every client connected to any worker, in memory shared by the workers.
+
+    The table uses open addressing with linear probing, and removing an entry moves the entries after it back rather
+    than leaving a marker behind, so lookups stay short however many clients have come and gone. Every change is made
+    under one lock shared by the processes. Listing and searching read a RegistrySnapshot of the public list, made the
+    same way ClientRegistry makes them; the version of the public list and a ring of its last changes live in the shared
+    memory, so every worker hands out the same versions and presence deltas.
+
+    Entries are only changed by the worker the client is on, which is what the worker attribute says.
+    """
+
+    def __init__(self, capacity=DIRECTORY_SIZE):
+        """
+        :param capacity: how many clients there is room for
+        :type capacity: int
+        """
+        self.capacity = capacity
+        self.worker = 0  # the worker this process is, set once it has been forked
+        self.lock = multiprocessing.Lock()
+        self._slots = HEADER_SIZE + CHANGE_HISTORY * CHANGE.size
+        # an anonymous mapping is shared with the processes forked after it is made
+        self._memory = mmap.mmap(-1, self._slots + capacity * SLOT.size)
+        self._snapshot = RegistrySnapshot(0, (), ())  # this process's latest snapshot
+
+    def __len__(self):
+        return HEADER.unpack_from(self._memory, 0)[2]
+
+    def __contains__(self, user_id):
+        return self.lookup(user_id) is not None
+
+    @property
+    def version(self):
+        return HEADER.unpack_from(self._memory, 0)[0]
+
+    def full(self):
+        """
+        :rtype: bool (True once the table is too full for lookups to stay quick)
+        """
+        return len(self) >= self.capacity * 3 // 4
+
+    @staticmethod
+    def fit(user_id):
+        """
+        Shortens a userID a client asked for, if need be, so that it fits in the directory with a suffix added.
+        :rtype: str
+        """
+        name = user_id.encode()
+        if len(name) <= NAME_BYTES - SUFFIX_BYTES:
+            return user_id
+        return name[:NAME_BYTES - SUFFIX_BYTES].decode(errors="ignore")
+
+    def lookup(self, user_id):
+        """
+        Looks a client up by userID.
+        :param user_id: The userID of a client
+        :type user_id: str
+        :rtype: DirectoryEntry or None if nobody has that userID on any worker
+        """
+        with self.lock:
+            index, slot = self._find(user_id.encode())
+        if slot is None:
+            return None
+        address = slot[7][:slot[6]].decode()
+        if address:
+            host, _, port = address.rpartition(":")
+            address = (host, int(port))
+        return DirectoryEntry(slot[2], slot[0] == CONNECTED, "1" if slot[1] else "0", address or None)
+
+    def claim(self, user_id, address, visibility):
+        """
+        Adds a client connected to this worker, unless their userID has been taken.
+        :param user_id: The userID of the client
+        :type user_id: str
+        :param address: The client IP and port number (host,port)
+        :type address: tuple
+        :param visibility: "1" for public, "0" for private
+        :type visibility: str
+        :rtype: bool (False if someone on any worker already has the userID)
+        """
+        return self._add(user_id, CONNECTED, address, visibility)
+
+    def reserve(self, user_id):
+        """
+        Keeps a userID for a client of this worker that may resume.
+        :rtype: bool (False if someone on any worker already has the userID)
+        """
+        return self._add(user_id, RESERVED, None, "0")
+
+    def connect(self, user_id, address, visibility):
+        """
+        Marks a client of this worker whose userID was reserved as connected again.
+        :rtype: bool (False if the userID is not this worker's)
+        """
+        return self._change(user_id, CONNECTED, address, visibility)
+
+    def disconnect(self, user_id):
+        """
+        Keeps the userID of a client of this worker who lost their connection, taking them off the public list.
+        :rtype: bool (False if the userID is not this worker's)
+        """
+        return self._change(user_id, RESERVED, None, "0")
+
+    def set_visibility(self, user_id, visibility):
+        """
+        Changes the visibility of a client connected to this worker.
+        :rtype: bool (False if the userID is not this worker's)
+        """
+        return self._change(user_id, CONNECTED, None, visibility)
+
+    def release(self, user_id):
+        """
+        Removes a client of this worker altogether.
+        :rtype: None
+        """
+        with self.lock:
+            index, slot = self._find(user_id.encode())
+            if slot is None or slot[2] != self.worker:
+                return
+            if slot[0] == CONNECTED and slot[1]:
+                self._public_changed("-", slot[5][:slot[4]])
+            self._remove(index)
+            version, order, entries = HEADER.unpack_from(self._memory, 0)
+            HEADER.pack_into(self._memory, 0, version, order, entries - 1)
+
+    def _add(self, user_id, state, address, visibility):
+        name = user_id.encode()
+        if len(name) > NAME_BYTES:
+            raise ValueError("userID too long for the shared directory: " + user_id)
+        with self.lock:
+            index, slot = self._find(name)
+            if slot is not None:
+                return False
+            if index is None:
+                raise RuntimeError("the shared directory is full")
+            self._store(index, state, visibility, name, address, None)
+            version, order, entries = HEADER.unpack_from(self._memory, 0)
+            HEADER.pack_into(self._memory, 0, version, order, entries + 1)
+        return True
+
+    def _change(self, user_id, state, address, visibility):
+        name = user_id.encode()
+        with self.lock:
+            index, slot = self._find(name)
+            if slot is None or slot[2] != self.worker:
+                return False
+            self._store(index, state, visibility, name, address, slot)
+        return True
+
+    # the rest are always called with the lock held
+    def _find(self, name):
+        # the slot holding name, or the empty slot it would go in (None if the table is full) and None
+        start = zlib.crc32(name) % self.capacity
+        for probe in range(self.capacity):
+            index = (start + probe) % self.capacity
+            slot = SLOT.unpack_from(self._memory, self._slots + index * SLOT.size)
+            if slot[0] == EMPTY:
+                return index, None
+            if slot[5][:slot[4]] == name:
+                return index, slot
+        return None, None
+
+    def _store(self, index, state, visibility, name, address, slot):
+        # address None keeps the one already stored
+        was_public = slot is not None and slot[0] == CONNECTED and slot[1] == 1
+        public = state == CONNECTED and visibility == "1"
+        order = slot[3] if slot is not None else 0
+        if address is None:
+            address = slot[7][:slot[6]] if slot is not None else b""
+        else:
+            address = (str(address[0]) + ":" + str(address[1])).encode()[:ADDRESS_BYTES]
+        if public and not was_public:
+            order = self._public_changed("+", name)
+        elif was_public and not public:
+            self._public_changed("-", name)
+        SLOT.pack_into(self._memory, self._slots + index * SLOT.size, state, visibility == "1", self.worker,
+                       order, len(name), name, len(address), address)
+
+    def _public_changed(self, change, name):
+        # writes the change into the ring and returns the order a client made public is listed in
+        version, order, entries = HEADER.unpack_from(self._memory, 0)
+        version += 1
+        order += 1
+        HEADER.pack_into(self._memory, 0, version, order, entries)
+        CHANGE.pack_into(self._memory, HEADER_SIZE + version % CHANGE_HISTORY * CHANGE.size, version, ord(change),
+                         len(name), name)
+        return order
+
+    def _remove(self, index):
+        # empties a slot, then moves back any entry after it that could no longer be found with the gap in its way
+        size = SLOT.size
+        self._memory[self._slots + index * size:self._slots + (index + 1) * size] = bytes(size)
+        gap = index
+        following = index
+        while True:
+            following = (following + 1) % self.capacity
+            slot = SLOT.unpack_from(self._memory, self._slots + following * size)
+            if slot[0] == EMPTY:
+                return
+            home = zlib.crc32(slot[5][:slot[4]]) % self.capacity
+            # the entry can stay if its home lies cyclically after the gap, up to where it is now
+            if (gap < following and gap < home <= following) or (gap > following and (home > gap or home <= following)):
+                continue
+            start = self._slots + following * size
+            self._memory[self._slots + gap * size:self._slots + (gap + 1) * size] = self._memory[start:start + size]
+            self._memory[start:start + size] = bytes(size)
+            gap = following
+
+    def changes_since(self, version):
+        """
+        The changes to the public list after a version, oldest first, ending at the current version.
+        :param version: a version of the public list
+        :type version: int
+        :rtype: list[tuple[int,str,str]] ((version, "+" or "-", user_ID)) or None if they are not all remembered
+        """
+        with self.lock:
+            current = self.version
+            if version > current or current - version > CHANGE_HISTORY:
+                return None
+            changes = []
+            for wanted in range(version + 1, current + 1):
+                changed, change, length, name = CHANGE.unpack_from(
+                    self._memory, HEADER_SIZE + wanted % CHANGE_HISTORY * CHANGE.size)
+                changes.append((changed, chr(change), name[:length].decode()))
+        return changes
+
+    def snapshot(self):
+        """
+        The public list of every worker as it is now.
+        :rtype: RegistrySnapshot
+        """
+        snapshot = self._snapshot
+        if snapshot.version == self.version:
+            return snapshot
+        size = SLOT.size
+        end = self._slots + self.capacity * size
+        with self.lock:
+            version = self.version
+            # the state and visibility bytes of every slot, each picked out in a single C call; ANDed together as
+            # integers, they leave a 1 at just the public slots (CONNECTED is 1, RESERVED is 2)
+            states = int.from_bytes(self._memory[self._slots:end:size], "little")
+            visible = int.from_bytes(self._memory[self._slots + 1:end:size], "little")
+            marks = (states & visible).to_bytes(self.capacity, "little")
+            if marks.count(1) < self.capacity // COPY_FRACTION:
+                public = self._listed(marks, self._memory, self._slots)  # few enough to read while the others wait
+                table = None
+            else:
+                table = self._memory[self._slots:end]  # copied in one go, and read after
+        if table is not None:
+            public = self._listed(marks, table, 0)
+        public.sort()
+        public = tuple([user_id.decode() for order, user_id in public])
+        snapshot = RegistrySnapshot(version, public, tuple(sorted(public)))
+        if version > self._snapshot.version:
+            self._snapshot = snapshot
+        return snapshot
+
+    @staticmethod
+    def _listed(marks, table, start):
+        # (public order, userID) of every slot marked in marks
+        listed = []
+        index = marks.find(1)
+        while index != -1:
+            order, length, name = LISTED.unpack_from(table, start + index * SLOT.size + LISTED_OFFSET)
+            listed.append((order, name[:length]))
+            index = marks.find(1, index + 1)
+        return listed
+
+    def find(self, prefix, limit):
+        """
+        Finds public clients on every worker whose userID starts with prefix (see RegistrySnapshot.find()).
+        :rtype: list[str]
+        """
+        return self.snapshot().find(prefix, limit)
+
+    def public_snapshot(self):
+        """
+        The userIDs of public clients on every worker, in the order they became public, along with the version of the
+        list.
+        :rtype: tuple[int,tuple[str]]
+        """
+        snapshot = self.snapshot()
+        return snapshot.version, snapshot.public
+
+
+class WorkerLinks:
+    """
+    A connected pair of Unix sockets between every two workers, made before forking. Each worker keeps its own end of
+    the pairs it is part of. The engine wraps each end in a protocol.Channel or protocol.AsyncChannel and puts it in
+    channels, after which send() passes messages, encoded as JSON, to the other workers.
+
+    Each worker also has a datagram socket that any other worker can pass a client's connection to (see hand_over()).
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.index = None  # the worker this process is
+        self.sockets = {}  # the other worker's index -> this worker's end of the pair
+        self.channels = {}  # the other worker's index -> channel over that socket
+        self.inbox = None  # where connections handed over to this worker arrive
+        self._outboxes = {}  # the other worker's index -> where to hand connections over to it
+        self._pairs = {(first, second): socket.socketpair()
+                       for first in range(count) for second in range(first + 1, count)}
+        self._handovers = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for index in range(count)]
+
+    def become(self, index):
+        """
+        Keeps worker index's ends of the pairs, closing every other socket.
+        :rtype: None
+        """
+        self.index = index
+        for (first, second), (first_end, second_end) in self._pairs.items():
+            if first == index:
+                self.sockets[second] = first_end
+                second_end.close()
+            elif second == index:
+                self.sockets[first] = second_end
+                first_end.close()
+            else:
+                first_end.close()
+                second_end.close()
+        for worker, (receiving_end, sending_end) in enumerate(self._handovers):
+            if worker == index:
+                self.inbox = receiving_end
+                sending_end.close()
+            else:
+                self._outboxes[worker] = sending_end
+                receiving_end.close()
+        self._pairs = {}
+        self._handovers = []
+
+    def close(self):
+        for pair in list(self._pairs.values()) + self._handovers:
+            for end in pair:
+                end.close()
+        self._pairs = {}
+        self._handovers = []
+
+    def send(self, worker, message):
+        """
+        Sends a message to another worker.
+        :param worker: the worker's index
+        :type worker: int
+        :param message: what to send; "op" says what it is
+        :type message: dict
+        :rtype: None
+        """
+        channel = self.channels.get(worker)
+        if channel is None:
+            raise ConnectionError("no link to worker " + str(worker))
+        channel.send(2, str(self.index), json.dumps(message))
+
+    def hand_over(self, worker, sock, details):
+        """
+        Passes a client's connection to another worker. This worker can close its own copy of the socket afterwards.
+        :param worker: the worker's index
+        :type worker: int
+        :param sock: the client's socket
+        :type sock: socket.socket
+        :param details: what the other worker needs to know about the client, such as their hello
+        :type details: dict
+        :rtype: None
+        """
+        socket.send_fds(self._outboxes[worker], [json.dumps(details).encode()], [sock.fileno()])
+
+    def take_over(self):
+        """
+        Waits for another worker to hand a connection over to this one.
+        :rtype: tuple[socket.socket,dict] (the client's socket, and the details the other worker sent with it)
+        """
+        message, fds, flags, address = socket.recv_fds(self.inbox, 65536, 1)
+        return socket.socket(fileno=fds[0]), json.loads(message)
+
+
+class RemoteChannel:
+    """
+    Stands in for the channel of a client connected to another worker. Whatever is sent to it is passed on to that
+    worker, which sends it to the client.
+    """
+
+    def __init__(self, links, worker, user_id):
+        self.links = links
+        self.worker = worker
+        self.user_id = user_id
+        self.reply_to = 0  # request ID of the command the other worker passed on
+
+    def send(self, message_type, user_id, message, request_id=0):
+        self.links.send(self.worker, {"op": "deliver", "user_id": self.user_id, "type": message_type,
+                                      "message": message, "request_id": request_id})
+
+    def reply(self, message_type, user_id, message):
+        self.send(message_type, user_id, message, self.reply_to)
+
+    def close(self):
+        pass  # the client's own worker looks after their connection
+
+
+def fork_workers(count, links):
+    """
+    Forks the workers. The process that forks them only waits, and stops them all when it is told to stop or when any
+    one of them exits; it never returns.
+    :param count: how many workers
+    :type count: int
+    :param links: the links between them, which the forking process has no use for itself
+    :type links: WorkerLinks
+    :rtype: int (the index of the worker, in each worker)
+    """
+    children = {}
+    # only the forking process holds the write end, so the workers see the pipe close if it dies without stopping them
+    lifeline, held = os.pipe()
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            os.close(held)
+            threading.Thread(target=_exit_with_parent, args=(lifeline,), daemon=True).start()
+            return index
+        children[pid] = index
+    os.close(lifeline)
+    links.close()
+
+    def stop(signum=None, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0 if signum else 1)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    pid, status = os.wait()
+    print("worker " + str(children.pop(pid)) + " exited, stopping the others", file=sys.stderr)
+    stop()
+
+
+def _exit_with_parent(lifeline):
+    # the read only returns once the forking process is gone
+    os.read(lifeline, 1)
+    os._exit(1)